@@ -0,0 +1,204 @@
+"""
+Admission.py file for ProxyGPT. This file contains the admission control of upstream calls for the API.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for waiting for a slot
+import asyncio
+
+# Required for the priority wait queue
+import heapq
+import itertools
+
+# Required for rounding up Retry-After
+import math
+
+# Required for wait and hold times
+import time
+
+# Required for the recent wait times
+from collections import deque
+
+# Required for type hints
+from typing import Optional
+
+
+# ------------- [Classes] -------------
+
+# Define the error raised when a request is not admitted
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is shed by admission control, either because the
+    wait queue is full or because its wait deadline passed.
+
+    Args:
+        reason (str): Either "queue_full" or "timeout".
+        retry_after (int): The suggested seconds before retrying.
+    """
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Request not admitted ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# Define the slot held by an admitted request
+class AdmissionTicket:
+    """
+    A slot held by an admitted request. It must be released once the upstream
+    call has finished (for streams, once the stream has been relayed).
+    Releasing twice has no effect.
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        """
+        This function returns the slot to the controller, admitting the next waiting request.
+        """
+        if not self.released:
+            self.released = True
+            self.controller._release(time.monotonic() - self.admitted_at)
+
+
+# Define the admission controller
+class AdmissionController:
+    """
+    Bounds the number of concurrent upstream calls of a worker. Requests
+    beyond max_concurrency wait in a queue, ordered by priority (lower first)
+    and then by arrival. A request is shed with AdmissionRejected when the
+    queue already holds max_queue requests, or when it has waited for
+    queue_timeout seconds, so latency stays bounded under overload instead of
+    every request timing out.
+
+    Runs in the event loop of the worker, so it needs no locks.
+
+    Args:
+        max_concurrency (Optional[int]): The maximum number of admitted requests (None for no limit).
+        max_queue (int): The maximum number of waiting requests.
+        queue_timeout (float): The maximum seconds a request waits for a slot.
+    """
+
+    def __init__(self, max_concurrency: Optional[int], max_queue: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self.waiters = []
+        self.sequence = itertools.count()
+
+        # Metrics
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.max_wait_ms = 0.0
+        self.recent_wait_ms = deque(maxlen=1000)
+        self.recent_hold_seconds = deque(maxlen=100)
+
+    async def acquire(self, priority: int = 0, timeout: Optional[float] = None) -> AdmissionTicket:
+        """
+        This function waits for a slot, and returns it once admitted.
+
+        Args:
+            priority (int): The priority of the request (lower is admitted first).
+            timeout (Optional[float]): The maximum seconds to wait, if shorter than queue_timeout (e.g. the time left before the deadline of the request).
+
+        Returns:
+            AdmissionTicket: The slot of the request.
+
+        Raises:
+            AdmissionRejected: If the queue is full, or the wait deadline passed.
+        """
+        # Admit at once while there is room and no one is waiting
+        if self.queued == 0 and (self.max_concurrency is None or self.active < self.max_concurrency):
+            self.active += 1
+            return self._admit(0.0)
+
+        if self.queued >= self.max_queue:
+            self.rejected_queue_full += 1
+            raise AdmissionRejected("queue_full", self.retry_after())
+
+        start_time = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        self.queued += 1
+        try:
+            await asyncio.wait([future], timeout=self.queue_timeout if timeout is None else min(timeout, self.queue_timeout))
+        except asyncio.CancelledError:
+            # The request was cancelled while waiting. If the slot was already handed over, pass it on.
+            self.queued -= 1
+            if future.done() and not future.cancelled():
+                self._release(0.0)
+            else:
+                future.cancel()
+            raise
+        self.queued -= 1
+
+        # The slot was handed over by a finished request (the active count already includes it)
+        if future.done() and not future.cancelled():
+            return self._admit((time.monotonic() - start_time) * 1000)
+
+        future.cancel()
+        self.rejected_timeout += 1
+        raise AdmissionRejected("timeout", self.retry_after())
+
+    def retry_after(self) -> int:
+        """
+        This function estimates the seconds until a new request would be
+        admitted, from the queue length and the recent hold times of a slot.
+
+        Returns:
+            int: The suggested Retry-After in seconds (at least 1).
+        """
+        if not self.recent_hold_seconds or not self.max_concurrency:
+            return 1
+        mean_hold = sum(self.recent_hold_seconds) / len(self.recent_hold_seconds)
+        return max(1, math.ceil(mean_hold * (self.queued + 1) / self.max_concurrency))
+
+    def stats(self) -> dict:
+        """
+        This function returns the metrics of the admission control.
+
+        Returns:
+            dict: The active and waiting requests, the shed requests, and the wait times.
+        """
+        waits = sorted(self.recent_wait_ms)
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self.active,
+            "queue_length": self.queued,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "wait_ms_mean": round(sum(waits) / len(waits), 3) if waits else None,
+            "wait_ms_p95": round(waits[int(0.95 * (len(waits) - 1))], 3) if waits else None,
+            "wait_ms_max": round(self.max_wait_ms, 3),
+        }
+
+    def _admit(self, wait_ms: float) -> AdmissionTicket:
+        self.admitted += 1
+        self.recent_wait_ms.append(wait_ms)
+        self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        return AdmissionTicket(self)
+
+    def _release(self, hold_seconds: float) -> None:
+        # Hand the slot over to the first waiting request that is still waiting, or free it
+        if hold_seconds > 0:
+            self.recent_hold_seconds.append(hold_seconds)
+        while self.waiters:
+            priority, sequence, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
@@ -0,0 +1,234 @@
+"""
+Batchwriter.py file for ProxyGPT. This file contains the background batched database writer for the API.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for timestamps
+import time
+
+# Import the shared storage layer
+from storage import transaction
+
+# Required for the bounded queue drained by the background thread
+import queue
+import threading
+
+# Required for type hints
+from typing import Callable, List, Optional, Tuple, Union
+
+# Required for printing styled log messages
+from utils import *
+
+# Import the writer settings
+from settings import LOG_WRITER_QUEUE_SIZE, LOG_WRITER_BATCH_SIZE, LOG_WRITER_FLUSH_INTERVAL
+
+
+# ------------- [Classes] -------------
+
+# Define the background batched writer
+class BatchWriter:
+    """
+    Takes database writes off the request path. Writes are put on a bounded
+    in-memory queue and a background thread drains it, flushing up to
+    batch_size rows (or whatever arrived within flush_interval seconds) with
+    executemany in one transaction per batch. When the queue is full, rows are
+    dropped and counted instead of blocking the request.
+
+    A row can also be deferred: a function without arguments returning the
+    parameters of the row (or None to skip it), called by the background thread
+    before the transaction. Expensive rows, e.g. logs with large payloads to
+    parse and compress, are then built off the event loop.
+
+    If the writer has not been started (e.g. in a script), writes are executed
+    immediately instead.
+
+    Args:
+        max_queue_size (int): The maximum number of pending writes.
+        batch_size (int): The maximum number of rows flushed in one transaction.
+        flush_interval (float): The maximum seconds a row waits before it is flushed.
+    """
+
+    def __init__(self, max_queue_size: int, batch_size: int, flush_interval: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = None
+        self.stopping = threading.Event()
+
+        # Metrics
+        self.dropped_rows = 0
+        self.written_rows = 0
+        self.failed_rows = 0
+        self.batches = 0
+        self.last_flush_ms = 0.0
+
+        # Optional callback with the seconds and rows of each flush (set by the metrics module)
+        self.flush_observer = None
+
+    def start(self) -> None:
+        """
+        This function starts the background thread draining the queue.
+        """
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name="proxygpt-batch-writer", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """
+        This function stops the background thread after draining every pending write.
+
+        Args:
+            timeout (float): The maximum seconds to wait for the queue to drain.
+        """
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def submit(self, statement: str, params: Union[tuple, Callable[[], Optional[tuple]]]) -> bool:
+        """
+        This function queues one row to be written.
+
+        Args:
+            statement (str): The parameterized SQL statement.
+            params (Union[tuple, Callable]): The parameters of the row, or a function building them.
+
+        Returns:
+            bool: True if the row was queued (or written), False if it was dropped.
+        """
+        return self.submit_many(statement, [params])
+
+    def submit_many(self, statement: str, rows: List[Union[tuple, Callable[[], Optional[tuple]]]]) -> bool:
+        """
+        This function queues several rows of the same statement. They are always
+        written together in the same transaction.
+
+        Args:
+            statement (str): The parameterized SQL statement.
+            rows (List[Union[tuple, Callable]]): The parameters of each row, or functions building them.
+
+        Returns:
+            bool: True if the rows were queued (or written), False if they were dropped.
+        """
+        if not rows:
+            return True
+
+        # Write immediately if the background thread is not running
+        if self.thread is None:
+            self._flush([(statement, list(rows))])
+            return True
+
+        try:
+            self.queue.put_nowait((statement, list(rows)))
+            return True
+        except queue.Full:
+            self.dropped_rows += len(rows)
+            return False
+
+    def stats(self) -> dict:
+        """
+        This function returns the metrics of the writer.
+
+        Returns:
+            dict: The queue depth, and the written, dropped and failed row counts.
+        """
+        return {
+            "running": self.thread is not None,
+            "queue_depth": self.queue.qsize(),
+            "queue_capacity": self.queue.maxsize,
+            "written_rows": self.written_rows,
+            "dropped_rows": self.dropped_rows,
+            "failed_rows": self.failed_rows,
+            "batches": self.batches,
+            "last_flush_ms": self.last_flush_ms,
+        }
+
+    def _run(self) -> None:
+        # Collect a batch until it is full or the flush interval has passed, then write it
+        while True:
+            batch = []
+            rows = 0
+            deadline = time.monotonic() + self.flush_interval
+            while rows < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                rows += len(item[1])
+
+            if batch:
+                self._flush(batch)
+            elif self.stopping.is_set():
+                return
+
+    def _flush(self, batch: List[Tuple[str, list]]) -> None:
+        # Build the deferred rows before taking the write lock
+        build_errors = []
+        for statement, rows in batch:
+            for index, row in enumerate(rows):
+                if callable(row):
+                    try:
+                        rows[index] = row()
+                    except Exception as e:
+                        rows[index] = None
+                        build_errors.append(e)
+        if build_errors:
+            self.failed_rows += len(build_errors)
+            print(red_critical(f'[Critical] Batch writer failed to build {len(build_errors)} rows: {build_errors[0]}'))
+
+        # Group the rows by statement, keeping order, and write them all in one transaction. Inserts join the earlier
+        # rows of their statement, but never across another statement (e.g. a delete of rows queued before it).
+        groups = []
+        latest = {}
+        for statement, rows in batch:
+            rows = [row for row in rows if row is not None]
+            if not rows:
+                continue
+            if statement in latest:
+                latest[statement].extend(rows)
+                continue
+            groups.append((statement, rows))
+            if statement.lstrip().upper().startswith("INSERT"):
+                latest[statement] = rows
+            else:
+                latest = {}
+        count = sum(len(rows) for statement, rows in groups)
+        if not count:
+            return
+
+        start_time = time.time()
+        try:
+            with transaction() as conn:
+                for statement, rows in groups:
+                    conn.executemany(statement, rows)
+            self.written_rows += count
+            self.batches += 1
+        except Exception as e:
+            self.failed_rows += count
+            print(red_critical(f'[Critical] Batch writer failed to write {count} rows: {e}'))
+        self.last_flush_ms = round((time.time()-start_time)*1000, 3)
+        if self.flush_observer is not None:
+            self.flush_observer(time.time()-start_time, count)
+
+
+# ------------- [Initialization: Writer] -------------
+
+# Create the shared writer used by the rate limit and logging code of each worker
+batch_writer = BatchWriter(
+    max_queue_size=LOG_WRITER_QUEUE_SIZE,
+    batch_size=LOG_WRITER_BATCH_SIZE,
+    flush_interval=LOG_WRITER_FLUSH_INTERVAL,
+)
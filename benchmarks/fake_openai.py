@@ -0,0 +1,187 @@
+"""
+Fake_openai.py file for ProxyGPT. This file contains a local fake of the OpenAI API, with configurable latency and errors, to test and benchmark ProxyGPT without calling OpenAI.
+
+Point ProxyGPT at it with OPENAI_API_BASES=http://127.0.0.1:8765/v1 (any OpenAI key starting with sk- is accepted).
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the command line options
+import argparse
+
+# Required for the simulated latency
+import asyncio
+
+# Required for the responses
+import json
+
+# Required for injecting latency and errors at random
+import random
+
+# Required for the fake server
+from aiohttp import web
+
+
+# ------------- [Helper Functions] -------------
+
+# Function for simulating the latency and errors of an upstream call
+async def inject_faults(request: web.Request):
+    """
+    This function waits for the simulated latency of a call, and returns the
+    simulated error response, if any, of the call.
+
+    Args:
+        request (web.Request): The request.
+
+    Returns:
+        Optional[web.Response]: The error response, or None if the call succeeds.
+    """
+    options = request.app["options"]
+    stats = request.app["stats"]
+    stats["requests"] += 1
+
+    latency = options.latency + random.uniform(0, options.jitter)
+    if random.random() < options.slow_rate:
+        latency += options.slow_latency
+    await asyncio.sleep(latency)
+
+    roll = random.random()
+    if roll < options.error_rate:
+        stats["errors"] += 1
+        return web.json_response({"error": {"message": "The server had an error while processing your request.", "type": "server_error"}}, status=500)
+    roll -= options.error_rate
+    if roll < options.rate_limit_rate:
+        stats["rate_limited"] += 1
+        return web.json_response({"error": {"message": "Rate limit reached.", "type": "requests"}}, status=429, headers={"Retry-After": "1", "x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "1s"})
+    roll -= options.rate_limit_rate
+    if roll < options.drop_rate:
+        stats["dropped"] += 1
+        request.transport.close()
+        raise ConnectionResetError("Connection dropped by the fake upstream")
+    return None
+
+# Function for building the usage block of a response
+def get_usage(prompt: str, completion: str) -> dict:
+    """
+    This function returns the usage block of a response, estimating four characters per token.
+
+    Args:
+        prompt (str): The prompt.
+        completion (str): The completion.
+
+    Returns:
+        dict: The prompt, completion and total tokens.
+    """
+    prompt_tokens = len(prompt) // 4 + 1
+    completion_tokens = len(completion) // 4 + 1
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+
+# ------------- [Routes and Endpoints] -------------
+
+# Define the fake chat completion endpoint
+async def chat_completions(request: web.Request) -> web.StreamResponse:
+    payload = await request.json()
+    error = await inject_faults(request)
+    if error is not None:
+        return error
+
+    options = request.app["options"]
+    prompt = "".join(message.get("content") or "" for message in payload.get("messages", []))
+    completion = "lorem ipsum " * options.completion_words
+    completion = completion.strip()
+    model = payload.get("model", "gpt-3.5-turbo")
+
+    if not payload.get("stream"):
+        return web.json_response({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": completion}, "finish_reason": "stop"}],
+            "usage": get_usage(prompt, completion),
+        })
+
+    # Stream the completion one word per chunk
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    words = completion.split(" ")
+    for index, word in enumerate(words):
+        delta = {"content": word if index == 0 else " " + word}
+        if index == 0:
+            delta["role"] = "assistant"
+        chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+        await response.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+        if options.chunk_interval:
+            await asyncio.sleep(options.chunk_interval)
+    chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+    await response.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\ndata: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+# Define the fake embeddings endpoint
+async def embeddings(request: web.Request) -> web.Response:
+    payload = await request.json()
+    error = await inject_faults(request)
+    if error is not None:
+        return error
+
+    inputs = payload.get("input", "")
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    return web.json_response({
+        "object": "list",
+        "data": [{"object": "embedding", "index": index, "embedding": [0.0] * 8} for index in range(len(inputs))],
+        "model": payload.get("model", "text-embedding-ada-002"),
+        "usage": get_usage("".join(str(text) for text in inputs), ""),
+    })
+
+# Define the endpoint returning the counts of the fake server
+async def get_stats(request: web.Request) -> web.Response:
+    return web.json_response(request.app["stats"])
+
+
+# ------------- [Main] -------------
+
+# Function for creating the fake server
+def create_app(options: argparse.Namespace) -> web.Application:
+    """
+    This function creates the fake OpenAI server.
+
+    Args:
+        options (argparse.Namespace): The latency and error options.
+
+    Returns:
+        web.Application: The fake server.
+    """
+    app = web.Application()
+    app["options"] = options
+    app["stats"] = {"requests": 0, "errors": 0, "rate_limited": 0, "dropped": 0}
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1/embeddings", embeddings)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+# Function for parsing the command line options
+def parse_args(args=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fake OpenAI API with configurable latency and errors.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="Base seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra seconds (uniform) before each response")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Fraction of calls with extra tail latency")
+    parser.add_argument("--slow-latency", type=float, default=2.0, help="Extra seconds of the slow calls")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of calls answered with a 429")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="Fraction of calls whose connection is dropped")
+    parser.add_argument("--completion-words", type=int, default=20, help="Words in each completion")
+    parser.add_argument("--chunk-interval", type=float, default=0.0, help="Seconds between streamed chunks")
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    options = parse_args()
+    web.run_app(create_app(options), host=options.host, port=options.port, print=None)
@@ -0,0 +1,300 @@
+"""
+Loadgen.py file for ProxyGPT. This file contains the async load generator of the benchmarks, with fixed concurrency (closed loop) and fixed arrival rate (open loop) modes.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the command line options
+import argparse
+
+# Required for sending requests concurrently
+import asyncio
+
+# Required for the request bodies and the results
+import json
+
+# Required for the exponential arrival times of the open loop
+import random
+
+# Required for timing requests
+import time
+
+# Required for type hints
+from typing import Callable, Dict, List, Optional
+
+# Required for the async HTTP client
+import aiohttp
+
+
+# ------------- [Helper Functions] -------------
+
+# Function for computing a percentile
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """
+    This function returns a percentile (nearest rank) of sorted values.
+
+    Args:
+        values (List[float]): The sorted values.
+        fraction (float): The percentile as a fraction, e.g. 0.99.
+
+    Returns:
+        Optional[float]: The percentile, or None if there are no values.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+# Function for summarizing latencies
+def summarize_latencies(latencies: List[float]) -> Dict[str, Optional[float]]:
+    """
+    This function returns the mean, p50, p95, p99 and max of latencies, in milliseconds.
+
+    Args:
+        latencies (List[float]): The latencies in seconds.
+
+    Returns:
+        Dict[str, Optional[float]]: The summary in milliseconds (None if there are no latencies).
+    """
+    values = sorted(latencies)
+    summary = {"mean": sum(values) / len(values) if values else None, "p50": percentile(values, 0.50), "p95": percentile(values, 0.95), "p99": percentile(values, 0.99), "max": values[-1] if values else None}
+    return {name: round(value * 1000, 3) if value is not None else None for name, value in summary.items()}
+
+# Function for building the body of a ProxyGPT completion request
+def proxy_completion_body(index: int) -> bytes:
+    """
+    This function returns the body of the index-th completion request to
+    ProxyGPT. Every prompt is unique, so requests are neither coalesced nor
+    cached.
+
+    Args:
+        index (int): The index of the request.
+
+    Returns:
+        bytes: The JSON body.
+    """
+    return json.dumps([{"role": "user", "content": f"Benchmark prompt {index}: say hello."}]).encode("utf-8")
+
+# Function for building the body of a direct request to the upstream
+def upstream_completion_body(index: int, stream: bool = False) -> bytes:
+    """
+    This function returns the body of the index-th chat completion request
+    sent directly to the (fake) upstream, matching what ProxyGPT sends.
+
+    Args:
+        index (int): The index of the request.
+        stream (bool): Request a streamed response.
+
+    Returns:
+        bytes: The JSON body.
+    """
+    payload = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": f"Benchmark prompt {index}: say hello."}], "temperature": 0.7}
+    if stream:
+        payload["stream"] = True
+    return json.dumps(payload).encode("utf-8")
+
+
+# ------------- [Classes] -------------
+
+# Define the load generator
+class LoadGenerator:
+    """
+    Sends requests to a url and records their latency (until the whole body
+    has been read), time to first byte and status code.
+
+    Args:
+        url (str): The url of the requests.
+        make_body (Callable[[int], bytes]): The function building the body of the index-th request.
+        headers (dict): The headers of the requests.
+        timeout (float): Seconds before a request is counted as an error.
+    """
+
+    def __init__(self, url: str, make_body: Callable[[int], bytes], headers: dict, timeout: float = 60):
+        self.url = url
+        self.make_body = make_body
+        self.headers = headers
+        self.timeout = timeout
+        self.index = 0
+        self.recording = True
+        self.latencies = []
+        self.first_byte_latencies = []
+        self.status_codes = {}
+        self.errors = 0
+
+    async def send(self, session: aiohttp.ClientSession) -> None:
+        """
+        This function sends one request and records its result.
+
+        Args:
+            session (aiohttp.ClientSession): The client session.
+        """
+        self.index += 1
+        body = self.make_body(self.index)
+        recording = self.recording
+        start_time = time.perf_counter()
+        try:
+            async with session.post(self.url, data=body, headers=self.headers, timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                first_byte_time = None
+                async for _ in response.content.iter_any():
+                    if first_byte_time is None:
+                        first_byte_time = time.perf_counter()
+                status_code = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if recording:
+                self.errors += 1
+            return
+        end_time = time.perf_counter()
+
+        if not recording:
+            return
+        self.status_codes[str(status_code)] = self.status_codes.get(str(status_code), 0) + 1
+        if 200 <= status_code < 300:
+            self.latencies.append(end_time - start_time)
+            self.first_byte_latencies.append((first_byte_time or end_time) - start_time)
+
+    async def run_closed_loop(self, concurrency: int, duration: float, warmup: float = 0) -> dict:
+        """
+        This function keeps concurrency requests in flight for duration
+        seconds, each client sending its next request as soon as the last
+        one finished. Throughput is limited by the latency of the server.
+
+        Args:
+            concurrency (int): The number of concurrent clients.
+            duration (float): Seconds of recorded load.
+            warmup (float): Seconds of unrecorded load before.
+
+        Returns:
+            dict: The summary of the run.
+        """
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            start_time = time.perf_counter()
+            end_time = start_time + warmup + duration
+
+            async def client():
+                while time.perf_counter() < end_time:
+                    await self.send(session)
+
+            self.recording = warmup <= 0
+            clients = [asyncio.ensure_future(client()) for _ in range(concurrency)]
+            if warmup > 0:
+                await asyncio.sleep(warmup)
+                self.recording = True
+            recording_start = time.perf_counter()
+            await asyncio.gather(*clients)
+            return self.summary(time.perf_counter() - recording_start, {"mode": "closed", "concurrency": concurrency})
+
+    async def run_open_loop(self, rate: float, duration: float, warmup: float = 0, max_in_flight: int = 10000) -> dict:
+        """
+        This function starts requests at rate per second on average (Poisson
+        arrivals) for duration seconds, whether or not earlier requests have
+        finished, so latency under a given offered load is measured without
+        coordinated omission. Arrivals beyond max_in_flight outstanding
+        requests are dropped and counted.
+
+        Args:
+            rate (float): The average arrivals per second.
+            duration (float): Seconds of recorded load.
+            warmup (float): Seconds of unrecorded load before.
+            max_in_flight (int): The maximum outstanding requests.
+
+        Returns:
+            dict: The summary of the run.
+        """
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            in_flight = set()
+            dropped = 0
+            self.recording = warmup <= 0
+            start_time = time.perf_counter()
+            recording_start = start_time + warmup
+            end_time = recording_start + duration
+            next_arrival = start_time
+            while next_arrival < end_time:
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if not self.recording and time.perf_counter() >= recording_start:
+                    self.recording = True
+                if len(in_flight) >= max_in_flight:
+                    dropped += self.recording
+                else:
+                    task = asyncio.ensure_future(self.send(session))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+                next_arrival += random.expovariate(rate)
+            if in_flight:
+                await asyncio.gather(*in_flight)
+            return self.summary(time.perf_counter() - recording_start, {"mode": "open", "rate": rate, "dropped_arrivals": dropped})
+
+    def summary(self, elapsed: float, extra: dict) -> dict:
+        """
+        This function returns the summary of the recorded requests.
+
+        Args:
+            elapsed (float): Seconds from the start of recording until the last request finished.
+            extra (dict): Fields of the run to include.
+
+        Returns:
+            dict: The requests, errors, status codes, throughput and latencies (in milliseconds).
+        """
+        requests = sum(self.status_codes.values()) + self.errors
+        return {
+            **extra,
+            "requests": requests,
+            "successful": len(self.latencies),
+            "errors": self.errors,
+            "status_codes": self.status_codes,
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_rps": round(len(self.latencies) / elapsed, 3) if elapsed > 0 else None,
+            "latency_ms": summarize_latencies(self.latencies),
+            "first_byte_ms": summarize_latencies(self.first_byte_latencies),
+        }
+
+
+# ------------- [Main] -------------
+
+# Function for running one load test
+def run_load(url: str, make_body: Callable[[int], bytes], headers: dict, concurrency: Optional[int] = None, rate: Optional[float] = None, duration: float = 10, warmup: float = 0, timeout: float = 60) -> dict:
+    """
+    This function runs one load test, with fixed concurrency or (if rate is
+    given) a fixed arrival rate.
+
+    Args:
+        url (str): The url of the requests.
+        make_body (Callable[[int], bytes]): The function building the body of the index-th request.
+        headers (dict): The headers of the requests.
+        concurrency (Optional[int]): The number of concurrent clients (closed loop).
+        rate (Optional[float]): The average arrivals per second (open loop).
+        duration (float): Seconds of recorded load.
+        warmup (float): Seconds of unrecorded load before.
+        timeout (float): Seconds before a request is counted as an error.
+
+    Returns:
+        dict: The summary of the run.
+    """
+    generator = LoadGenerator(url, make_body, headers, timeout=timeout)
+    if rate is not None:
+        return asyncio.run(generator.run_open_loop(rate, duration, warmup))
+    return asyncio.run(generator.run_closed_loop(concurrency or 1, duration, warmup))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send load to a ProxyGPT completion endpoint (or directly to the upstream) and print the latency summary as JSON.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000/api/openai/completions/gpt3?temperature=0.7")
+    parser.add_argument("--api-key", default=None, help="ProxyGPT API key, sent as a bearer token")
+    parser.add_argument("--upstream", action="store_true", help="Send OpenAI style bodies, to measure the upstream directly")
+    parser.add_argument("--stream", action="store_true", help="Request streamed responses from the upstream (for ProxyGPT, add &stream=true to --url)")
+    parser.add_argument("--concurrency", type=int, default=10, help="Concurrent clients (closed loop)")
+    parser.add_argument("--rate", type=float, default=None, help="Arrivals per second (open loop, overrides --concurrency)")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--warmup", type=float, default=1)
+    parser.add_argument("--timeout", type=float, default=60)
+    options = parser.parse_args()
+
+    headers = {"Content-Type": "application/json"}
+    if options.api_key:
+        headers["Authorization"] = "Bearer " + options.api_key
+    make_body = (lambda index: upstream_completion_body(index, stream=options.stream)) if options.upstream else proxy_completion_body
+    print(json.dumps(run_load(options.url, make_body, headers, concurrency=options.concurrency, rate=options.rate, duration=options.duration, warmup=options.warmup, timeout=options.timeout), indent=2))
@@ -0,0 +1,268 @@
+"""
+Run.py file for ProxyGPT. This file contains the benchmark suite, which runs ProxyGPT (through entrypoint.sh) against the fake OpenAI server and sweeps the worker count, logging and the size of the rate limit table.
+
+Usage (from the repository root): python benchmarks/run.py --workers 1,4 --logging on,off --rate-table-rows 0,100000
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the command line options and the sweep
+import argparse
+import itertools
+
+# Required for the results
+import json
+
+# Required for running the servers
+import os
+import signal
+import subprocess
+import sys
+
+# Required for the platform of the results
+import platform
+
+# Required for prefilling the rate limit table
+import sqlite3
+
+# Required for the temporary databases and logs
+import tempfile
+
+# Required for timestamps and waiting for the servers
+import time
+
+# Required for checking that the servers are ready
+import urllib.error
+import urllib.request
+
+# Import the load generator
+from loadgen import run_load, proxy_completion_body, upstream_completion_body
+
+
+# ------------- [Settings] -------------
+
+# The repository root, where entrypoint.sh and main.py are
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The keys used by the benchmark (the fake upstream accepts any OpenAI key)
+BENCHMARK_API_KEY = "proxygpt-benchmark-key"
+BENCHMARK_OPENAI_API_KEY = "sk-benchmark"
+
+
+# ------------- [Helper Functions] -------------
+
+# Function for parsing a comma separated list of values
+def parse_list(value: str, cast):
+    return [cast(item) for item in value.split(",") if item.strip()]
+
+# Function for parsing on/off values
+def parse_switch(value: str) -> bool:
+    if value not in ("on", "off"):
+        raise argparse.ArgumentTypeError(f'Expected "on" or "off", not "{value}".')
+    return value == "on"
+
+# Function for waiting until a server answers
+def wait_until_ready(url: str, headers: dict, timeout: float = 60) -> None:
+    """
+    This function polls a url until it answers with a 200.
+
+    Args:
+        url (str): The url to poll.
+        headers (dict): The headers of the requests.
+        timeout (float): Seconds before giving up.
+
+    Raises:
+        Exception: If the server does not answer in time.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=2) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.2)
+    raise Exception(f"{url} did not answer within {timeout} seconds.")
+
+# Function for stopping a server and its children
+def stop_process(process: subprocess.Popen) -> None:
+    if process.poll() is not None:
+        return
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+# Function for getting the commit being benchmarked
+def get_git_commit() -> str:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPOSITORY_ROOT, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd=REPOSITORY_ROOT, stderr=subprocess.DEVNULL) != 0
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+# Function for starting the fake OpenAI server
+def start_fake_upstream(options: argparse.Namespace, log_file) -> subprocess.Popen:
+    command = [
+        sys.executable, os.path.join(REPOSITORY_ROOT, "benchmarks", "fake_openai.py"),
+        "--port", str(options.fake_port),
+        "--latency", str(options.latency),
+        "--jitter", str(options.jitter),
+        "--error-rate", str(options.error_rate),
+        "--completion-words", str(options.completion_words),
+        "--chunk-interval", str(options.chunk_interval),
+    ]
+    return subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+
+# Function for creating a database with a prefilled rate limit table
+def prepare_database(path: str, rows: int) -> None:
+    """
+    This function creates a database with the schema of ProxyGPT, and fills
+    api_usage with rows spread over the last day, so they are counted by the
+    daily rate limit.
+
+    Args:
+        path (str): The path of the database.
+        rows (int): The number of api_usage rows.
+    """
+    environment = dict(os.environ, PROXYGPT_DATABASE_PATH=path)
+    subprocess.check_call([sys.executable, "-c", "import storage; storage.migrate()"], cwd=REPOSITORY_ROOT, env=environment, stdout=subprocess.DEVNULL)
+
+    conn = sqlite3.connect(path)
+    now = int(time.time())
+    for start in range(0, rows, 100000):
+        conn.executemany("INSERT INTO api_usage (api_timestamp, key_id) VALUES (?, NULL)", ((now - 86000 + (index * 86000) // rows,) for index in range(start, min(start + 100000, rows))))
+        conn.commit()
+    conn.close()
+
+# Function for starting ProxyGPT through entrypoint.sh
+def start_proxy(options: argparse.Namespace, workers: int, logging_enabled: bool, database_path: str, log_file) -> subprocess.Popen:
+    environment = {name: value for name, value in os.environ.items() if name not in ("OPENAI_API_KEYS", "PROXYGPT_API_KEYS", "PROMETHEUS_MULTIPROC_DIR")}
+    environment.update({
+        "PROXYGPT_WORKERS": str(workers),
+        "PROXYGPT_INSTALLED_MODULES": "graphics,logging" if logging_enabled else "",
+        "PROXYGPT_DATABASE_PATH": database_path,
+        "PROXYGPT_API_KEY": BENCHMARK_API_KEY,
+        "PROXYGPT_HOURLY_RATE_LIMIT": str(10 ** 12),
+        "PROXYGPT_DAILY_RATE_LIMIT": str(10 ** 12),
+        "OPENAI_API_KEY": BENCHMARK_OPENAI_API_KEY,
+        "OPENAI_API_BASES": f"http://127.0.0.1:{options.fake_port}/v1",
+        "GUNICORN_CMD_ARGS": f"--bind 127.0.0.1:{options.proxy_port}",
+    })
+    return subprocess.Popen(["sh", os.path.join(REPOSITORY_ROOT, "entrypoint.sh")], cwd=REPOSITORY_ROOT, env=environment, stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+
+# Function for running every load of the sweep against a url
+def run_loads(options: argparse.Namespace, url: str, make_body, headers: dict) -> list:
+    results = []
+    for concurrency in options.concurrency:
+        results.append(run_load(url, make_body, headers, concurrency=concurrency, duration=options.duration, warmup=options.warmup, timeout=options.timeout))
+    for rate in options.rates:
+        results.append(run_load(url, make_body, headers, rate=rate, duration=options.duration, warmup=options.warmup, timeout=options.timeout))
+    return results
+
+# Function for computing the overhead of the proxy over the upstream
+def get_overhead(result: dict, baseline: dict) -> dict:
+    """
+    This function returns the latency added by ProxyGPT: the difference of
+    each latency percentile to the same load sent directly to the upstream.
+
+    Args:
+        result (dict): The summary of the load through ProxyGPT.
+        baseline (dict): The summary of the same load sent directly to the upstream.
+
+    Returns:
+        dict: The overhead of each percentile in milliseconds.
+    """
+    return {name: round(result["latency_ms"][name] - baseline["latency_ms"][name], 3) if result["latency_ms"][name] is not None and baseline["latency_ms"][name] is not None else None for name in ("mean", "p50", "p95", "p99")}
+
+
+# ------------- [Main] -------------
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark ProxyGPT against a fake OpenAI server and write the results as JSON.")
+    parser.add_argument("--workers", type=lambda value: parse_list(value, int), default=[1, 4], help="Comma separated gunicorn worker counts (PROXYGPT_WORKERS of entrypoint.sh)")
+    parser.add_argument("--logging", type=lambda value: parse_list(value, parse_switch), default=[True, False], help="Comma separated on/off for the logging module")
+    parser.add_argument("--rate-table-rows", type=lambda value: parse_list(value, int), default=[0, 100000], help="Comma separated numbers of api_usage rows to prefill")
+    parser.add_argument("--concurrency", type=lambda value: parse_list(value, int), default=[10, 50], help="Comma separated concurrencies of the closed loop loads")
+    parser.add_argument("--rates", type=lambda value: parse_list(value, float), default=[100.0], help="Comma separated arrival rates (per second) of the open loop loads")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of recorded load per run")
+    parser.add_argument("--warmup", type=float, default=2, help="Seconds of unrecorded load before each run")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds before a request is counted as an error")
+    parser.add_argument("--stream", action="store_true", help="Benchmark streamed completions")
+    parser.add_argument("--latency", type=float, default=0.05, help="Base latency of the fake upstream in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra latency of the fake upstream in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of fake upstream calls answered with a 500")
+    parser.add_argument("--completion-words", type=int, default=20, help="Words in each fake completion")
+    parser.add_argument("--chunk-interval", type=float, default=0.0, help="Seconds between the streamed chunks of the fake upstream")
+    parser.add_argument("--proxy-port", type=int, default=18000)
+    parser.add_argument("--fake-port", type=int, default=18765)
+    parser.add_argument("--output", default=None, help="Path of the JSON results (default benchmarks/results/<commit>-<time>.json)")
+    options = parser.parse_args()
+
+    commit = get_git_commit()
+    output = options.output or os.path.join(REPOSITORY_ROOT, "benchmarks", "results", f"{commit[:12]}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    proxy_url = f"http://127.0.0.1:{options.proxy_port}/api/openai/completions/gpt3?temperature=0.7" + ("&stream=true" if options.stream else "")
+    proxy_headers = {"Content-Type": "application/json", "Authorization": "Bearer " + BENCHMARK_API_KEY}
+    upstream_url = f"http://127.0.0.1:{options.fake_port}/v1/chat/completions"
+    upstream_headers = {"Content-Type": "application/json", "Authorization": "Bearer " + BENCHMARK_OPENAI_API_KEY}
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="proxygpt-benchmark-") as directory:
+        fake_log = open(os.path.join(directory, "fake_openai.log"), "w")
+        fake_upstream = start_fake_upstream(options, fake_log)
+        try:
+            wait_until_ready(f"http://127.0.0.1:{options.fake_port}/stats", {})
+
+            # Measure the same loads directly against the upstream, as the baseline of the overhead
+            print("Running the upstream baseline")
+            baseline = run_loads(options, upstream_url, lambda index: upstream_completion_body(index, stream=options.stream), upstream_headers)
+
+            for run_index, (workers, logging_enabled, rows) in enumerate(itertools.product(options.workers, options.logging, options.rate_table_rows)):
+                print(f"Running workers={workers} logging={'on' if logging_enabled else 'off'} rate_table_rows={rows}")
+                database_path = os.path.join(directory, f"proxygpt-{run_index}.db")
+                prepare_database(database_path, rows)
+                proxy_log = open(os.path.join(directory, f"proxygpt-{run_index}.log"), "w")
+                proxy = start_proxy(options, workers, logging_enabled, database_path, proxy_log)
+                try:
+                    wait_until_ready(f"http://127.0.0.1:{options.proxy_port}/ratelimit", proxy_headers)
+                    for result, baseline_result in zip(run_loads(options, proxy_url, proxy_completion_body, proxy_headers), baseline):
+                        result.update({"workers": workers, "logging": logging_enabled, "rate_table_rows": rows, "overhead_ms": get_overhead(result, baseline_result)})
+                        results.append(result)
+                        print(f"  {result['mode']:6} {result.get('concurrency', result.get('rate')):>8} {result['throughput_rps']:>10} rps  p50 {result['latency_ms']['p50']} ms  p99 {result['latency_ms']['p99']} ms  overhead p50 {result['overhead_ms']['p50']} ms  errors {result['errors']}")
+                except Exception:
+                    proxy_log.flush()
+                    with open(proxy_log.name) as log:
+                        print(log.read()[-4000:])
+                    raise
+                finally:
+                    stop_process(proxy)
+                    proxy_log.close()
+        finally:
+            stop_process(fake_upstream)
+            fake_log.close()
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump({
+            "commit": commit,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "options": vars(options),
+            "upstream_baseline": baseline,
+            "results": results,
+        }, file, indent=2)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+Coalesce.py file for ProxyGPT. This file contains the coalescing of identical in-flight requests for the API.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for sharing one upstream call between waiting requests
+import asyncio
+
+# Required for the lock owner and timestamps
+import os
+import time
+
+# Required for type hints
+from typing import Awaitable, Callable, Optional, Tuple
+
+# Required for running the lock table queries off the event loop
+from fastapi.concurrency import run_in_threadpool
+
+# Import the shared storage layer
+from storage import transaction
+
+# Import the upstream response, which is shared with the waiting requests
+from upstream import UpstreamResponse
+
+# Import the deadline of a request, which bounds how long it waits for another request
+from resilience import Deadline, DeadlineExceeded
+
+
+# ------------- [Classes] -------------
+
+# Define the rejection of a leader
+class LeaderRejected(Exception):
+    """
+    Raised by the call of a leader that is rejected on its own account before
+    calling upstream, e.g. because its API key is over its rate limit. The error
+    is only returned to the leader: the requests waiting for it retry instead,
+    and one of them may lead.
+
+    Args:
+        error (BaseException): The error returned to the leader.
+    """
+
+    def __init__(self, error: BaseException):
+        super().__init__(str(error))
+        self.error = error
+
+# Define the request coalescer
+class RequestCoalescer:
+    """
+    Lets concurrent identical requests share one upstream call ("singleflight").
+    The first request for a key (the leader) makes the call, and every request
+    for the same key that arrives while it is in flight waits for the leader's
+    response instead of calling upstream itself.
+
+    Within a worker the waiting requests share an asyncio future. With
+    across_workers, the leader also takes a lock on the key in the
+    inflight_requests table; leaders in other workers then poll the table for
+    the published response. If the holder of a lock dies, the lock expires after
+    lock_timeout seconds and the next request takes over. A waiting request
+    gives up once its own deadline has passed.
+
+    Args:
+        across_workers (bool): Also coalesce requests of other workers through the database.
+        lock_timeout (float): Seconds a lock is held at most before another worker may take over.
+        poll_interval (float): Seconds between polls for the response of another worker.
+        result_ttl (float): Seconds a published response is kept for workers still polling.
+    """
+
+    def __init__(self, across_workers: bool, lock_timeout: float, poll_interval: float, result_ttl: float):
+        self.across_workers = across_workers
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl
+        self.calls = {}
+
+        # Metrics
+        self.leaders = 0
+        self.coalesced = 0
+        self.coalesced_across_workers = 0
+
+    async def run(self, key: str, call: Callable[[], Awaitable[UpstreamResponse]], deadline: Optional[Deadline] = None) -> Tuple[UpstreamResponse, bool]:
+        """
+        This function returns the upstream response of a request, calling
+        upstream only if no identical request is already in flight.
+
+        Args:
+            key (str): The canonical key of the request.
+            call (Callable): The coroutine function making the upstream call. It raises
+                LeaderRejected for errors that only concern the calling request.
+            deadline (Deadline) (optional): The deadline of the request, which bounds the wait for another request.
+
+        Returns:
+            Tuple[UpstreamResponse, bool]: The response, and True if this request made the upstream call.
+
+        Raises:
+            DeadlineExceeded: If the deadline passed while waiting for another request.
+        """
+        while True:
+            future = self.calls.get(key)
+            if future is None:
+                break
+            try:
+                if deadline is None:
+                    response = await asyncio.shield(future)
+                else:
+                    response = await asyncio.wait_for(asyncio.shield(future), timeout=deadline.remaining())
+                self.coalesced += 1
+                return response, False
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded()
+            except asyncio.CancelledError:
+                # The leader was cancelled (e.g. its client disconnected) or rejected, so retry and possibly lead
+                if not future.cancelled():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        self.calls[key] = future
+        try:
+            response, called = await self._lead(key, call, deadline)
+            future.set_result(response)
+            return response, called
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except LeaderRejected as e:
+            future.cancel()
+            raise e.error
+        except DeadlineExceeded:
+            # Only the deadline of this request passed while polling, so the requests waiting for it retry
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved, in case no request was waiting
+            future.exception()
+            raise
+        finally:
+            del self.calls[key]
+
+    def is_in_flight(self, key: str) -> bool:
+        """
+        This function checks if a request with the key is in flight in this worker.
+
+        Args:
+            key (str): The canonical key of the request.
+
+        Returns:
+            bool: True if a request for the key is waiting for its upstream response.
+        """
+        return key in self.calls
+
+    def stats(self) -> dict:
+        """
+        This function returns the metrics of the coalescer.
+
+        Returns:
+            dict: The number of in-flight keys, upstream calls and coalesced requests.
+        """
+        return {
+            "in_flight": len(self.calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "coalesced_across_workers": self.coalesced_across_workers,
+        }
+
+    async def _lead(self, key: str, call: Callable[[], Awaitable[UpstreamResponse]], deadline: Optional[Deadline]) -> Tuple[UpstreamResponse, bool]:
+        if not self.across_workers:
+            self.leaders += 1
+            return await call(), True
+
+        # Poll until the lock is taken or the response of its holder is published, within the deadline of the request
+        while True:
+            acquired, published = await run_in_threadpool(self._acquire, key)
+            if acquired:
+                break
+            if published is not None:
+                self.coalesced_across_workers += 1
+                return published, False
+            if deadline is None:
+                await asyncio.sleep(self.poll_interval)
+            elif deadline.remaining() > 0:
+                await asyncio.sleep(min(self.poll_interval, deadline.remaining()))
+            else:
+                raise DeadlineExceeded()
+
+        self.leaders += 1
+        try:
+            response = await call()
+        except BaseException:
+            await asyncio.shield(run_in_threadpool(self._release, key))
+            raise
+        await run_in_threadpool(self._publish, key, response)
+        return response, True
+
+    def _acquire(self, key: str) -> Tuple[bool, Optional[UpstreamResponse]]:
+        # Take the lock if it is free or expired, or return the response published by its holder
+        now = time.time()
+        with transaction() as conn:
+            row = conn.execute("SELECT status_code, body, expires_at FROM inflight_requests WHERE request_key = ?", (key,)).fetchone()
+            if row is None or row[2] <= now:
+                conn.execute("INSERT OR REPLACE INTO inflight_requests (request_key, owner, status_code, body, expires_at) VALUES (?, ?, NULL, NULL, ?)", (key, os.getpid(), now + self.lock_timeout))
+                return True, None
+            if row[1] is not None:
+                return False, UpstreamResponse(status_code=row[0], headers={}, body=row[1])
+            return False, None
+
+    def _publish(self, key: str, response: UpstreamResponse) -> None:
+        # Publish the response for the polling workers, and drop expired rows
+        now = time.time()
+        with transaction() as conn:
+            conn.execute("UPDATE inflight_requests SET status_code = ?, body = ?, expires_at = ? WHERE request_key = ? AND owner = ?", (response.status_code, response.content, now + self.result_ttl, key, os.getpid()))
+            conn.execute("DELETE FROM inflight_requests WHERE expires_at <= ?", (now,))
+
+    def _release(self, key: str) -> None:
+        # Release the lock after a failed call, so a polling worker takes over
+        with transaction() as conn:
+            conn.execute("DELETE FROM inflight_requests WHERE request_key = ? AND owner = ? AND body IS NULL", (key, os.getpid()))
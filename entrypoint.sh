@@ -1,3 +1,4 @@
 #!/bin/sh
 
-gunicorn -w 4 -k uvicorn.workers.UvicornWorker main:app
\ No newline at end of file
+# Set PROXYGPT_WORKERS to change the number of gunicorn workers (4 by default)
+exec gunicorn -w ${PROXYGPT_WORKERS:-4} -k uvicorn.workers.UvicornWorker main:app
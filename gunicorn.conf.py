@@ -0,0 +1,41 @@
+"""
+Gunicorn.conf.py file for ProxyGPT. This file contains the gunicorn settings and hooks, loaded automatically by gunicorn (see entrypoint.sh).
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the directory of the metric files
+import os
+import shutil
+
+# Import the settings of the metrics module
+from settings import INSTALLED_MODULES, METRICS_MULTIPROCESS_DIR
+
+
+# ------------- [Metrics] -------------
+
+# Let every worker write its Prometheus metrics to files, so /metrics can aggregate them across workers.
+# Set before the workers are forked, as prometheus_client reads it on import.
+if "metrics" in INSTALLED_MODULES:
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", METRICS_MULTIPROCESS_DIR)
+
+
+# ------------- [Hooks] -------------
+
+# Function for clearing the metric files of the previous run
+def on_starting(server):
+    metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+
+# Function for removing the live gauges of a worker that exited
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
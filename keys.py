@@ -0,0 +1,111 @@
+"""
+Keys.py file for ProxyGPT. This file contains the registry of ProxyGPT API keys and their rate limits.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for hashing keys and comparing them in constant time
+import hashlib
+import hmac
+
+# Required for type hints
+from typing import Dict, List, Optional
+
+
+# ------------- [Helper Functions] -------------
+
+# Function for hashing an API key
+def hash_api_key(api_key: str) -> str:
+    """
+    This function returns the SHA-256 hash of an API key.
+
+    Args:
+        api_key (str): The API key.
+
+    Returns:
+        str: The hex digest of the key.
+    """
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+# Function for getting the fingerprint of an API key
+def get_key_id(api_key: str) -> str:
+    """
+    This function returns the fingerprint of an API key: the first 16 hex
+    characters of its hash. The fingerprint identifies a key in settings.py,
+    the database and /ratelimit without revealing the key itself.
+
+    Args:
+        api_key (str): The API key.
+
+    Returns:
+        str: The fingerprint of the key.
+    """
+    return hash_api_key(api_key)[:16]
+
+
+# ------------- [Classes] -------------
+
+# Define the key registry
+class KeyRegistry:
+    """
+    Registry of the ProxyGPT API keys. Keys are only kept as SHA-256 hashes in
+    a dict indexed by fingerprint, so a lookup is O(1) however many keys there
+    are, and the full hash of the matched key is compared in constant time.
+
+    Each key may have its own rolling window limits (e.g. {"hourly": 100}),
+    configured by fingerprint, on top of the global limits. Keys without their
+    own limits use the default limits.
+
+    Args:
+        api_keys (List[str]): The valid API keys.
+        key_limits (Dict[str, Dict[str, int]]): The limits of specific keys by fingerprint, as {name: limit}.
+        default_limits (Dict[str, Optional[int]]): The limits of every other key, as {name: limit} (None for no limit).
+    """
+
+    def __init__(self, api_keys: List[str], key_limits: Dict[str, Dict[str, int]], default_limits: Dict[str, Optional[int]]):
+        self.hashes = {}
+        for api_key in api_keys:
+            digest = hash_api_key(api_key)
+            self.hashes[digest[:16]] = digest
+
+        # Fingerprints with limits but no matching key (reported by the initialization check)
+        self.unknown_key_ids = sorted(set(key_limits) - set(self.hashes))
+
+        self.default_limits = {name: limit for name, limit in default_limits.items() if limit is not None}
+        self.key_limits = {key_id: {name: limit for name, limit in limits.items() if limit is not None} for key_id, limits in key_limits.items()}
+
+    def authenticate(self, api_key: str) -> Optional[str]:
+        """
+        This function looks up an API key.
+
+        Args:
+            api_key (str): The API key sent by the client.
+
+        Returns:
+            Optional[str]: The fingerprint of the key, or None if the key is not valid.
+        """
+        digest = hash_api_key(api_key)
+        key_id = digest[:16]
+        if not hmac.compare_digest(self.hashes.get(key_id, ""), digest):
+            return None
+        return key_id
+
+    def limits_for(self, key_id: str) -> Dict[str, int]:
+        """
+        This function returns the limits of a key.
+
+        Args:
+            key_id (str): The fingerprint of the key.
+
+        Returns:
+            Dict[str, int]: The limits of the key by name (empty for no limits).
+        """
+        return self.key_limits.get(key_id, self.default_limits)
+
+    def __len__(self) -> int:
+        return len(self.hashes)
@@ -10,10 +10,15 @@ License: MIT
 # ------------- [Import Libraries] -------------
 
 # Required libraries from FastAPI for API functionality
-from fastapi import FastAPI, HTTPException, Depends, Security
+from fastapi import FastAPI, HTTPException, Depends, Security, Query
 from fastapi.security.api_key import APIKeyHeader, APIKey
 from fastapi.security import HTTPBearer
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi import Request
+
+# Required for the app lifespan (startup and shutdown), and the no-op phase timer
+from contextlib import asynccontextmanager, nullcontext
 
 # Required libraries from Pydantic for API functionality
 from pydantic import BaseModel
@@ -25,13 +30,50 @@ import os
 # Required for inspecting code
 import inspect
 
-# Import requests for making API calls
-import requests
+# Import the async upstream client for making API calls
+from upstream import UpstreamClient, UpstreamMember, UpstreamPool, UpstreamUnavailable
+
+# Import the coalescing of identical in-flight requests, and the canonical request key
+from coalesce import RequestCoalescer, LeaderRejected
+from payloads import get_payload_key
+
+# Import the token estimation and token budget
+from tokens import TokenBudget, get_tokenizer, estimate_chat_tokens, find_total_tokens
+
+# Import the admission control of upstream calls
+from admission import AdmissionController, AdmissionRejected
+
+# Import the deadlines, retries, hedging and circuit breaker of upstream calls
+from resilience import Deadline, CircuitBreaker, ResilientCaller, CircuitOpen, DeadlineExceeded, UpstreamFailed
+
+# Required for releasing the admission slot of an abandoned stream
+import weakref
+
+# Required for the live feed of the dashboard
+import asyncio
+import json
 
-# Required for rate limiting with database and timestamps
-import sqlite3
+# Required for rounding up Retry-After
+import math
+
+# Required for rate limiting with timestamps
 import time
 
+# Import the shared storage layer
+import storage
+
+# Import the registry of ProxyGPT API keys
+from keys import KeyRegistry
+
+# Import the rate limit backends
+from ratelimit import MemoryRateLimitBackend, SQLiteRateLimitBackend, RedisRateLimitBackend
+
+# Import the background batched writer
+from batchwriter import batch_writer
+
+# Import the retention compactor
+from retention import RetentionCompactor
+
 # Required for printing styled log messages 
 from utils import *
 
@@ -42,17 +84,32 @@ from utils import *
 from settings import *
 
 # Check if settings are properly imported and set, raise exception if not
-if USE_HOURLY_RATE_LIMIT==None or USE_DAILY_RATE_LIMIT==None or INSECURE_DEBUG==None or INSTALLED_MODULES==None:
+if USE_HOURLY_RATE_LIMIT==None or USE_DAILY_RATE_LIMIT==None or INSECURE_DEBUG==None or INSTALLED_MODULES==None or UPSTREAM_POOL_SIZE==None or UPSTREAM_POOL_SIZE_PER_HOST==None or UPSTREAM_CONNECT_TIMEOUT==None or UPSTREAM_TOTAL_TIMEOUT==None or UPSTREAM_KEEPALIVE_TIMEOUT==None or RATE_LIMIT_BACKEND==None or RATE_LIMIT_BUCKET_SECONDS==None or RATE_LIMIT_SYNC_INTERVAL==None or LOG_WRITER_QUEUE_SIZE==None or LOG_WRITER_BATCH_SIZE==None or LOG_WRITER_FLUSH_INTERVAL==None or DATABASE_PATH==None or RETENTION_INTERVAL==None or RETENTION_BATCH_SIZE==None or RETENTION_VACUUM_PAGES==None or RETENTION_LATENCY_BUCKETS_MS==None or CACHE_MAX_ENTRIES==None or CACHE_MAX_BYTES==None or CACHE_TTL==None or CACHE_PERSISTENT==None or CACHE_PERSISTENT_MAX_ENTRIES==None or CACHE_MAX_TEMPERATURE==None or CACHE_HITS_CONSUME_RATE_LIMIT==None or COALESCE_REQUESTS==None or COALESCE_ACCOUNTING==None or COALESCE_ACROSS_WORKERS==None or COALESCE_LOCK_TIMEOUT==None or COALESCE_POLL_INTERVAL==None or COALESCE_RESULT_TTL==None or PASSTHROUGH_ENDPOINTS==None or PER_KEY_DEFAULT_RATE_LIMITS==None or PER_KEY_RATE_LIMITS==None or USE_TOKEN_BUDGET==None or TOKEN_BUDGET_TOKENIZER==None or TOKEN_BUDGET_COMPLETION_TOKENS==None or ADMISSION_MAX_QUEUE==None or ADMISSION_QUEUE_TIMEOUT==None or ADMISSION_DEFAULT_PRIORITY==None or ADMISSION_KEY_PRIORITIES==None or UPSTREAM_DEFAULT_COOLDOWN==None or RESILIENCE_DEADLINE==None or RESILIENCE_MAX_ATTEMPTS==None or RESILIENCE_BACKOFF_BASE==None or RESILIENCE_BACKOFF_MAX==None or RESILIENCE_HEDGE==None or RESILIENCE_HEDGE_MIN_DELAY==None or RESILIENCE_HEDGE_MIN_SAMPLES==None or RESILIENCE_BREAKER_FAILURES==None or RESILIENCE_BREAKER_RESET==None or DASHBOARD_REFRESH_INTERVAL==None or DASHBOARD_LIVE_FEED==None or DASHBOARD_LIVE_FEED_INTERVAL==None or DASHBOARD_LIVE_FEED_MAX_LOGS==None or BATCH_MAX_SIZE==None or BATCH_MAX_CONCURRENCY==None or SEARCH_INDEX_INTERVAL==None or SEARCH_INDEX_BATCH_SIZE==None or SEARCH_MAX_TEXT_CHARS==None or SEARCH_SNIPPET_TOKENS==None or LOG_SAMPLE_RATES==None or LOG_ERROR_SAMPLE_RATES==None or LOG_PAYLOADS==None:
     raise Exception("One or more of the settings are not set or have been removed. They are required for operation of ProxyGPT, unless the code has been modified.")
 
-# Import the modules
+# Import the modules. The metrics module is imported first, so the code of the other modules can be timed.
+if "metrics" in INSTALLED_MODULES:
+    # Import metrics module
+    from modules.metrics import *
+
+    metrics_installed_bool = True
+else:
+    # Without the metrics module, the phase timers do nothing and cost next to nothing
+    def timed(phase: str):
+        return lambda function: function
+
+    def time_phase(phase: str):
+        return nullcontext()
+
+    metrics_installed_bool = False
+
+
 if "graphics" in INSTALLED_MODULES:
     # Import graphics module
     from modules.graphics import *
 
     from fastapi.templating import Jinja2Templates
     from fastapi.responses import HTMLResponse
-    from fastapi import Request
 
     templates = Jinja2Templates(directory="templates")
 
@@ -65,6 +122,10 @@ if "logging" in INSTALLED_MODULES:
     # Import logging module
     from modules.logging import *
 
+    # Time the log writes on the request path
+    insert_api_log = timed("log_write")(insert_api_log)
+    insert_api_logs = timed("log_write")(insert_api_logs)
+
     # Import time which is needed
     import time
 
@@ -73,15 +134,100 @@ else:
     logging_installed_bool = False
 
 
+if "cache" in INSTALLED_MODULES:
+    # Import cache module
+    from modules.cache import *
+
+    cache_installed_bool = True
+else:
+    cache_installed_bool = False
+
+
+if "search" in INSTALLED_MODULES:
+    # Import search module
+    from modules.search import *
+
+    search_installed_bool = True
+else:
+    search_installed_bool = False
+
+
+# ------------- [Initialization: Upstream] -------------
+
+# Create the upstream client, which holds one shared keep-alive connection pool per worker
+upstream_client = UpstreamClient(
+    pool_size=UPSTREAM_POOL_SIZE,
+    pool_size_per_host=UPSTREAM_POOL_SIZE_PER_HOST,
+    connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+    total_timeout=UPSTREAM_TOTAL_TIMEOUT,
+    keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT,
+)
+
+# Check the accounting policy of coalesced requests
+if COALESCE_ACCOUNTING not in ("per_request", "leader_only"):
+    raise Exception(f'COALESCE_ACCOUNTING in settings.py must be one of "per_request" or "leader_only", not "{COALESCE_ACCOUNTING}".')
+
+# Create the admission controller, which bounds the concurrent upstream calls of each worker
+admission_controller = AdmissionController(
+    max_concurrency=ADMISSION_MAX_CONCURRENCY,
+    max_queue=ADMISSION_MAX_QUEUE,
+    queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+)
+
+# Create the resilient caller, which retries and hedges upstream calls within their deadline behind a circuit breaker
+resilient_caller = ResilientCaller(
+    breaker=CircuitBreaker(failure_threshold=RESILIENCE_BREAKER_FAILURES, reset_timeout=RESILIENCE_BREAKER_RESET),
+    max_attempts=RESILIENCE_MAX_ATTEMPTS,
+    backoff_base=RESILIENCE_BACKOFF_BASE,
+    backoff_max=RESILIENCE_BACKOFF_MAX,
+    hedge_min_delay=RESILIENCE_HEDGE_MIN_DELAY,
+    hedge_min_samples=RESILIENCE_HEDGE_MIN_SAMPLES,
+)
+
+# Create the coalescer, which lets concurrent identical requests share one upstream call
+request_coalescer = RequestCoalescer(
+    across_workers=COALESCE_ACROSS_WORKERS,
+    lock_timeout=COALESCE_LOCK_TIMEOUT,
+    poll_interval=COALESCE_POLL_INTERVAL,
+    result_ttl=COALESCE_RESULT_TTL,
+)
+
+
 # ------------- [Initialization: App] -------------
 
+# Define the app lifespan, which opens and closes shared resources for each worker
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the upstream connection pool inside the worker's event loop
+    await upstream_client.start()
+    # Start the background writer that flushes log rows in batches
+    batch_writer.start()
+    # Start the background compactor that deletes and rolls up expired rows
+    retention_compactor.start()
+    # Start the background indexer that adds new logs to the full-text index
+    if search_installed_bool:
+        search_indexer.start()
+    yield
+    # Close the upstream connection pool on shutdown
+    await upstream_client.close()
+    # Stop the compactor, then drain every pending log row before the worker exits
+    if search_installed_bool:
+        search_indexer.stop()
+    retention_compactor.stop()
+    batch_writer.stop()
+
 # Create FastAPI app
 app = FastAPI(
     title="ProxyGPT",
     description="Lightweight wrapper for OpenAI python library. Add custom hourly and daily rate limits to API usage, and share OpenAI access with your development team without providing your secret key.",
     version="v0.2.0-beta",
+    lifespan=lifespan,
 )
 
+# Count and time every request if metrics installed
+if metrics_installed_bool:
+    app.add_middleware(MetricsMiddleware)
+
 # ------------- [Initialization: Env] -------------
 
 # Set minimum length for secure key
@@ -119,25 +265,44 @@ elif proxygpt_api_keys is not None:
         if len(key) < MIN_LENGTH_FOR_SECURE_KEY:
             initialization_transcript += yellow_warning(f'[Warning] PROXYGPT_API_KEYS environment variable contains a key that is too short to be secure. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
 
-# Set OpenAI API key securely from environment variable
+# Set OpenAI API key securely from environment variable, either singular key or multiple keys for the upstream pool
 openai_api_key = os.getenv("OPENAI_API_KEY")
+openai_api_keys = os.getenv("OPENAI_API_KEYS")
+
+if openai_api_keys is not None:
+    # Get list of keys with comma separated keys
+    openai_api_keys = [key.strip() for key in openai_api_keys.split(",") if key.strip()]
+elif openai_api_key is not None:
+    openai_api_keys = [openai_api_key]
+
+# Set the OpenAI base urls, either one for every key or one per key (comma separated, in the order of the keys)
+openai_api_bases = [base.strip() for base in os.getenv("OPENAI_API_BASES", os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")).split(",") if base.strip()]
 
 if USE_HOURLY_RATE_LIMIT:
     hourly_rate_limit = (os.getenv("PROXYGPT_HOURLY_RATE_LIMIT"))
 if USE_DAILY_RATE_LIMIT:
     daily_rate_limit = (os.getenv("PROXYGPT_DAILY_RATE_LIMIT"))
+if USE_TOKEN_BUDGET:
+    tokens_per_minute = (os.getenv("PROXYGPT_TOKENS_PER_MINUTE"))
 
 # Check if the key is set
-if openai_api_key is None:
+if not openai_api_keys:
     initialization_transcript += red_critical(f'[Critical] OPENAI_API_KEY environment variable is not set. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
     critical_exist = True
+    openai_api_keys = []
 
-# If the key is set, check if it is valid
-elif len(openai_api_key) <5:
-    initialization_transcript += red_critical(f'[Critical] OPENAI_API_KEY environment variable is too short to be a working key. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
-    critical_exist = True
-elif openai_api_key.startswith("sk-")==False:
-    initialization_transcript += red_critical(f'[Critical] OPENAI_API_KEY environment variable is not a valid secret key. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+# If the keys are set, check if they are valid
+for key in openai_api_keys:
+    if len(key) <5:
+        initialization_transcript += red_critical(f'[Critical] OPENAI_API_KEY(S) environment variable contains a key that is too short to be a working key. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+        critical_exist = True
+    elif key.startswith("sk-")==False:
+        initialization_transcript += red_critical(f'[Critical] OPENAI_API_KEY(S) environment variable contains a key that is not a valid secret key. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+        critical_exist = True
+
+# Check if there is one base url for every key, or one per key
+if len(openai_api_bases) not in (1, len(openai_api_keys)):
+    initialization_transcript += red_critical(f'[Critical] OPENAI_API_BASES environment variable must have one base url, or one per key in OPENAI_API_KEYS. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
     critical_exist = True
 
 # Check if the rate limit(s) are set correctly
@@ -161,6 +326,42 @@ if USE_DAILY_RATE_LIMIT:
     else:
         daily_rate_limit = int(daily_rate_limit)
 
+# Check if the token budget is set correctly
+if USE_TOKEN_BUDGET:
+    if tokens_per_minute == None:
+        initialization_transcript += red_critical(f'[Critical] PROXYGPT_TOKENS_PER_MINUTE environment variable is not set. Set USE_TOKEN_BUDGET to False in settings.py if you do not wish to use a token budget. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+        critical_exist = True
+    elif tokens_per_minute.isdigit() == False: # Will return False for floating point numbers
+        initialization_transcript += red_critical(f'[Critical] PROXYGPT_TOKENS_PER_MINUTE environment variable is not a valid integer. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+        critical_exist = True
+    else:
+        tokens_per_minute = int(tokens_per_minute)
+
+# Set the windows (in seconds) of the per-key rate limits
+key_windows = {"hourly": 3600, "daily": 86400}
+for limits in [PER_KEY_DEFAULT_RATE_LIMITS] + list(PER_KEY_RATE_LIMITS.values()):
+    for name in limits:
+        if name not in key_windows:
+            raise Exception(f'Per-key rate limits in settings.py must be "hourly" or "daily", not "{name}".')
+
+# Create the registry of ProxyGPT API keys, which only keeps their hashes
+key_registry = KeyRegistry(
+    api_keys=[proxygpt_api_key] if proxygpt_api_key else (proxygpt_api_keys or []),
+    key_limits=PER_KEY_RATE_LIMITS,
+    default_limits=PER_KEY_DEFAULT_RATE_LIMITS,
+)
+
+# Check if the per-key rate limits match a key
+for key_id in key_registry.unknown_key_ids:
+    initialization_transcript += yellow_warning(f'[Warning] PER_KEY_RATE_LIMITS in settings.py has limits for {key_id}, which is not the fingerprint of any ProxyGPT API key. (Line {inspect.currentframe().f_lineno} in {os.path.basename(__file__)})\n')
+
+# Create the upstream pool, which spreads upstream calls over the OpenAI keys
+upstream_pool = UpstreamPool(
+    members=[UpstreamMember(api_key=key, base_url=openai_api_bases[index] if len(openai_api_bases) > 1 else openai_api_bases[0]) for index, key in enumerate(openai_api_keys) if len(openai_api_bases) in (1, len(openai_api_keys))],
+    capacity=UPSTREAM_MEMBER_CAPACITY,
+    default_cooldown=UPSTREAM_DEFAULT_COOLDOWN,
+)
+
 # Print results of initialization check
 print("Initialization check:")
 print(initialization_transcript)    
@@ -172,56 +373,268 @@ else:
 
 # ------------- [Initialization: DB] -------------
 
-# Check if database is needed for rate limiting
-if USE_HOURLY_RATE_LIMIT or USE_DAILY_RATE_LIMIT:
-    # Use SQLITE database to store API usage
-    # Create a table for API usage if it does not exist
-    conn = sqlite3.connect('proxygpt.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS api_usage
-                    (api_timestamp integer)''')
-    conn.commit()
-    conn.close()
+# Create or migrate the database schema (tables, indexes) and switch it to WAL mode
+storage.migrate()
+
+# Create the full-text index of the API logs (after the migration, which creates api_logs)
+if search_installed_bool:
+    create_search_index()
+
+# Set the windows (in seconds) and limits enforced by the rate limit backend
+rate_limits = {}
+if USE_HOURLY_RATE_LIMIT and isinstance(hourly_rate_limit, int):
+    rate_limits["hourly"] = (3600, hourly_rate_limit)
+if USE_DAILY_RATE_LIMIT and isinstance(daily_rate_limit, int):
+    rate_limits["daily"] = (86400, daily_rate_limit)
+
+# Create the rate limit backend selected in settings.py
+if RATE_LIMIT_BACKEND == "memory":
+    rate_limit_backend = MemoryRateLimitBackend(
+        limits=rate_limits,
+        key_windows=key_windows,
+        bucket_seconds=RATE_LIMIT_BUCKET_SECONDS,
+        sync_interval=RATE_LIMIT_SYNC_INTERVAL,
+        writer=batch_writer,
+    )
+elif RATE_LIMIT_BACKEND == "redis":
+    rate_limit_backend = RedisRateLimitBackend(
+        limits=rate_limits,
+        redis_url=os.getenv("PROXYGPT_REDIS_URL", "redis://localhost:6379/0"),
+        key=RATE_LIMIT_REDIS_KEY,
+        key_windows=key_windows,
+    )
+elif RATE_LIMIT_BACKEND == "sqlite":
+    rate_limit_backend = SQLiteRateLimitBackend(
+        limits=rate_limits,
+        key_windows=key_windows,
+    )
+else:
+    raise Exception(f'RATE_LIMIT_BACKEND in settings.py must be one of "memory", "sqlite" or "redis", not "{RATE_LIMIT_BACKEND}".')
+
+# Prepare the rate limit backend (e.g. rebuild in-memory counters)
+rate_limit_backend.load()
+
+# Create the token budget, which rejects requests locally before they would exceed OpenAI's tokens per minute
+if USE_TOKEN_BUDGET and isinstance(tokens_per_minute, int):
+    token_budget = TokenBudget(tokens_per_window=tokens_per_minute, window_seconds=60)
+    tokenizer = get_tokenizer(TOKEN_BUDGET_TOKENIZER)
+else:
+    token_budget = None
+
+# Create the retention compactor, which keeps api_usage and api_logs bounded
+retention_compactor = RetentionCompactor(
+    usage_ttl=RETENTION_API_USAGE_TTL,
+    logs_ttl=RETENTION_API_LOGS_TTL,
+    interval=RETENTION_INTERVAL,
+    batch_size=RETENTION_BATCH_SIZE,
+    vacuum_pages=RETENTION_VACUUM_PAGES,
+    latency_buckets=RETENTION_LATENCY_BUCKETS_MS,
+)
 
 
 # ------------- [Helper Functions] -------------
 
 # Make function for adding API usage
-def log_api_usage() -> None:
+def log_api_usage(key_id: str = None, amount: int = 1) -> bool:
+    """
+    This function atomically reserves instances of API usage with the rate
+    limit backend. The usage is only logged if no rate limit (global, or of
+    the API key) would be exceeded, so concurrent requests in any worker can
+    never overshoot the limits. It only logs the instances if a rate limit is
+    enabled.
+
+    Args:
+        key_id (str) (optional): The fingerprint of the API key making the call.
+        amount (int): The number of calls to reserve, all or none.
+
+    Returns:
+        bool: True if the usage was logged, False if a rate limit would be exceeded.
+    """
+    key_limits = key_registry.limits_for(key_id) if key_id is not None else {}
+    if USE_HOURLY_RATE_LIMIT or USE_DAILY_RATE_LIMIT or key_limits:
+        return rate_limit_backend.reserve(key_id=key_id, key_limits=key_limits, amount=amount)
+    return True
+
+# Make function for reserving API usage or rejecting the request
+@timed("rate_limit")
+def reserve_api_usage(key_id: str = None, amount: int = 1) -> None:
+    """
+    This function atomically reserves instances of API usage, and raises a
+    429 error with a Retry-After header if a rate limit would be exceeded.
+
+    Args:
+        key_id (str) (optional): The fingerprint of the API key making the call.
+        amount (int): The number of calls to reserve, all or none (e.g. the items of a batch).
+    """
+    if log_api_usage(key_id, amount) == False:
+        key_limits = key_registry.limits_for(key_id) if key_id is not None else {}
+        retry_after = rate_limit_backend.retry_after(key_id=key_id, key_limits=key_limits, amount=amount)
+        raise HTTPException(status_code=429, detail="Rate limit reached. Try again later. See /ratelimit to view status and settings.", headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+# Make function for giving back API usage that was never sent upstream
+def release_api_usage(key_id: str = None, amount: int = 1) -> None:
     """
-    This function logs an instance of API usage to the SQLite database.
-    It only logs the instance if the rate limit is enabled.
+    This function gives back instances of API usage reserved by
+    reserve_api_usage for calls that never reached upstream (e.g. the requests
+    of a batch shed by admission or rejected by the token budget).
+
+    Args:
+        key_id (str) (optional): The fingerprint of the API key that reserved the calls.
+        amount (int): The number of calls to give back.
+    """
+    key_limits = key_registry.limits_for(key_id) if key_id is not None else {}
+    if USE_HOURLY_RATE_LIMIT or USE_DAILY_RATE_LIMIT or key_limits:
+        rate_limit_backend.release(key_id=key_id, amount=amount)
+
+# Make function for setting the deadline of a request
+def get_deadline(request: Request) -> Deadline:
+    """
+    This function returns the deadline of a request: RESILIENCE_DEADLINE
+    seconds from now, or sooner if the client sent a shorter timeout in the
+    X-ProxyGPT-Timeout header.
+
+    Args:
+        request (Request): The request.
+
+    Returns:
+        Deadline: The deadline of the request.
     """
-    if USE_HOURLY_RATE_LIMIT or USE_DAILY_RATE_LIMIT:
-        with sqlite3.connect('proxygpt.db') as conn:
-            c = conn.cursor()
-            c.execute("INSERT INTO api_usage VALUES (?)", (int(time.time()),))
-            conn.commit()
+    timeout = request.headers.get("x-proxygpt-timeout")
+    if timeout is None:
+        return Deadline(RESILIENCE_DEADLINE)
+    try:
+        timeout = float(timeout)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="X-ProxyGPT-Timeout must be a number of seconds.")
+    if not timeout > 0:
+        raise HTTPException(status_code=400, detail="X-ProxyGPT-Timeout must be a number of seconds.")
+    return Deadline(min(timeout, RESILIENCE_DEADLINE))
+
+# Make function for admitting a request to call upstream or shedding it
+@timed("admission")
+async def admit_request(key_id: str, deadline: Deadline = None):
+    """
+    This function waits for an upstream slot of this worker, with the priority
+    of the API key, and raises a 503 error with a Retry-After header if the
+    request is shed (the wait queue is full or the wait deadline passed).
+    Requests are admitted before their rate limit is reserved, so shed requests
+    are not counted.
+
+    Args:
+        key_id (str): The fingerprint of the API key making the call.
+        deadline (Deadline) (optional): The deadline of the request, which also bounds the wait.
+
+    Returns:
+        AdmissionTicket: The slot of the request, to release once the upstream call has finished.
+    """
+    try:
+        return await admission_controller.acquire(ADMISSION_KEY_PRIORITIES.get(key_id, ADMISSION_DEFAULT_PRIORITY), timeout=deadline.remaining() if deadline is not None else None)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=503, detail="Server is overloaded. Try again later.", headers={"Retry-After": str(e.retry_after)})
+
+# Make function for calling upstream with retries, hedging and the circuit breaker
+@timed("upstream")
+async def call_upstream_resiliently(attempt, deadline: Deadline, hedge: bool = False):
+    """
+    This function makes an upstream call through the resilient caller, and
+    turns its failures into errors for the client: a 429 if every OpenAI key is
+    rate limited, a 503 if they are at capacity or the circuit breaker is open
+    (both with a Retry-After header), a 502 if OpenAI could not be reached, and
+    a 504 if the deadline passed.
+
+    Args:
+        attempt: The coroutine function making one attempt (picking its own member of the upstream pool).
+        deadline (Deadline): The deadline of the request.
+        hedge (bool): Send a hedged attempt if the first one is slow.
+
+    Returns:
+        The upstream response of the last attempt.
+    """
+    try:
+        return await resilient_caller.call(attempt, deadline, hedge=hedge)
+    except UpstreamUnavailable as e:
+        if e.status_code == 429:
+            raise HTTPException(status_code=429, detail="Every OpenAI key is rate limited. Try again later. See /ratelimit to view status and settings.", headers={"Retry-After": str(e.retry_after)})
+        raise HTTPException(status_code=503, detail="Server is overloaded. Try again later.", headers={"Retry-After": str(e.retry_after)})
+    except CircuitOpen as e:
+        raise HTTPException(status_code=503, detail="OpenAI is unavailable. Try again later.", headers={"Retry-After": str(e.retry_after)})
+    except UpstreamFailed as e:
+        raise HTTPException(status_code=502, detail="Could not reach OpenAI: " + str(e) if INSECURE_DEBUG else "Could not reach OpenAI.")
+    except DeadlineExceeded:
+        raise HTTPException(status_code=504, detail="OpenAI did not respond before the deadline.")
+
+# Make function for reserving tokens from the token budget or rejecting the request
+@timed("token_budget")
+def reserve_tokens(messages: List[dict] = None, body: bytes = None):
+    """
+    This function reserves the estimated tokens of a request from the token
+    budget, and raises a 429 error with a Retry-After header if the budget
+    has no room for them. The prompt tokens are counted with the tokenizer for
+    messages, and estimated from the size of a raw body otherwise, plus
+    TOKEN_BUDGET_COMPLETION_TOKENS for the completion. Tokens are reserved
+    before the rate limit, so requests rejected by the token budget are not
+    counted.
+
+    Args:
+        messages (List[dict]) (optional): The messages of a chat completion.
+        body (bytes) (optional): The raw body of a passthrough request.
+
+    Returns:
+        The reservation to reconcile once the response arrives, or None if the token budget is disabled.
+    """
+    if token_budget is None:
+        return None
+    if messages is not None:
+        estimated_tokens = estimate_chat_tokens(messages, tokenizer)
+    else:
+        estimated_tokens = len(body or b"") // 4
+    reservation, retry_after = token_budget.reserve(estimated_tokens + TOKEN_BUDGET_COMPLETION_TOKENS)
+    if reservation is None:
+        raise HTTPException(status_code=429, detail="Token budget reached. Try again later. See /ratelimit to view status and settings.", headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+    return reservation
+
+# Make function for reconciling reserved tokens with the actual usage
+def reconcile_tokens(reservation, status_code: int, body: bytes) -> None:
+    """
+    This function corrects a token reservation to the total tokens in the
+    usage block of the response. Failed requests without usage are counted as
+    zero tokens, and successful ones without usage keep the estimate.
+
+    Args:
+        reservation: The reservation returned by reserve_tokens.
+        status_code (int): The status code of the response.
+        body (bytes): The raw response body.
+    """
+    if reservation is None:
+        return
+    total_tokens = find_total_tokens(body)
+    if total_tokens is None:
+        if status_code < 400:
+            return
+        total_tokens = 0
+    token_budget.reconcile(reservation, total_tokens)
 
 # Make function for getting API usage (hourly)
-def get_api_usage_from_last_hour() -> int:
+def get_api_usage_from_last_hour(key_id: str = None) -> int:
     """
-    This function returns the number of API calls to OpenAI in the last hour.
+    This function returns the number of API calls to OpenAI in the last hour,
+    in total or of one API key.
     """
-    with sqlite3.connect('proxygpt.db') as conn:
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM api_usage WHERE api_timestamp > ?", (int(time.time())-3600,))
-        return c.fetchone()[0]
+    return rate_limit_backend.usage("hourly", key_id=key_id)
 
 # Make function for getting API usage (daily)
-def get_api_usage_from_last_day() -> int:
+def get_api_usage_from_last_day(key_id: str = None) -> int:
     """
-    This function returns the number of API calls to OpenAI in the last day.
+    This function returns the number of API calls to OpenAI in the last day,
+    in total or of one API key.
     """
-    with sqlite3.connect('proxygpt.db') as conn:
-        c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM api_usage WHERE api_timestamp > ?", (int(time.time())-86400,))
-        return c.fetchone()[0]
+    return rate_limit_backend.usage("daily", key_id=key_id)
 
 # Make function for checking rate limit
 def check_rate_limit() -> bool:
     """
-    This function checks if the rate limit has been reached.
+    This function checks if the rate limit has been reached, without
+    reserving a call. Use log_api_usage to check and count a call atomically.
 
     Note that both hourly and daily rate limits can simultaneously be 
     in effect.
@@ -229,12 +642,66 @@ def check_rate_limit() -> bool:
     Returns:
         bool: True if rate limit has not been reached, False otherwise.
     """
-    if USE_HOURLY_RATE_LIMIT and get_api_usage_from_last_hour() >= hourly_rate_limit:
-        return False
-    if USE_DAILY_RATE_LIMIT and get_api_usage_from_last_day() >= daily_rate_limit:
-        return False
-    else:
-        return True
+    return rate_limit_backend.check()
+
+# Make function for answering dashboard data requests with an ETag
+def get_dashboard_response(request: Request, get_content) -> Response:
+    """
+    This function answers a dashboard data request. Its ETag is made from the
+    smallest and largest API log ids, which change whenever logs are written
+    or deleted, so a request with a matching If-None-Match gets a 304 without
+    the logs being read. The largest id is sent in X-ProxyGPT-Cursor, to be
+    passed as since on the next refresh.
+
+    Args:
+        request (Request): The request.
+        get_content (Callable): The function returning the content of the response.
+
+    Returns:
+        Response: The JSON response, or an empty 304 if nothing changed.
+    """
+    first_id, last_id = get_api_log_ids()
+    headers = {"ETag": f'"{first_id}-{last_id}"', "X-ProxyGPT-Cursor": str(last_id), "Cache-Control": "private, no-cache"}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip()[2:] if tag.strip().startswith("W/") else tag.strip() for tag in if_none_match.split(",")]
+        if "*" in tags or headers["ETag"] in tags:
+            return Response(status_code=304, headers=headers)
+
+    return JSONResponse(status_code=200, content=get_content(), headers=headers)
+
+# Make function for streaming new API logs to the dashboard
+async def stream_dashboard_updates(since: int = None):
+    """
+    This function yields the Server-Sent Events of the dashboard live feed.
+    Every DASHBOARD_LIVE_FEED_INTERVAL seconds it looks up the largest API log
+    id, and only reads the logs when it has changed. Otherwise a comment is
+    sent, so closed connections are noticed.
+
+    Args:
+        since (int) (optional): The cursor after which logs are sent (by default the current largest id).
+
+    Yields:
+        str: A "cursor" event with the starting cursor, then "logs" events with
+            the previous and new cursor, and the new logs (newest first, at most
+            DASHBOARD_LIVE_FEED_MAX_LOGS, with truncated set if some were left out).
+    """
+    cursor = since if since is not None else (await run_in_threadpool(get_api_log_ids))[1]
+    yield "event: cursor\ndata: " + json.dumps({"cursor": cursor}) + "\n\n"
+
+    while True:
+        await asyncio.sleep(DASHBOARD_LIVE_FEED_INTERVAL)
+        last_id = (await run_in_threadpool(get_api_log_ids))[1]
+        if last_id <= cursor:
+            yield ": keepalive\n\n"
+            continue
+
+        logs = transform_api_logs(await run_in_threadpool(get_api_logs, since=cursor, last_n=DASHBOARD_LIVE_FEED_MAX_LOGS))
+        logs.reverse()
+        previous_cursor = cursor
+        cursor = max([last_id] + [log["id"] for log in logs])
+        yield "event: logs\ndata: " + json.dumps({"since": previous_cursor, "cursor": cursor, "logs": logs, "truncated": len(logs) == DASHBOARD_LIVE_FEED_MAX_LOGS}) + "\n\n"
 
 
 # ------------- [Classes and Other] -------------
@@ -244,99 +711,571 @@ class ChatMessage(BaseModel):
     role: str
     content: str
 
+# Define a model of one chat request of a batch
+class BatchCompletionItem(BaseModel):
+    message: List[ChatMessage]
+    temperature: float
+
+# Define a model of a batch of chat requests
+class BatchCompletionRequest(BaseModel):
+    requests: List[BatchCompletionItem]
+
 # Define a security scheme for API key
 bearer_scheme = HTTPBearer()
 
 # Define validation function for API key
-def valid_api_key(api_key_header: APIKey = Depends(bearer_scheme)):
-
-    if proxygpt_api_key:
-        # Check if API key is valid
-        if api_key_header.credentials != proxygpt_api_key:
-            raise HTTPException(
-                status_code=400, detail="Invalid API key"
-            )
-        return api_key_header.credentials
-    else:
-        # Check if API key is valid
-        if api_key_header.credentials not in proxygpt_api_keys:
-            raise HTTPException(
-                status_code=400, detail="Invalid API key"
-            )
-        return api_key_header.credentials
+@timed("auth")
+def valid_api_key(request: Request, api_key_header: APIKey = Depends(bearer_scheme)):
+
+    # Check if API key is valid, with a constant-time lookup of its hash
+    key_id = key_registry.authenticate(api_key_header.credentials)
+    if key_id is None:
+        raise HTTPException(
+            status_code=400, detail="Invalid API key"
+        )
+
+    # Keep the fingerprint on the request (e.g. for the per-key metrics)
+    request.state.key_id = key_id
+
+    # Return the fingerprint of the key, which identifies it for per-key rate limits
+    return key_id
 
 # Define validation function for API key with rate limit
-def valid_api_key_rate_limit(api_key_header: APIKey = Depends(bearer_scheme)):
-    # Check if rate limit has been reached
-    if check_rate_limit() == False:
-        raise HTTPException(status_code=429, detail="Rate limit reached. Try again later. See /ratelimit to view status and settings.")
-
-    if proxygpt_api_key:
-        # Check if API key is valid
-        if api_key_header.credentials != proxygpt_api_key:
-            raise HTTPException(
-                status_code=400, detail="Invalid API key"
-            )
-        return api_key_header.credentials
-    else:
-        # Check if API key is valid
-        if api_key_header.credentials not in proxygpt_api_keys:
-            raise HTTPException(
-                status_code=400, detail="Invalid API key"
-            )
-        return api_key_header.credentials
+def valid_api_key_rate_limit(api_key: str = Depends(valid_api_key)):
+    # Atomically check the rate limit and log the API usage, only once the API key is known to be valid.
+    # Note, you could move this to the end of the endpoint and check the response content if you want to log only successful requests.
+    reserve_api_usage(api_key)
+
+    return api_key
+
+# Define validation function for the path of the raw passthrough route
+def valid_passthrough_path(path: str):
+    # Checked before the rate limit, so requests to disabled endpoints do not use up the limit
+    if path not in PASSTHROUGH_ENDPOINTS:
+        raise HTTPException(status_code=404, detail="This endpoint is not enabled. See PASSTHROUGH_ENDPOINTS in settings.py.")
+
+    return path
 
 # ------------- [Routes and Endpoints] -------------
 
 @app.post('/api/openai/completions/gpt3')
-async def get_openai_gpt3_completion(message: List[ChatMessage], temperature: float, api_key: str = Depends(valid_api_key_rate_limit)):
+async def get_openai_gpt3_completion(request: Request, message: List[ChatMessage], temperature: float, stream: bool = False, api_key: str = Depends(valid_api_key)):
     """
     This endpoint allows you to interact with OpenAI's GPT-3 model for Chat Completion.
 
     - **message**: A list of message objects. Each object should have a "role" (which can be "system", "user", or "assistant") and a "content" (which is the actual content of the message).
     - **temperature**: The temperature to use for the model's response.
+    - **stream**: If true, the response is relayed as Server-Sent-Events chunks as soon as they arrive from OpenAI.
+
+    If the cache module is installed, identical deterministic requests (temperature at most CACHE_MAX_TEMPERATURE) are served from the response cache. Send "Cache-Control: no-cache" to refresh the cached response, or "X-ProxyGPT-Cache: bypass" (or "Cache-Control: no-store") to skip the cache.
+
+    Send "X-ProxyGPT-Timeout: <seconds>" to shorten the deadline of the request (RESILIENCE_DEADLINE). Failed upstream calls are retried within the deadline.
 
     The endpoint will return a string containing the model's response.
     """
 
+    endpoint = "/chat/completions"
+    url = upstream_pool.members[0].base_url + endpoint if upstream_pool.members else None
+    deadline = get_deadline(request)
+    payload = { "model": "gpt-3.5-turbo", "messages": [{"role": msg.role, "content": msg.content} for msg in message], "temperature": temperature }
+
+    # Serve the response from the cache if installed, before reserving rate limit
+    cache_key = None
+    if cache_installed_bool and not stream:
+        cache_mode = get_cache_mode(request.headers)
+        if cache_mode == "bypass" or not response_cache.is_cacheable(payload):
+            response_cache.record_bypass()
+        else:
+            cache_key = get_cache_key(payload)
+            if cache_mode == "use":
+                # The persistent tier is read from SQLite, so keep it off the event loop
+                if response_cache.persistent:
+                    cached_body = await run_in_threadpool(response_cache.get, cache_key)
+                else:
+                    cached_body = response_cache.get(cache_key)
+                if cached_body is not None:
+                    if CACHE_HITS_CONSUME_RATE_LIMIT:
+                        await run_in_threadpool(reserve_api_usage, api_key)
+                    return Response(status_code=200, content=b'{"message":' + cached_body + b'}', media_type="application/json", headers={"X-ProxyGPT-Cache": "HIT"})
+
+    # Coalesce the request with identical in-flight requests if enabled
+    coalesce_key = None
+    if COALESCE_REQUESTS and not stream and (COALESCE_MAX_TEMPERATURE is None or temperature <= COALESCE_MAX_TEMPERATURE):
+        coalesce_key = get_payload_key(payload)
+
+    # Wait for an upstream slot. Requests joining an identical in-flight request do not call upstream, so they skip the
+    # wait here, and only take a slot in call_upstream if they end up leading (when their leader was cancelled).
+    admission_ticket = None
+    token_reservation = None
+    leading = coalesce_key is None or not request_coalescer.is_in_flight(coalesce_key)
+    if leading:
+        admission_ticket = await admit_request(api_key, deadline)
+
     try:
-        # Log API usage. Note, you could move this to the end of the endpoint and check the response content if you want to log only successful requests.
-        log_api_usage()
+        # Reserve the estimated tokens before the rate limit, so requests rejected by the token budget are not counted.
+        # Like the upstream slot, requests joining an identical in-flight request only reserve them if they end up leading.
+        if leading:
+            token_reservation = reserve_tokens(messages=payload["messages"])
+
+        # Atomically check the rate limit and log the API usage, only once the API key is known to be valid.
+        # With "leader_only" accounting, coalesced requests only reserve when they call upstream.
+        if coalesce_key is None or COALESCE_ACCOUNTING == "per_request":
+            await run_in_threadpool(reserve_api_usage, api_key)
 
         # Log time if logging installed.
         if logging_installed_bool:
             start_time = time.time()
 
-        # Send request to OpenAI
-        url = "https://api.openai.com/v1/chat/completions"
-        payload = { "model": "gpt-3.5-turbo", "messages": [{"role": msg.role, "content": msg.content} for msg in message], "temperature": temperature }
-
+        # Send request to OpenAI, with the Authorization of the upstream member added per call
         headers = {
             "content-type": "application/json",
-            "Authorization": "Bearer " + str(openai_api_key)
         }
 
-        # Send the request
-        response = requests.post(url, json=payload, headers=headers)
+        # Relay the response as a stream if requested
+        if stream:
+            payload["stream"] = True
+            # The relay releases the slot and reconciles the tokens once the stream has finished
+            stream_ticket, admission_ticket = admission_ticket, None
+            stream_tokens, token_reservation = token_reservation, None
+            return await stream_openai_completion(endpoint=endpoint, payload=payload, headers=headers, deadline=deadline, start_time=start_time if logging_installed_bool else None, admission_ticket=stream_ticket, token_reservation=stream_tokens)
+
+        # Send one attempt through the shared connection pool without blocking the event loop, to the least busy OpenAI key
+        async def attempt_upstream():
+            nonlocal url
+            member = upstream_pool.acquire()
+            url = member.base_url + endpoint
+            try:
+                response = await upstream_client.post(url, json=payload, headers=upstream_pool.headers(member, headers))
+            except BaseException:
+                upstream_pool.release(member)
+                raise
+            upstream_pool.release(member, response.status_code, response.headers)
+            return response
+
+        # Call upstream with retries (and hedging if enabled) within the deadline
+        async def call_upstream():
+            nonlocal admission_ticket, token_reservation
+            try:
+                if admission_ticket is None:
+                    admission_ticket = await admit_request(api_key, deadline)
+                if token_reservation is None:
+                    token_reservation = reserve_tokens(messages=payload["messages"])
+                if coalesce_key is not None and COALESCE_ACCOUNTING == "leader_only":
+                    await run_in_threadpool(reserve_api_usage, api_key)
+            except HTTPException as e:
+                # Shedding and limits are checked for the request leading, so they are not shared with coalesced requests
+                raise LeaderRejected(e) if coalesce_key is not None else e
+            response = await call_upstream_resiliently(attempt_upstream, deadline, hedge=RESILIENCE_HEDGE)
+            reconcile_tokens(token_reservation, response.status_code, response.content)
+            token_reservation = None
+            return response
+
+        if coalesce_key is not None:
+            try:
+                response, called_upstream = await request_coalescer.run(coalesce_key, call_upstream, deadline)
+            except DeadlineExceeded:
+                raise HTTPException(status_code=504, detail="OpenAI did not respond before the deadline.")
+        else:
+            response = await call_upstream()
+            called_upstream = True
         
+        # Log API results if logging installed. With "leader_only" accounting, coalesced requests are not logged.
+        if logging_installed_bool and (called_upstream or COALESCE_ACCOUNTING == "per_request"):
+            insert_api_log(response_time=round((time.time()-start_time)*1000),response_code=response.status_code,endpoint=url,request=payload,response_str=response.content)
+
+        # Only successful responses are cached
+        if cache_key is not None and response.status_code == 200 and called_upstream:
+            response_cache.set(cache_key, response.content)
+
+        # Parse the upstream response and serialize the response to the client
+        with time_phase("serialization"):
+            return JSONResponse(status_code=200, content={"message": response.json()}, headers={"X-ProxyGPT-Cache": "MISS"} if cache_key is not None else None)
+    except HTTPException:
+        # Rate limit, token budget and upstream errors are returned as is
+        raise
+    except Exception as e:
+        if INSECURE_DEBUG:
+            return JSONResponse(status_code=500, content={"error": str(e)})
+        else:
+            print(e)
+            return JSONResponse(status_code=500, content={"error": "Internal server error. Set INSECURE_DEBUG to True to view error details from client side."})
+    finally:
+        if admission_ticket is not None:
+            admission_ticket.release()
+        # Give back the tokens of requests that did not call upstream (e.g. rate limited or coalesced)
+        if token_reservation is not None:
+            reconcile_tokens(token_reservation, 500, b"")
+
+
+# Make function for relaying a streamed completion
+async def stream_openai_completion(endpoint: str, payload: dict, headers: dict, deadline: Deadline, start_time: float = None, admission_ticket = None, token_reservation = None):
+    """
+    This function opens a streaming request to OpenAI and relays the
+    Server-Sent-Events chunks to the client as they arrive. Opening the stream
+    is retried within the deadline, but once it is open it is only bounded by
+    UPSTREAM_TOTAL_TIMEOUT per read. Once the stream finishes (or the client
+    disconnects), the assembled response is logged.
+
+    Args:
+        endpoint (str): The upstream endpoint, relative to the base url of the upstream member.
+        payload (dict): The JSON payload of the request.
+        headers (dict): The headers of the request, without Authorization.
+        deadline (Deadline): The deadline of the request, for opening the stream.
+        start_time (float) (optional): The start time of the request, if logging is installed.
+        admission_ticket (AdmissionTicket) (optional): The upstream slot, released once the stream has finished.
+        token_reservation (optional): The tokens reserved for the request, reconciled once the stream has finished.
+
+    Returns:
+        StreamingResponse or JSONResponse: The relayed stream, or the upstream error.
+    """
+
+    # Open the stream on the least busy OpenAI key. The key is held until the stream has been relayed, unless upstream returned an error.
+    member = url = None
+    async def attempt_upstream():
+        nonlocal member, url
+        member = upstream_pool.acquire()
+        url = member.base_url + endpoint
+        try:
+            upstream_stream = await upstream_client.open_stream(url, json=payload, headers=upstream_pool.headers(member, headers))
+        except BaseException:
+            upstream_pool.release(member)
+            raise
+        if upstream_stream.status_code != 200:
+            upstream_pool.release(member, upstream_stream.status_code, upstream_stream.headers)
+        return upstream_stream
+
+    try:
+        upstream_stream = await call_upstream_resiliently(attempt_upstream, deadline)
+    except BaseException:
+        reconcile_tokens(token_reservation, 500, b"")
+        raise
+
+    # Errors are not streamed by OpenAI, so return them the same way as the non-streaming path
+    if upstream_stream.status_code != 200:
+        response = await upstream_stream.read()
+        reconcile_tokens(token_reservation, response.status_code, response.content)
+        if logging_installed_bool:
+            insert_api_log(response_time=round((time.time()-start_time)*1000),response_code=response.status_code,endpoint=url,request=payload,response_str=response.content)
+        return JSONResponse(status_code=200, content={"message": response.json()})
+
+    # Release the upstream member once, when the relay finishes or is dropped
+    member_released = False
+    def release_member():
+        nonlocal member_released
+        if not member_released:
+            member_released = True
+            upstream_pool.release(member, upstream_stream.status_code, upstream_stream.headers)
+
+    async def relay():
+        chunks = []
+        try:
+            async for chunk in upstream_stream.iter_chunks():
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            upstream_stream.release()
+            release_member()
+            if admission_ticket is not None:
+                admission_ticket.release()
+            reconcile_tokens(token_reservation, upstream_stream.status_code, b"".join(chunks))
+
+            # Log the assembled response once the stream has finished
+            if logging_installed_bool:
+                insert_api_log(response_time=round((time.time()-start_time)*1000),response_code=upstream_stream.status_code,endpoint=url,request=payload,response_str=b"".join(chunks),stream=True)
+
+    # Release the slot and the member even if the client disconnects before the relay starts
+    relay_stream = relay()
+    weakref.finalize(relay_stream, release_member)
+    if admission_ticket is not None:
+        weakref.finalize(relay_stream, admission_ticket.release)
+
+    return StreamingResponse(relay_stream, media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post('/api/openai/completions/gpt3/batch')
+async def get_openai_gpt3_batch_completion(request: Request, batch: BatchCompletionRequest, stream: bool = False, api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint runs a batch of independent Chat Completions with OpenAI's GPT-3 model in one call.
+
+    - **requests**: A list of up to BATCH_MAX_SIZE chat requests, each with a "message" (a list of message objects, as for /api/openai/completions/gpt3) and a "temperature".
+    - **stream**: If true, the results are streamed back as newline delimited JSON (one result per line) as each completes, instead of all at once.
+
+    The rate limit is reserved once for the whole batch: if it has no room for every request, the batch is rejected with a 429 before anything is sent to OpenAI. Requests that never reach OpenAI (shed by admission or rejected by the token budget) give their call back once the batch has finished. Requests served from the cache (if installed) are not counted, unless CACHE_HITS_CONSUME_RATE_LIMIT is set. At most BATCH_MAX_CONCURRENCY requests of the batch call OpenAI at a time, each with its own deadline (send "X-ProxyGPT-Timeout: <seconds>" to shorten it). The logs of the batch are written in one transaction.
+
+    Each result has the "index" of its request and the "status" of its call, with the OpenAI response in "message" or the error in "error". Without streaming, the results are returned in order as {"results": [...]}.
+    """
+
+    if not 0 < len(batch.requests) <= BATCH_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"A batch must have between 1 and {BATCH_MAX_SIZE} requests. See BATCH_MAX_SIZE in settings.py.")
+
+    # Check the X-ProxyGPT-Timeout header before anything is reserved. Each request gets its own deadline when it starts.
+    get_deadline(request)
+
+    endpoint = "/chat/completions"
+    headers = {
+        "content-type": "application/json",
+    }
+    payloads = [{ "model": "gpt-3.5-turbo", "messages": [{"role": msg.role, "content": msg.content} for msg in item.message], "temperature": item.temperature } for item in batch.requests]
+    results = [None] * len(payloads)
+
+    # Serve the responses from the cache if installed, before reserving rate limit
+    cache_keys = [None] * len(payloads)
+    if cache_installed_bool:
+        cache_mode = get_cache_mode(request.headers)
+        for index, payload in enumerate(payloads):
+            if cache_mode == "bypass" or not response_cache.is_cacheable(payload):
+                response_cache.record_bypass()
+                continue
+            cache_keys[index] = get_cache_key(payload)
+            if cache_mode == "use":
+                # The persistent tier is read from SQLite, so keep it off the event loop
+                if response_cache.persistent:
+                    cached_body = await run_in_threadpool(response_cache.get, cache_keys[index])
+                else:
+                    cached_body = response_cache.get(cache_keys[index])
+                if cached_body is not None:
+                    results[index] = {"index": index, "status": 200, "message": json.loads(cached_body), "cache": "HIT"}
+
+    # Atomically reserve the rate limit of the whole batch, all or nothing
+    pending = [index for index, result in enumerate(results) if result is None]
+    reserved = len(payloads) if CACHE_HITS_CONSUME_RATE_LIMIT else len(pending)
+    if reserved > 0:
+        await run_in_threadpool(reserve_api_usage, api_key, reserved)
+
+    # The log rows of the batch, written together once the batch has finished
+    log_rows = []
+
+    # The number of requests that went on to call upstream. The others (shed by admission, rejected by the token
+    # budget or never started) give back their reserved call once the batch has finished.
+    sent_upstream = 0
+
+    # Run one request of the batch, returning its result instead of raising its error
+    async def complete(index: int) -> dict:
+        nonlocal sent_upstream
+        payload = payloads[index]
+        url = None
+
+        # Send one attempt through the shared connection pool, to the least busy OpenAI key
+        async def attempt_upstream():
+            nonlocal url
+            member = upstream_pool.acquire()
+            url = member.base_url + endpoint
+            try:
+                response = await upstream_client.post(url, json=payload, headers=upstream_pool.headers(member, headers))
+            except BaseException:
+                upstream_pool.release(member)
+                raise
+            upstream_pool.release(member, response.status_code, response.headers)
+            return response
+
+        admission_ticket = None
+        try:
+            deadline = get_deadline(request)
+            admission_ticket = await admit_request(api_key, deadline)
+            token_reservation = reserve_tokens(messages=payload["messages"])
+            sent_upstream += 1
+            start_time = time.time()
+
+            # Call upstream with retries (and hedging if enabled) within the deadline
+            try:
+                response = await call_upstream_resiliently(attempt_upstream, deadline, hedge=RESILIENCE_HEDGE)
+            except BaseException:
+                reconcile_tokens(token_reservation, 500, b"")
+                raise
+            reconcile_tokens(token_reservation, response.status_code, response.content)
+
+            if logging_installed_bool:
+                log_rows.append(defer_api_log_row(response_time=round((time.time()-start_time)*1000),response_code=response.status_code,endpoint=url,request=payload,response_str=response.content))
+
+            # Only successful responses are cached
+            if cache_keys[index] is not None and response.status_code == 200:
+                response_cache.set(cache_keys[index], response.content)
+
+            result = {"index": index, "status": response.status_code, "message": response.json()}
+            if cache_keys[index] is not None:
+                result["cache"] = "MISS"
+            return result
+        except HTTPException as e:
+            # Token budget, admission and upstream errors fail only their own request
+            return {"index": index, "status": e.status_code, "error": e.detail}
+        except Exception as e:
+            if not INSECURE_DEBUG:
+                print(e)
+            return {"index": index, "status": 500, "error": str(e) if INSECURE_DEBUG else "Internal server error. Set INSECURE_DEBUG to True to view error details from client side."}
+        finally:
+            if admission_ticket is not None:
+                admission_ticket.release()
+
+    # Yield the results as they complete, with at most BATCH_MAX_CONCURRENCY requests in flight
+    async def fan_out():
+        next_position = 0
+        in_flight = set()
+        try:
+            while True:
+                while len(in_flight) < BATCH_MAX_CONCURRENCY and next_position < len(pending):
+                    in_flight.add(asyncio.ensure_future(complete(pending[next_position])))
+                    next_position += 1
+                if not in_flight:
+                    return
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            # Stop the requests still running if the client went away, and write the logs of the batch in one transaction
+            for task in in_flight:
+                task.cancel()
+            if log_rows:
+                insert_api_logs(log_rows)
+
+            # Give back the calls reserved for the requests that never reached upstream
+            if reserved > 0 and sent_upstream < len(pending):
+                await run_in_threadpool(release_api_usage, api_key, len(pending) - sent_upstream)
+
+    if not stream:
+        async for result in fan_out():
+            results[result["index"]] = result
+        with time_phase("serialization"):
+            return JSONResponse(status_code=200, content={"results": results})
+
+    # Stream the cached results first, then every other result as soon as it completes
+    async def stream_results():
+        completions = fan_out()
+        try:
+            for result in results:
+                if result is not None:
+                    yield json.dumps(result) + "\n"
+            async for result in completions:
+                yield json.dumps(result) + "\n"
+        finally:
+            await completions.aclose()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# Define a route for the raw passthrough of the allowed OpenAI endpoints
+@app.api_route('/api/openai/v1/{path:path}', methods=["GET", "POST"], dependencies=[Depends(valid_passthrough_path)])
+async def passthrough_openai(path: str, request: Request, api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint forwards requests to the OpenAI endpoints allowed in PASSTHROUGH_ENDPOINTS (e.g. /api/openai/v1/embeddings to https://api.openai.com/v1/embeddings).
+
+    The request and response bodies are forwarded unchanged, without being parsed, and only the Authorization header is replaced. Streamed responses are relayed as they arrive. Failed upstream calls are retried within the deadline (see X-ProxyGPT-Timeout), and errors from OpenAI are then returned with their original status code.
+    """
+
+    # Wait for an upstream slot
+    deadline = get_deadline(request)
+    admission_ticket = await admit_request(api_key, deadline)
+
+    try:
+        # Reserve the estimated tokens before the rate limit, so requests rejected by the token budget are not counted
+        body = await request.body()
+        token_reservation = reserve_tokens(body=body) if body else None
+
+        # Atomically check the rate limit and log the API usage, once the request is admitted
+        try:
+            await run_in_threadpool(reserve_api_usage, api_key)
+        except HTTPException:
+            reconcile_tokens(token_reservation, 500, b"")
+            raise
+
+        # Log time if logging installed.
+        if logging_installed_bool:
+            start_time = time.time()
+
+        # Forward the raw body, replacing only the Authorization header (set by the upstream member)
+        headers = {}
+        for header in ("content-type", "accept"):
+            if header in request.headers:
+                headers[header] = request.headers[header]
+
+        # Send each attempt to the least busy OpenAI key, which is held until a streamed response has been relayed
+        member = url = None
+        async def attempt_upstream():
+            nonlocal member, url
+            member = upstream_pool.acquire()
+            url = member.base_url + "/" + path
+            if request.url.query:
+                url += "?" + request.url.query
+            try:
+                upstream_response = await upstream_client.open_request(request.method, url, body=body, headers=upstream_pool.headers(member, headers))
+            except BaseException:
+                upstream_pool.release(member)
+                raise
+            if upstream_response.status_code != 200:
+                upstream_pool.release(member, upstream_response.status_code, upstream_response.headers)
+                member = None
+            return upstream_response
+
+        try:
+            upstream_response = await call_upstream_resiliently(attempt_upstream, deadline)
+        except BaseException:
+            reconcile_tokens(token_reservation, 500, b"")
+            raise
+        media_type = upstream_response.headers.get("Content-Type")
+
+        # Release the upstream member once, when the response has been read or relayed
+        member_released = member is None
+        def release_member():
+            nonlocal member_released
+            if not member_released:
+                member_released = True
+                upstream_pool.release(member, upstream_response.status_code, upstream_response.headers)
+
+        # Relay streamed responses as they arrive
+        if media_type is not None and media_type.startswith("text/event-stream"):
+            async def relay():
+                chunks = []
+                try:
+                    async for chunk in upstream_response.iter_chunks():
+                        chunks.append(chunk)
+                        yield chunk
+                finally:
+                    upstream_response.release()
+                    release_member()
+                    stream_ticket.release()
+                    reconcile_tokens(token_reservation, upstream_response.status_code, b"".join(chunks))
+
+                    # Log the response once the stream has finished
+                    if logging_installed_bool:
+                        insert_api_log(response_time=round((time.time()-start_time)*1000),response_code=upstream_response.status_code,endpoint=url,request=body or None,response_str=b"".join(chunks),stream=path == "chat/completions")
+
+            # The relay releases the slot and the member once the stream has finished, even if the client disconnects before it starts
+            stream_ticket, admission_ticket = admission_ticket, None
+            relay_stream = relay()
+            weakref.finalize(relay_stream, release_member)
+            weakref.finalize(relay_stream, stream_ticket.release)
+
+            return StreamingResponse(relay_stream, status_code=upstream_response.status_code, media_type=media_type, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+        try:
+            response = await upstream_response.read()
+        finally:
+            release_member()
+        reconcile_tokens(token_reservation, response.status_code, response.content)
+
         # Log API results if logging installed.
         if logging_installed_bool:
-            insert_api_log(response_time=round((time.time()-start_time)*1000),response_code=response.status_code,endpoint=url,request=str(payload),response_str=response.text)
+            insert_api_log(response_time=round((time.time()-start_time)*1000),response_code=response.status_code,endpoint=url,request=body or None,response_str=response.content)
 
-        return JSONResponse(status_code=200, content={"message": response.json()})
+        return Response(status_code=response.status_code, content=response.content, media_type=media_type)
+    except HTTPException:
+        # Rate limit and token budget errors are returned as is
+        raise
     except Exception as e:
         if INSECURE_DEBUG:
             return JSONResponse(status_code=500, content={"error": str(e)})
         else:
             print(e)
             return JSONResponse(status_code=500, content={"error": "Internal server error. Set INSECURE_DEBUG to True to view error details from client side."})
+    finally:
+        if admission_ticket is not None:
+            admission_ticket.release()
 
 
 # Define a route for the GET of /ratelimit
 @app.get('/ratelimit')
 async def get_ratelimit(api_key: str = Depends(valid_api_key)):
     """
-    This endpoint allows you to view the current rate limit status and settings.
+    This endpoint allows you to view the current rate limit status and settings, including the limits and usage of your API key (key_id is its fingerprint), and the health of each OpenAI key of the upstream pool.
     """
 
     # Return rate limit status and settings if rate limits are enabled
@@ -347,12 +1286,109 @@ async def get_ratelimit(api_key: str = Depends(valid_api_key)):
     if USE_HOURLY_RATE_LIMIT:
         json_to_return["hourly_rate_limit"] = hourly_rate_limit
         json_to_return["hourly_api_usage"] = get_api_usage_from_last_hour()
+
+    # Return the limits and usage of the API key if it has per-key limits
+    key_limits = key_registry.limits_for(api_key)
+    if "daily" in key_limits:
+        json_to_return["key_daily_rate_limit"] = key_limits["daily"]
+        json_to_return["key_daily_api_usage"] = get_api_usage_from_last_day(key_id=api_key)
+    if "hourly" in key_limits:
+        json_to_return["key_hourly_rate_limit"] = key_limits["hourly"]
+        json_to_return["key_hourly_api_usage"] = get_api_usage_from_last_hour(key_id=api_key)
+
+    # Return the token budget and the tokens used in the last minute
+    if token_budget is not None:
+        json_to_return["tokens_per_minute"] = tokens_per_minute
+        json_to_return["token_usage"] = token_budget.usage()
+
     if len(json_to_return) == 0:
         json_to_return = {"error": "Rate limit is not enabled."}
+    json_to_return["key_id"] = api_key
+
+    # Return the health and usage of each OpenAI key of the upstream pool, by fingerprint (as seen by this worker)
+    json_to_return["upstream"] = upstream_pool.stats()
+
+    return JSONResponse(status_code=200, content=json_to_return)
+
+
+# Define a route for the GET of /stats
+@app.get('/stats')
+async def get_stats(api_key: str = Depends(valid_api_key)):
+    """
+    This endpoint allows you to view the internal metrics of this worker, such as the queue depth and dropped rows of the log writer, the rows deleted and rolled up by the retention compactor, the coalesced requests, and the hits and misses of the response cache.
+    """
+
+    json_to_return = {"log_writer": batch_writer.stats(), "retention": retention_compactor.stats(), "coalescing": request_coalescer.stats()}
+    json_to_return["admission"] = admission_controller.stats()
+    json_to_return["upstream"] = resilient_caller.stats()
+    if token_budget is not None:
+        json_to_return["token_budget"] = token_budget.stats()
+    if cache_installed_bool:
+        json_to_return["cache"] = response_cache.stats()
+    if search_installed_bool:
+        json_to_return["search"] = search_indexer.stats()
 
     return JSONResponse(status_code=200, content=json_to_return)
 
 
+if logging_installed_bool:
+    @app.get("/logs/export")
+    def export_logs(format: str = "ndjson", gzip: bool = False, columns: str = None, start_time: int = None, end_time: int = None, after_id: int = None, api_key: str = Depends(valid_api_key)):
+        """
+        This endpoint streams the API logs out of the database, oldest first, in constant memory (see also manage.py export-logs).
+
+        - **format**: "ndjson" (one JSON object per line, the default) or "csv" (with a header row).
+        - **gzip**: If true, the export is gzipped.
+        - **columns** (optional): Comma separated columns to export, from id, timestamp, response_time, response_code, endpoint, model, message_count, prompt_tokens, completion_tokens, finish_reason, sample_weight, request and response (the decoded payloads). Defaults to every column but the payloads.
+        - **start_time** (optional): Only export logs at or after this unix timestamp.
+        - **end_time** (optional): Only export logs at or before this unix timestamp.
+        - **after_id** (optional): Only export logs with an id above this one. To resume an interrupted export, pass the id of the last log received (so include the id column).
+        """
+
+        if format not in EXPORT_FORMATS:
+            raise HTTPException(status_code=400, detail="Unknown format: " + format + ". Use one of: " + ", ".join(EXPORT_FORMATS))
+        try:
+            export_columns = get_export_columns(columns.split(",") if columns else None)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        filename = "api_logs." + format + (".gz" if gzip else "")
+        output = format_api_logs(iter_api_logs(columns=export_columns, start_time=start_time, end_time=end_time, after_id=after_id), export_columns, format=format, gzip=gzip)
+        return StreamingResponse(output, media_type="application/gzip" if gzip else EXPORT_FORMATS[format], headers={"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": "no-store"})
+
+
+if search_installed_bool:
+    @app.get("/logs/search")
+    def search_logs(q: str, raw: bool = False, start_time: int = None, end_time: int = None, status: str = None, limit: int = Query(default=20, gt=0, le=SEARCH_MAX_LIMIT), offset: int = Query(default=0, ge=0), api_key: str = Depends(valid_api_key)):
+        """
+        This endpoint searches the prompts and completions of the API logs, best matches first. Each result has the summary of the log, its rank (lower is better) and a snippet of its prompt and completion with the matched terms wrapped in <mark></mark>. Logs are indexed in the background, within about SEARCH_INDEX_INTERVAL seconds of being written.
+
+        - **q**: The words to search for, all of which must match (a word ending in * matches as a prefix).
+        - **raw**: If true, q uses the SQLite FTS5 query syntax (OR, NOT, NEAR, "phrases", prompt: or completion: filters).
+        - **start_time** (optional): Only match logs at or after this unix timestamp.
+        - **end_time** (optional): Only match logs at or before this unix timestamp.
+        - **status** (optional): Comma separated status codes or classes to match, e.g. "429,5xx".
+        - **limit**: The maximum number of results (at most 100).
+        - **offset**: The number of results to skip, for the next page.
+        """
+
+        try:
+            results = search_api_logs(q, raw=raw, start_time=start_time, end_time=end_time, status=status, limit=limit, offset=offset)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return JSONResponse(status_code=200, content={"results": results})
+
+
+if metrics_installed_bool:
+    @app.get("/metrics")
+    def get_metrics(api_key: str = Depends(valid_api_key)):
+        """
+        This endpoint returns the Prometheus metrics of ProxyGPT (aggregated across gunicorn workers), such as the request counts by route, status code and key fingerprint, and the latency histograms of each phase of a request. Scrape it with the API key as a bearer token.
+        """
+
+        return Response(content=generate_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+
 if graphics_installed_bool:
     @app.get("/dashboard", response_class=HTMLResponse)
     async def get_dashboard(request: Request):
@@ -362,18 +1398,88 @@ if graphics_installed_bool:
 
         return templates.TemplateResponse(
         "dashboard.html",
-        {"request": request})
+        {"request": request, "live_feed": DASHBOARD_LIVE_FEED, "refresh_interval": DASHBOARD_REFRESH_INTERVAL, "search_enabled": search_installed_bool})
 
     @app.get("/dashboard-data")
-    async def get_dashboard_data(api_key: str = Depends(valid_api_key)):
+    def get_dashboard_data(request: Request, start_time: int = None, end_time: int = None, last_n: int = None, since: int = None, api_key: str = Depends(valid_api_key)):
         """
-        This endpoint allows you to view the dashboard data of ProxyGPT.
+        This endpoint allows you to view the dashboard data of ProxyGPT, newest first. Payloads are left out, see /dashboard-data/logs/{log_id}.
+
+        - **start_time** (optional): Only return logs at or after this unix timestamp.
+        - **end_time** (optional): Only return logs at or before this unix timestamp.
+        - **last_n** (optional): Only return the last n logs.
+        - **since** (optional): Only return logs newer than this cursor (the X-ProxyGPT-Cursor header of an earlier response).
+
+        Send the ETag of an earlier response as If-None-Match to get a 304 if no logs were written since.
+
+        Prefer /dashboard-data/aggregate and /dashboard-data/logs for large log tables.
         """
         #TODO: clean logs to remove injection vulnerabilities
 
-        log_results = transform_api_logs(get_api_logs())
+        def get_content():
+            log_results = transform_api_logs(get_api_logs(start_time=start_time, end_time=end_time, last_n=last_n, since=since))
+
+            # Reverse
+            log_results.reverse()
+            return log_results
+
+        return get_dashboard_response(request, get_content)
+
+    @app.get("/dashboard-data/aggregate")
+    def get_dashboard_aggregate(request: Request, start_time: int = None, end_time: int = None, bucket_seconds: int = Query(default=3600, gt=0), since: int = None, api_key: str = Depends(valid_api_key)):
+        """
+        This endpoint returns the API logs aggregated per time bucket and response code (request count and latency stats), computed in SQL.
+
+        - **start_time** (optional): Only aggregate logs at or after this unix timestamp.
+        - **end_time** (optional): Only aggregate logs at or before this unix timestamp.
+        - **bucket_seconds**: The length of each time bucket in seconds (default one hour).
+        - **since** (optional): Only return the buckets changed by logs newer than this cursor (the X-ProxyGPT-Cursor header of an earlier response), with their full values.
+
+        Send the ETag of an earlier response as If-None-Match to get a 304 if no logs were written since.
+        """
+
+        return get_dashboard_response(request, lambda: get_api_log_aggregates(start_time=start_time, end_time=end_time, bucket_seconds=bucket_seconds, since=since))
+
+    if DASHBOARD_LIVE_FEED:
+        @app.get("/dashboard-data/stream")
+        async def get_dashboard_stream(since: int = None, api_key: str = Depends(valid_api_key)):
+            """
+            This endpoint pushes the summaries of new API logs as Server-Sent Events, checking for new logs every DASHBOARD_LIVE_FEED_INTERVAL seconds.
+
+            - **since** (optional): Send the logs newer than this cursor (by default, only logs written after connecting).
+
+            The first event ("cursor") holds the starting cursor. Each "logs" event holds the previous cursor ("since"), the new cursor ("cursor"), the new logs newest first ("logs"), and whether older new logs were left out ("truncated"). Fetch /dashboard-data/aggregate with the previous cursor as since to update the aggregates.
+            """
+
+            return StreamingResponse(stream_dashboard_updates(since), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @app.get("/dashboard-data/logs")
+    def get_dashboard_logs(limit: int = Query(default=50, gt=0, le=1000), cursor: int = None, columns: str = None, start_time: int = None, end_time: int = None, api_key: str = Depends(valid_api_key)):
+        """
+        This endpoint returns one page of API logs, newest first.
+
+        - **limit**: The maximum number of logs to return (up to 1000).
+        - **cursor** (optional): The next_cursor returned with the previous page.
+        - **columns** (optional): Comma separated columns to return, from id, timestamp, response_time, response_code, endpoint, model, message_count, prompt_tokens, completion_tokens, finish_reason and sample_weight. Payloads are only returned by /dashboard-data/logs/{log_id}.
+        - **start_time** (optional): Only return logs at or after this unix timestamp.
+        - **end_time** (optional): Only return logs at or before this unix timestamp.
+        """
+
+        try:
+            page = get_api_log_page(limit=limit, cursor=cursor, columns=columns.split(",") if columns else None, start_time=start_time, end_time=end_time)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return JSONResponse(status_code=200, content=page)
+
+    @app.get("/dashboard-data/logs/{log_id}")
+    def get_dashboard_log(log_id: int, api_key: str = Depends(valid_api_key)):
+        """
+        This endpoint returns a single API log with its request and response payloads, which are only decompressed here.
+        """
 
-        # Reverse
-        log_results.reverse()
+        log = get_api_log(log_id)
+        if log is None:
+            raise HTTPException(status_code=404, detail="Log not found")
 
-        return JSONResponse(status_code=200, content=log_results)
\ No newline at end of file
+        return JSONResponse(status_code=200, content=log)
@@ -0,0 +1,138 @@
+"""
+Manage.py file for ProxyGPT. This file contains the command line tools for the database of ProxyGPT.
+
+Usage: python manage.py export-logs --format csv --gzip --output api_logs.csv.gz
+       python manage.py rebuild-search-index
+       python manage.py vacuum
+       python manage.py compress-logs
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the command line options
+import argparse
+
+# Required for writing to standard output
+import sys
+
+# Import the shared storage layer, to bring the database up to date before using it
+import storage
+
+# Import the export of API logs
+from modules.logging import EXPORT_FORMATS, get_export_columns, iter_api_logs, format_api_logs
+
+
+# ------------- [Commands] -------------
+
+# Function for exporting the API logs
+def export_logs(options: argparse.Namespace) -> None:
+    """
+    This function writes the API logs to a file (or standard output), oldest
+    first and in constant memory, like /logs/export.
+
+    Args:
+        options (argparse.Namespace): The options of the export-logs command.
+    """
+    columns = get_export_columns(options.columns.split(",") if options.columns else None)
+    output = open(options.output, "wb") if options.output else sys.stdout.buffer
+    try:
+        for piece in format_api_logs(iter_api_logs(columns=columns, start_time=options.start_time, end_time=options.end_time, after_id=options.after_id), columns, format=options.format, gzip=options.gzip):
+            output.write(piece)
+    finally:
+        if options.output:
+            output.close()
+        else:
+            output.flush()
+
+# Function for rebuilding the full-text index of the API logs
+def rebuild_search_index_command(options: argparse.Namespace) -> None:
+    """
+    This function rebuilds the full-text index of the search module, printing
+    its progress to standard error.
+
+    Args:
+        options (argparse.Namespace): The options of the rebuild-search-index command.
+    """
+    # Imported here, as the search module needs SQLite with FTS5
+    from modules.search import create_search_index, rebuild_search_index
+
+    create_search_index()
+    indexed_logs = rebuild_search_index(progress=lambda count: print(f"Indexed {count} logs", file=sys.stderr))
+    print(f"Rebuilt the search index ({indexed_logs} logs)", file=sys.stderr)
+
+# Function for converting the database to incremental auto vacuum
+def vacuum(options: argparse.Namespace) -> None:
+    """
+    This function converts the database to incremental auto vacuum once, so
+    the retention compactor can return freed pages to the OS.
+
+    Args:
+        options (argparse.Namespace): The options of the vacuum command.
+    """
+    if storage.enable_incremental_vacuum():
+        print("Converted the database to incremental auto vacuum", file=sys.stderr)
+    else:
+        print("The database already uses incremental auto vacuum", file=sys.stderr)
+
+# Function for converting the payloads of legacy API logs
+def compress_logs(options: argparse.Namespace) -> None:
+    """
+    This function converts every API log written before payloads were stored as
+    compressed JSON, in batches, printing its progress to standard error. It
+    can run while ProxyGPT is running, and resumes if interrupted.
+
+    Args:
+        options (argparse.Namespace): The options of the compress-logs command.
+    """
+    total, last_rowid = 0, 0
+    while True:
+        converted, last_rowid = storage.compress_logged_payloads(last_rowid, options.batch_size)
+        if not converted:
+            break
+        total += converted
+        print(f"Converted {total} logs", file=sys.stderr)
+    print(f"Every log payload is compressed ({total} converted)", file=sys.stderr)
+
+
+# ------------- [Main] -------------
+
+# Function for parsing the command line and running the command
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(description="Command line tools for the database of ProxyGPT (set PROXYGPT_DATABASE_PATH to use another database).")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+
+    export_parser = subparsers.add_parser("export-logs", help="Export the API logs as NDJSON or CSV", description="Export the API logs, oldest first, in constant memory.")
+    export_parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="ndjson")
+    export_parser.add_argument("--gzip", action="store_true", help="Compress the export with gzip")
+    export_parser.add_argument("--columns", default=None, help="Comma separated columns, from id, timestamp, response_time, response_code, endpoint, model, message_count, prompt_tokens, completion_tokens, finish_reason, sample_weight, request and response (default every column but the payloads)")
+    export_parser.add_argument("--start-time", type=int, default=None, help="Only export logs at or after this unix timestamp")
+    export_parser.add_argument("--end-time", type=int, default=None, help="Only export logs at or before this unix timestamp")
+    export_parser.add_argument("--after-id", type=int, default=None, help="Only export logs with an id above this one (to resume an export)")
+    export_parser.add_argument("--output", default=None, help="Path of the export (default standard output)")
+    export_parser.set_defaults(handler=export_logs)
+
+    search_parser = subparsers.add_parser("rebuild-search-index", help="Rebuild the full-text index of the API logs", description="Empty the full-text index of the search module and index every API log again.")
+    search_parser.set_defaults(handler=rebuild_search_index_command)
+
+    vacuum_parser = subparsers.add_parser("vacuum", help="Convert the database to incremental auto vacuum", description="Convert an existing database to incremental auto vacuum with a full VACUUM, so the retention compactor can return freed pages to the OS. Preferably run it while ProxyGPT is stopped.")
+    vacuum_parser.set_defaults(handler=vacuum)
+
+    compress_parser = subparsers.add_parser("compress-logs", help="Convert the payloads of old API logs to compressed JSON", description="Convert the payloads of API logs written before they were stored as compressed JSON, in batches. The retention compactor also does it in the background.")
+    compress_parser.add_argument("--batch-size", type=int, default=1000, help="Maximum number of logs converted per transaction")
+    compress_parser.set_defaults(handler=compress_logs)
+
+    options = parser.parse_args(args)
+    storage.migrate()
+    try:
+        options.handler(options)
+    except ValueError as e:
+        parser.error(str(e))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+Cache.py file for ProxyGPT. This file contains the response cache module code for the API.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the in-memory LRU tier
+from collections import OrderedDict
+import threading
+
+# Required for expiry timestamps
+import time
+
+# Required for type hints
+from typing import Optional
+
+# Import the canonical request key
+from payloads import get_payload_key
+
+# Import the shared storage layer (persistent tier) and the background batched writer
+from storage import get_connection
+from batchwriter import batch_writer
+
+# Import the cache settings
+from settings import CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_TTL, CACHE_PERSISTENT, CACHE_PERSISTENT_MAX_ENTRIES, CACHE_MAX_TEMPERATURE
+
+
+# ------------- [Helper Functions] -------------
+
+# Function for building the cache key of a completion request
+def get_cache_key(payload: dict) -> str:
+    """
+    This function returns the cache key of a completion request, the canonical
+    hash of its model, messages and temperature.
+
+    Args:
+        payload (dict): The upstream payload of the request.
+
+    Returns:
+        str: The cache key.
+    """
+    return get_payload_key(payload)
+
+# Function for reading the cache mode requested by the client
+def get_cache_mode(headers) -> str:
+    """
+    This function returns how the cache should be used for a request, from
+    its headers:
+
+    - "X-ProxyGPT-Cache: bypass" or "Cache-Control: no-store": "bypass" (neither read nor write)
+    - "Cache-Control: no-cache": "refresh" (skip the read, store the new response)
+    - otherwise: "use"
+
+    Args:
+        headers: The headers of the request.
+
+    Returns:
+        str: One of "use", "refresh" or "bypass".
+    """
+    cache_control = headers.get("cache-control", "").lower()
+    if headers.get("x-proxygpt-cache", "").lower() == "bypass" or "no-store" in cache_control:
+        return "bypass"
+    if "no-cache" in cache_control:
+        return "refresh"
+    return "use"
+
+
+# ------------- [Classes] -------------
+
+# Define the response cache
+class ResponseCache:
+    """
+    Two tier cache of upstream response bodies for deterministic completion
+    requests. The first tier is an in-memory LRU per worker, bounded by entry
+    count and total bytes. The optional second tier is the response_cache table,
+    shared by every worker and kept across restarts; its writes go through the
+    background batched writer. Entries expire after ttl seconds in both tiers.
+
+    Args:
+        max_entries (int): The maximum number of entries in memory.
+        max_bytes (int): The maximum total size of the bodies in memory.
+        ttl (int): Seconds an entry is served before it expires.
+        persistent (bool): Also store entries in the response_cache table.
+        persistent_max_entries (int): The maximum number of entries in the response_cache table.
+        max_temperature (float): Requests with a higher temperature are never cached.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: int, persistent: bool, persistent_max_entries: int, max_temperature: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.persistent = persistent
+        self.persistent_max_entries = persistent_max_entries
+        self.max_temperature = max_temperature
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def is_cacheable(self, payload: dict) -> bool:
+        """
+        This function checks if a request is deterministic enough to be cached.
+
+        Args:
+            payload (dict): The upstream payload of the request.
+
+        Returns:
+            bool: True if the response of the request may be cached.
+        """
+        return not payload.get("stream") and payload.get("temperature", 1) <= self.max_temperature
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        This function returns the cached response body of a key, or None on a miss.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            Optional[bytes]: The cached upstream response body.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, body = entry
+                if expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return body
+                self._remove(key)
+                self.expirations += 1
+
+        # Fall back to the persistent tier, promoting the entry to memory on a hit
+        if self.persistent:
+            row = get_connection().execute("SELECT expires_at, body FROM response_cache WHERE cache_key = ? AND expires_at > ?", (key, now)).fetchone()
+            if row is not None:
+                with self.lock:
+                    self._insert(key, row[0], row[1])
+                    self.hits += 1
+                    self.persistent_hits += 1
+                return row[1]
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, body: bytes) -> None:
+        """
+        This function stores the response body of a key in both tiers.
+
+        Args:
+            key (str): The cache key.
+            body (bytes): The upstream response body.
+        """
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            self._insert(key, expires_at, body)
+            self.stores += 1
+            stores = self.stores
+
+        if self.persistent:
+            batch_writer.submit("INSERT OR REPLACE INTO response_cache (cache_key, expires_at, body) VALUES (?, ?, ?)", (key, expires_at, body))
+            # Periodically trim the persistent tier to its TTL and size bounds
+            if stores % 100 == 0:
+                batch_writer.submit("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+                batch_writer.submit("DELETE FROM response_cache WHERE cache_key IN (SELECT cache_key FROM response_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)", (self.persistent_max_entries,))
+
+    def record_bypass(self) -> None:
+        """
+        This function counts a request that skipped the cache.
+        """
+        with self.lock:
+            self.bypasses += 1
+
+    def stats(self) -> dict:
+        """
+        This function returns the hit and miss statistics of the cache.
+
+        Returns:
+            dict: The statistics of the cache.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "persistent_hits": self.persistent_hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "bypasses": self.bypasses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def _insert(self, key: str, expires_at: float, body: bytes) -> None:
+        # Bodies larger than the whole memory tier are only kept in the persistent tier
+        if len(body) > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (expires_at, body)
+        self.size += len(body)
+
+        # Evict the least recently used entries until both bounds hold
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        expires_at, body = self.entries.pop(key)
+        self.size -= len(body)
+
+
+# ------------- [Initialization: Cache] -------------
+
+# Create the response cache of this worker
+response_cache = ResponseCache(
+    max_entries=CACHE_MAX_ENTRIES,
+    max_bytes=CACHE_MAX_BYTES,
+    ttl=CACHE_TTL,
+    persistent=CACHE_PERSISTENT,
+    persistent_max_entries=CACHE_PERSISTENT_MAX_ENTRIES,
+    max_temperature=CACHE_MAX_TEMPERATURE,
+)
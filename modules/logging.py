@@ -11,145 +11,447 @@ License: MIT
 
 # Required libraries from Pydantic for API functionality
 from pydantic import BaseModel
-from typing import List
+from typing import Callable, Iterator, List, Optional
 
 # Required for inspecting code
 import inspect
 
-# Required for rate limiting with database and timestamps
-import sqlite3
+# Required for timestamps
 import time
 
+# Required for sampling API logs
+import random
+
+# Required for deferring the building of API log rows to the background writer
+import functools
+
+# Required for assembling the logged chat completion streams
+from upstream import assemble_chat_completion_stream
+
+# Import the shared storage layer, which creates the api_logs table through its migrations
+from storage import get_connection, open_connection
+
+# Required for exporting API logs as NDJSON or CSV, optionally gzipped
+import csv
+import io
+import json
+import zlib
+
 # Required for printing styled log messages 
 from utils import *
 
+# Import the background batched writer, which takes log writes off the request path
+from batchwriter import batch_writer
+
+# Import the payload encoding (compressed JSON and extracted columns)
+from payloads import encode_payload, decode_payload, extract_payload_fields, truncate_payload
 
-# ------------- [Initialization: DB] -------------
+# Import the logging policy settings
+from settings import LOG_SAMPLE_RATES, LOG_ERROR_SAMPLE_RATES, LOG_SLOW_REQUEST_MS, LOG_MAX_FIELD_CHARS, LOG_PAYLOADS
 
-# Use SQLITE database to store API logs
-# Create a table for API usage if it does not exist
-conn = sqlite3.connect('proxygpt.db')
-c = conn.cursor()
 
-# Create the api_logs table with the new schema
-c.execute('''
-    CREATE TABLE IF NOT EXISTS api_logs (
-        api_timestamp INTEGER,
-        response_time FLOAT,
-        response_code INTEGER,
-        endpoint TEXT,
-        request TEXT,
-        response_str TEXT
-    )
-''')
+# ------------- [Helper Functions] -------------
 
-# Commit the changes and close the connection
-conn.commit()
-conn.close()
+# Columns that can be selected from api_logs, by the name used in the API
+LOG_COLUMNS = {
+    "id": "rowid",
+    "timestamp": "api_timestamp",
+    "response_time": "response_time",
+    "response_code": "response_code",
+    "endpoint": "endpoint",
+    "model": "model",
+    "message_count": "message_count",
+    "prompt_tokens": "prompt_tokens",
+    "completion_tokens": "completion_tokens",
+    "finish_reason": "finish_reason",
+    "sample_weight": "sample_weight",
+}
+
+# Columns returned when no projection is given
+DEFAULT_LOG_COLUMNS = ["id", "timestamp", "response_time", "response_code", "endpoint", "model", "prompt_tokens", "completion_tokens", "finish_reason"]
+
+# Columns that can be exported: the columns of LOG_COLUMNS and the decoded payloads
+EXPORT_COLUMNS = list(LOG_COLUMNS) + ["request", "response"]
+
+# Formats of exported API logs, with their media types
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# Size in bytes of the pieces of an export yielded at once
+EXPORT_PIECE_SIZE = 65536
+
+def build_time_filter(start_time: int = None, end_time: int = None, column: str = "api_timestamp") -> tuple:
+    """
+    This function builds the SQL conditions and parameters of a time range filter.
 
+    Args:
+        start_time (int) (optional): The start time of the range (inclusive).
+        end_time (int) (optional): The end time of the range (inclusive).
+        column (str): The timestamp column to filter on.
 
-# ------------- [Helper Functions] -------------
+    Returns:
+        tuple: The list of SQL conditions and the list of their parameters.
+    """
 
-def get_last_n(list_to_cut: List[BaseModel], n: int) -> List[BaseModel]:
+    conditions = []
+    params = []
+    if start_time is not None:
+        conditions.append(column + " >= ?")
+        params.append(start_time)
+    if end_time is not None:
+        conditions.append(column + " <= ?")
+        params.append(end_time)
+    return conditions, params
+
+# Function for getting the sample rate of an API call
+def get_sample_rate(endpoint: str, response_code: int, response_time: float) -> float:
     """
-    This function returns the last n number of items from a list.
-    If n is None, the function returns the entire list.
+    This function returns the fraction of API calls like this one that are
+    logged, following the logging policy in settings.py: slow calls are always
+    logged, errors are sampled by status code or class (LOG_ERROR_SAMPLE_RATES)
+    and other calls by upstream endpoint (LOG_SAMPLE_RATES), the most specific
+    key winning.
 
     Args:
-        list_to_cut (List[BaseModel]): The list to cut.
-        n (int): The number of items to return.
-    
+        endpoint (str): The endpoint url of the API call.
+        response_code (int): The response code of the API call.
+        response_time (float): The response time of the API call in milliseconds.
+
     Returns:
-        List[BaseModel]: The last n number of items from the list.
+        float: The sample rate, from 0 (never logged) to 1 (always logged).
     """
 
-    # If n is None, return the entire list
-    if n is None:
-        return list_to_cut
-    # Otherwise, return the last n number of items from the list
-    else:
-        return list_to_cut[-n:]
+    if LOG_SLOW_REQUEST_MS is not None and response_time is not None and response_time >= LOG_SLOW_REQUEST_MS:
+        return 1.0
+    if response_code is not None and response_code >= 400:
+        for key in (str(response_code), str(response_code)[0] + "xx", "*"):
+            if key in LOG_ERROR_SAMPLE_RATES:
+                return LOG_ERROR_SAMPLE_RATES[key]
+        return 1.0
+
+    # The endpoint path after the API version, e.g. "chat/completions"
+    name = endpoint.split("/v1/", 1)[-1] if endpoint else ""
+    return LOG_SAMPLE_RATES.get(name, LOG_SAMPLE_RATES.get("*", 1.0))
 
 
 # ------------- [Functions] -------------
 
+# Statement inserting one API log row
+INSERT_API_LOG_STATEMENT = '''
+    INSERT INTO api_logs (api_timestamp, response_time, response_code, endpoint, payload_encoding, request_blob, response_blob,
+        model, message_count, prompt_tokens, completion_tokens, finish_reason, sample_weight)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Function for building an API log row
+def build_api_log_row(response_time: float, response_code: int, endpoint: str, request, response_str, stream: bool = False, sample_rate: float = None, timestamp: int = None) -> Optional[tuple]:
+    """
+    This function builds the parameters of an API log row (see
+    INSERT_API_LOG_STATEMENT), or returns None if the call is sampled out by
+    the logging policy, before any payload is encoded. The request and
+    response are stored as compressed JSON (with long strings truncated, or
+    left out in metadata mode), next to the small fields extracted from them
+    (model, message count, token usage and finish reason) and the sample
+    weight of the row.
+
+    Args:
+        response_time (float): The response time of the API call.
+        response_code (int): The response code of the API call.
+        endpoint (str): The endpoint url of the API call.
+        request (dict, str or bytes) (optional): The request data of the API call.
+        response_str (dict, str or bytes) (optional): The response of the API call, as an object or raw JSON body.
+        stream (bool) (optional): Whether the response is a raw chat completion stream to assemble.
+        sample_rate (float) (optional): The sample rate already chosen for the call, if it was sampled in.
+        timestamp (int) (optional): The time of the API call, defaults to now.
+
+    Returns:
+        Optional[tuple]: The parameters of the row, or None if it is not logged.
+    """
+
+    if sample_rate is None:
+        sample_rate = get_sample_rate(endpoint, response_code, response_time)
+        if sample_rate < 1 and random.random() >= sample_rate:
+            return None
+
+    if stream:
+        response_str = assemble_chat_completion_stream(response_str)
+
+    # In metadata mode the payloads are not stored, so only the fields are extracted
+    if LOG_PAYLOADS == "metadata":
+        fields = extract_payload_fields(request, response_str)
+        request_encoding, request_blob, response_encoding, response_blob = None, None, None, None
+    else:
+        # Only the long strings are cut, so the extracted fields are not affected
+        request = truncate_payload(request, LOG_MAX_FIELD_CHARS)
+        response_str = truncate_payload(response_str, LOG_MAX_FIELD_CHARS)
+        fields = extract_payload_fields(request, response_str)
+        request_encoding, request_blob = encode_payload(request)
+        response_encoding, response_blob = encode_payload(response_str)
+
+    return (timestamp or int(time.time()), response_time, response_code, endpoint, request_encoding or response_encoding, request_blob, response_blob,
+            fields["model"], fields["message_count"], fields["prompt_tokens"], fields["completion_tokens"], fields["finish_reason"],
+            round(1 / sample_rate, 6))
+
+# Function for deferring the building of an API log row
+def defer_api_log_row(response_time: float, response_code: int, endpoint: str, request, response_str, stream: bool = False) -> Optional[Callable[[], tuple]]:
+    """
+    This function samples an API call on the request path, and returns a
+    function building its row (see build_api_log_row) for the background
+    writer, or None if it is sampled out. The payloads are kept as they are
+    until the row is built, so parsing, truncating and compressing them does
+    not block the event loop.
+
+    Args:
+        response_time (float): The response time of the API call.
+        response_code (int): The response code of the API call.
+        endpoint (str): The endpoint url of the API call.
+        request (dict, str or bytes) (optional): The request data of the API call.
+        response_str (dict, str or bytes) (optional): The response of the API call, as an object or raw JSON body.
+        stream (bool) (optional): Whether the response is a raw chat completion stream to assemble.
+
+    Returns:
+        Optional[Callable[[], tuple]]: The function building the row, or None if it is not logged.
+    """
+
+    sample_rate = get_sample_rate(endpoint, response_code, response_time)
+    if sample_rate < 1 and random.random() >= sample_rate:
+        return None
+    return functools.partial(build_api_log_row, response_time, response_code, endpoint, request, response_str,
+                             stream=stream, sample_rate=sample_rate, timestamp=int(time.time()))
+
 # Function for inserting API log
-def insert_api_log(response_time: float, response_code: int, endpoint: str, request: str, response_str: str) -> None:
+def insert_api_log(response_time: float, response_code: int, endpoint: str, request, response_str, stream: bool = False) -> None:
     """
     This function inserts an instance of API usage into the SQLite database.
+    The request and response are stored as compressed JSON, next to the small
+    fields extracted from them (model, message count, token usage and finish
+    reason). The row is queued and written in a batch by the background writer,
+    which also builds it (see defer_api_log_row).
 
     Args:
         response_time (float): The response time of the API call.
         response_code (int): The response code of the API call.
         endpoint (str): The endpoint url of the API call.
-        request (str) (optional): The request data of the API call.
-        response_str (str) (optional): The response string of the API call.
+        request (dict, str or bytes) (optional): The request data of the API call.
+        response_str (dict, str or bytes) (optional): The response of the API call, as an object or raw JSON body.
+        stream (bool) (optional): Whether the response is a raw chat completion stream to assemble.
     """
 
-    conn = sqlite3.connect('proxygpt.db')
-    c = conn.cursor()
+    # Using parameterized query for safe insertion, queued for the background batched writer
+    row = defer_api_log_row(response_time, response_code, endpoint, request, response_str, stream)
+    if row is not None:
+        batch_writer.submit(INSERT_API_LOG_STATEMENT, row)
 
-    # Using parameterized query for safe insertion
-    c.execute('''
-        INSERT INTO api_logs (api_timestamp, response_time, response_code, endpoint, request, response_str)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (int(time.time()), response_time, response_code, endpoint, request, response_str))
+# Function for inserting several API logs together
+def insert_api_logs(rows: List[Optional[Callable[[], tuple]]]) -> None:
+    """
+    This function inserts several API log rows (deferred by defer_api_log_row,
+    skipping the sampled out ones), which the background writer always builds
+    and writes in the same transaction.
+
+    Args:
+        rows (List[Optional[Callable[[], tuple]]]): The functions building each row.
+    """
 
-    conn.commit()
-    conn.close()
+    rows = [row for row in rows if row is not None]
+    if rows:
+        batch_writer.submit_many(INSERT_API_LOG_STATEMENT, rows)
 
 
 # Function to returning the API logs
-def get_api_logs(start_time: int = None, end_time: int = None, last_n: int = None) -> List[BaseModel]:
+def get_api_logs(start_time: int = None, end_time: int = None, last_n: int = None, since: int = None) -> List[BaseModel]:
     """
-    This function returns a list of API logs from the SQLite database.
+    This function returns a list of API logs from the SQLite database, oldest first.
+    The filters are applied in SQL, so only the selected rows are read. Payloads
+    are not included (see get_api_log).
 
     Args:
         start_time (int) (optional): The start time of the API logs to return.
         end_time (int) (optional): The end time of the API logs to return.
         last_n (int) (optional): The last n number of API logs to return (will 
             select from filtered list if start_time and/or end_time are provided).
+        since (int) (optional): Only return API logs with an id above this cursor.
 
     Returns:
         List[BaseModel]: A list of API logs.
     """
 
-    conn = sqlite3.connect('proxygpt.db')
-    c = conn.cursor()
-
-    # If start_time and end_time are provided, filter the logs by time
-    if start_time and end_time:
-        c.execute('''
-            SELECT * FROM api_logs WHERE api_timestamp BETWEEN ? AND ?
-        ''', (start_time, end_time))
-    # If only start_time is provided, filter the logs by time
-    elif start_time:
-        c.execute('''
-            SELECT * FROM api_logs WHERE api_timestamp >= ?
-        ''', (start_time,))
-    # If only end_time is provided, filter the logs by time
-    elif end_time:
-        c.execute('''
-            SELECT * FROM api_logs WHERE api_timestamp <= ?
-        ''', (end_time,))
-    # If no time parameters are provided, select all logs
+    conditions, params = build_time_filter(start_time, end_time)
+    if since is not None:
+        conditions.append("rowid > ?")
+        params.append(since)
+    query = "SELECT rowid, api_timestamp, response_time, response_code, endpoint, model, message_count, prompt_tokens, completion_tokens, finish_reason FROM api_logs"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    # Take the last n rows in SQL (newest first), then restore the oldest first order
+    if last_n is not None:
+        query += " ORDER BY rowid DESC LIMIT ?"
+        params.append(last_n)
+        results = get_connection().execute(query, params).fetchall()
+        results.reverse()
     else:
-        c.execute('''
-            SELECT * FROM api_logs
-        ''')
-    
-    # Get the results from the query
-    results = c.fetchall()
-
-    # Filter by n, which will make no modification if n is None
-    results = get_last_n(results, last_n)
-
-    # Close the connection
-    conn.close()
-    
+        query += " ORDER BY rowid"
+        results = get_connection().execute(query, params).fetchall()
+
     # Return the results
     return results
 
+# Function for returning a single API log with its payloads
+def get_api_log(log_id: int) -> dict:
+    """
+    This function returns a single API log with its request and response
+    payloads decompressed and parsed.
+
+    Args:
+        log_id (int): The id of the API log.
+
+    Returns:
+        dict: The API log, or None if it does not exist.
+    """
+
+    row = get_connection().execute('''
+        SELECT rowid, api_timestamp, response_time, response_code, endpoint, model, message_count, prompt_tokens,
+            completion_tokens, finish_reason, payload_encoding, request_blob, response_blob
+        FROM api_logs WHERE rowid = ?
+    ''', (log_id,)).fetchone()
+    if row is None:
+        return None
+
+    log = transform_api_logs([row[:10]])[0]
+    log["request"] = decode_payload(row[10], row[11])
+    log["response"] = decode_payload(row[10], row[12])
+    return log
+
+# Function for returning one page of API logs
+def get_api_log_page(limit: int = 50, cursor: int = None, columns: List[str] = None, start_time: int = None, end_time: int = None) -> dict:
+    """
+    This function returns one page of API logs, newest first, using a keyset
+    cursor on the row id so every page costs the same no matter how deep it is.
+
+    Args:
+        limit (int): The maximum number of API logs to return.
+        cursor (int) (optional): The cursor returned with the previous page.
+        columns (List[str]) (optional): The columns to return (see LOG_COLUMNS). Payloads
+            are left out by default.
+        start_time (int) (optional): The start time of the API logs to return.
+        end_time (int) (optional): The end time of the API logs to return.
+
+    Returns:
+        dict: The API logs ("logs") and the cursor of the next page ("next_cursor", None on the last page).
+    """
+
+    columns = columns or DEFAULT_LOG_COLUMNS
+    unknown = [column for column in columns if column not in LOG_COLUMNS]
+    if unknown:
+        raise ValueError("Unknown column(s): " + ", ".join(unknown))
+
+    # Always select the id, which is needed for the cursor
+    selected = ["id"] + [column for column in columns if column != "id"]
+
+    conditions, params = build_time_filter(start_time, end_time)
+    if cursor is not None:
+        conditions.append("rowid < ?")
+        params.append(cursor)
+
+    query = "SELECT " + ", ".join(LOG_COLUMNS[column] for column in selected) + " FROM api_logs"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY rowid DESC LIMIT ?"
+    params.append(limit + 1)
+
+    rows = get_connection().execute(query, params).fetchall()
+
+    # The extra row tells whether there is a next page
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    logs = [{column: row[index] for index, column in enumerate(selected) if column in columns} for row in rows[:limit]]
+
+    return {"logs": logs, "next_cursor": next_cursor}
+
+# Function for returning the range of API log ids
+def get_api_log_ids() -> tuple:
+    """
+    This function returns the smallest and largest API log ids. Each is a
+    single index lookup, so they can be checked on every dashboard refresh:
+    the largest id is the cursor of new logs, and the pair changes whenever
+    logs are written or deleted.
+
+    Returns:
+        tuple: The smallest and largest ids (0 and 0 if there are no logs).
+    """
+
+    first_id, last_id = get_connection().execute("SELECT (SELECT MIN(rowid) FROM api_logs), (SELECT MAX(rowid) FROM api_logs)").fetchone()
+    return first_id or 0, last_id or 0
+
+# Function for returning aggregated API logs
+def get_api_log_aggregates(start_time: int = None, end_time: int = None, bucket_seconds: int = 3600, since: int = None) -> List[dict]:
+    """
+    This function returns the API logs aggregated in SQL per time bucket and
+    response code: the request count and the latency average, minimum and
+    maximum. Raw logs and the hourly rollups of expired logs are combined, so
+    the result covers the full history. Logs are counted by their sample
+    weight, so counts and averages estimate the true volume of sampled calls.
+
+    Args:
+        start_time (int) (optional): The start time of the API logs to aggregate.
+        end_time (int) (optional): The end time of the API logs to aggregate.
+        bucket_seconds (int): The length of each time bucket in seconds. Rollups
+            are only included when it is a multiple of 3600.
+        since (int) (optional): Only return the buckets changed by API logs with an
+            id above this cursor (recomputed in full, from the bucket of the oldest
+            of those logs onwards).
+
+    Returns:
+        List[dict]: The aggregates, ordered by bucket and response code.
+    """
+
+    # Only recompute the buckets that logs written after the cursor fall into
+    if since is not None:
+        first_timestamp = get_connection().execute("SELECT MIN(api_timestamp) FROM api_logs WHERE rowid > ?", (since,)).fetchone()[0]
+        if first_timestamp is None:
+            return []
+        first_bucket = first_timestamp - first_timestamp % bucket_seconds
+        start_time = first_bucket if start_time is None else max(start_time, first_bucket)
+
+    raw_conditions, raw_params = build_time_filter(start_time, end_time)
+    query = '''
+        SELECT api_timestamp - api_timestamp % ? AS bucket, response_code,
+            SUM(sample_weight) AS request_count, SUM(response_time * sample_weight) AS latency_sum,
+            MIN(response_time) AS latency_min, MAX(response_time) AS latency_max
+        FROM api_logs
+    ''' + (" WHERE " + " AND ".join(raw_conditions) if raw_conditions else "") + " GROUP BY bucket, response_code"
+    params = [bucket_seconds] + raw_params
+
+    # Combine with the rollups, which are only exact for whole hours
+    if bucket_seconds % 3600 == 0:
+        rollup_conditions, rollup_params = build_time_filter(
+            start_time - start_time % 3600 if start_time is not None else None, end_time, column="hour")
+        query += '''
+            UNION ALL
+            SELECT hour - hour % ? AS bucket, response_code,
+                SUM(request_count), SUM(latency_sum), MIN(latency_min), MAX(latency_max)
+            FROM api_logs_hourly
+        ''' + (" WHERE " + " AND ".join(rollup_conditions) if rollup_conditions else "") + " GROUP BY bucket, response_code"
+        params += [bucket_seconds] + rollup_params
+
+    query = '''
+        SELECT bucket, response_code, SUM(request_count), SUM(latency_sum), MIN(latency_min), MAX(latency_max)
+        FROM (''' + query + ''')
+        GROUP BY bucket, response_code
+        ORDER BY bucket, response_code
+    '''
+
+    return [
+        {
+            "bucket": bucket,
+            "response_code": response_code,
+            "request_count": round(request_count),
+            "latency_avg": round(latency_sum / request_count, 3) if request_count and latency_sum is not None else None,
+            "latency_min": latency_min,
+            "latency_max": latency_max,
+        }
+        for bucket, response_code, request_count, latency_sum, latency_min, latency_max in get_connection().execute(query, params).fetchall()
+    ]
+
 # Function for transforming list of API logs into list of dictionaries
 def transform_api_logs(logs: List[BaseModel]) -> List[BaseModel]:
     """
@@ -165,13 +467,157 @@ def transform_api_logs(logs: List[BaseModel]) -> List[BaseModel]:
     transformed_logs = []
     for log in logs:
         transformed_log = {
-            "timestamp": log[0],
-            "response_time": log[1],
-            "response_code": log[2],
-            "endpoint": log[3],
-            "request": log[4],
-            "response": log[5]
+            "id": log[0],
+            "timestamp": log[1],
+            "response_time": log[2],
+            "response_code": log[3],
+            "endpoint": log[4],
+            "model": log[5],
+            "message_count": log[6],
+            "prompt_tokens": log[7],
+            "completion_tokens": log[8],
+            "finish_reason": log[9]
         }
         transformed_logs.append(transformed_log)
 
-    return transformed_logs
\ No newline at end of file
+    return transformed_logs
+
+# Function for checking the columns of an export
+def get_export_columns(columns: List[str] = None) -> List[str]:
+    """
+    This function returns the columns of an export, checking that they exist.
+
+    Args:
+        columns (List[str]) (optional): The requested columns (see EXPORT_COLUMNS), DEFAULT_LOG_COLUMNS if not given.
+
+    Returns:
+        List[str]: The columns of the export.
+
+    Raises:
+        ValueError: If a column does not exist.
+    """
+
+    columns = columns or DEFAULT_LOG_COLUMNS
+    unknown = [column for column in columns if column not in EXPORT_COLUMNS]
+    if unknown:
+        raise ValueError("Unknown column(s): " + ", ".join(unknown))
+    return columns
+
+# Function for iterating over API logs in constant memory
+def iter_api_logs(columns: List[str] = None, start_time: int = None, end_time: int = None, after_id: int = None, page_size: int = 10000, chunk_size: int = 500) -> Iterator[dict]:
+    """
+    This function yields API logs oldest first, in constant memory. Logs are
+    read in keyset pages of page_size rows (ids above the last id read), and
+    each page is fetched from its cursor chunk_size rows at a time, on a
+    dedicated connection. A read snapshot is only held while a page is being
+    read, so a long export does not stop the WAL from being checkpointed. An
+    interrupted export can be resumed by passing the id of the last log it
+    received as after_id.
+
+    Args:
+        columns (List[str]) (optional): The columns to export (see EXPORT_COLUMNS). The
+            request and response payloads are decoded.
+        start_time (int) (optional): The start time of the API logs to export (inclusive).
+        end_time (int) (optional): The end time of the API logs to export (inclusive).
+        after_id (int) (optional): Only export API logs with an id above this one.
+        page_size (int): The maximum number of rows of one query.
+        chunk_size (int): The number of rows fetched from the cursor at a time.
+
+    Yields:
+        dict: The API logs, with the columns in the requested order.
+    """
+
+    columns = get_export_columns(columns)
+
+    # Always select the id, which is needed for the keyset, and the encoding with any payload
+    selected = ["id"] + [column for column in columns if column in LOG_COLUMNS and column != "id"]
+    payloads = [column for column in ("request", "response") if column in columns]
+    expressions = [LOG_COLUMNS[column] for column in selected]
+    if payloads:
+        expressions += ["payload_encoding"] + [column + "_blob" for column in payloads]
+
+    conditions, params = build_time_filter(start_time, end_time)
+    query = "SELECT " + ", ".join(expressions) + " FROM api_logs WHERE " + " AND ".join(["rowid > ?"] + conditions) + " ORDER BY rowid LIMIT ?"
+
+    conn = open_connection(check_same_thread=False)
+    try:
+        last_id = after_id or 0
+        while True:
+            cursor = conn.execute(query, [last_id] + params + [page_size])
+            count = 0
+            rows = cursor.fetchmany(chunk_size)
+            while rows:
+                for row in rows:
+                    values = dict(zip(selected, row))
+                    for index, column in enumerate(payloads):
+                        values[column] = decode_payload(row[len(selected)], row[len(selected) + 1 + index])
+                    last_id = row[0]
+                    yield {column: values[column] for column in columns}
+                count += len(rows)
+                rows = cursor.fetchmany(chunk_size)
+
+            # A short page is the last one
+            if count < page_size:
+                return
+    finally:
+        conn.close()
+
+# Function for formatting exported API logs
+def format_api_logs(logs: Iterator[dict], columns: List[str], format: str = "ndjson", gzip: bool = False) -> Iterator[bytes]:
+    """
+    This function formats API logs as NDJSON (one JSON object per line) or CSV
+    (with a header row, and payloads as JSON text), optionally gzipped. The
+    output is yielded in pieces of about EXPORT_PIECE_SIZE bytes, so memory use
+    does not depend on the number of logs.
+
+    Args:
+        logs (Iterator[dict]): The API logs (see iter_api_logs).
+        columns (List[str]): The columns of the API logs.
+        format (str): One of EXPORT_FORMATS.
+        gzip (bool): Compress the output with gzip.
+
+    Yields:
+        bytes: The pieces of the output.
+    """
+
+    if format not in EXPORT_FORMATS:
+        raise ValueError("Unknown format: " + format)
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n") if format == "csv" else None
+    if writer is not None:
+        writer.writerow(columns)
+
+    def take_piece() -> bytes:
+        piece = buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(piece) if compressor is not None else piece
+
+    for log in logs:
+        if writer is not None:
+            writer.writerow([json.dumps(log[column]) if column in ("request", "response") and log[column] is not None else log[column] for column in columns])
+        else:
+            buffer.write(json.dumps(log) + "\n")
+        if buffer.tell() >= EXPORT_PIECE_SIZE:
+            piece = take_piece()
+            if piece:
+                yield piece
+
+    piece = take_piece()
+    if compressor is not None:
+        piece += compressor.flush()
+    if piece:
+        yield piece
+
+
+# ------------- [Initialization: Logging Policy] -------------
+
+# Check the logging policy in settings.py
+if LOG_PAYLOADS not in ("full", "metadata"):
+    raise Exception(f'LOG_PAYLOADS in settings.py must be one of "full" or "metadata", not "{LOG_PAYLOADS}".')
+for policy_setting, policy_rates in (("LOG_SAMPLE_RATES", LOG_SAMPLE_RATES), ("LOG_ERROR_SAMPLE_RATES", LOG_ERROR_SAMPLE_RATES)):
+    for policy_key, policy_rate in policy_rates.items():
+        if not isinstance(policy_rate, (int, float)) or not 0 <= policy_rate <= 1:
+            raise Exception(f'The sample rate of "{policy_key}" in {policy_setting} in settings.py must be a number from 0 to 1, not {policy_rate!r}.')
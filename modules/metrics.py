@@ -0,0 +1,206 @@
+"""
+Metrics.py file for ProxyGPT. This file contains the Prometheus metrics module code for the API.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for wrapping timed functions
+import functools
+import inspect
+
+# Required for detecting the multiprocess mode of gunicorn
+import os
+
+# Required for timing requests and phases
+import time
+
+# Required for the Prometheus metrics (pip install prometheus_client)
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, REGISTRY, generate_latest, multiprocess
+
+# Import the background batched writer, whose flushes are timed as the db_write phase
+from batchwriter import batch_writer
+
+# Import the metrics settings
+from settings import METRICS_LATENCY_BUCKETS
+
+
+# ------------- [Metrics] -------------
+
+# With gunicorn, every worker writes its metrics to files in PROMETHEUS_MULTIPROC_DIR (see gunicorn.conf.py), which /metrics aggregates
+multiprocess_bool = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+# Define the metrics of requests
+REQUESTS = Counter("proxygpt_requests_total", "Requests handled, by route, method, status code and API key fingerprint.", ["route", "method", "status", "key_id"])
+REQUEST_DURATION = Histogram("proxygpt_request_duration_seconds", "Time from the start of a request until its response has been sent, by route.", ["route"], buckets=METRICS_LATENCY_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge("proxygpt_requests_in_flight", "Requests being handled.", multiprocess_mode="livesum")
+
+# Define the metrics of the phases of a request (auth, rate_limit, admission, token_budget, upstream, serialization, log_write, db_write)
+PHASE_DURATION = Histogram("proxygpt_phase_duration_seconds", "Time spent in each phase of a request.", ["phase"], buckets=METRICS_LATENCY_BUCKETS)
+PHASES_IN_FLIGHT = Gauge("proxygpt_phase_in_flight", "Requests currently in each phase (e.g. waiting for upstream).", ["phase"], multiprocess_mode="livesum")
+DB_WRITE_ROWS = Counter("proxygpt_db_write_rows_total", "Rows written by the background batched writer.")
+
+
+# ------------- [Classes] -------------
+
+# Define the timer of a phase
+class PhaseTimer:
+    """
+    Context manager timing one phase of a request, and counting it as in
+    flight while it runs.
+
+    Args:
+        phase (str): The name of the phase.
+    """
+
+    __slots__ = ("histogram", "gauge", "start_time")
+
+    def __init__(self, phase: str):
+        self.histogram = PHASE_DURATION.labels(phase)
+        self.gauge = PHASES_IN_FLIGHT.labels(phase)
+
+    def __enter__(self):
+        self.gauge.inc()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start_time)
+        self.gauge.dec()
+        return False
+
+
+# Define the middleware counting and timing every request
+class MetricsMiddleware:
+    """
+    ASGI middleware counting every request by route, method, status code and
+    API key fingerprint, and timing it until its response has been sent
+    (including the whole stream for streamed responses). Routes are labelled by
+    their path template (e.g. /api/openai/v1/{path:path}), so the number of
+    series stays bounded.
+
+    Args:
+        app: The ASGI app.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.route_paths = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        async def send_and_record_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            route = self.get_route_path(scope)
+            REQUEST_DURATION.labels(route).observe(time.perf_counter() - start_time)
+            REQUESTS.labels(route, scope["method"], str(status_code), scope.get("state", {}).get("key_id", "")).inc()
+            REQUESTS_IN_FLIGHT.dec()
+
+    def get_route_path(self, scope) -> str:
+        """
+        This function returns the path template of the route that handled a request.
+
+        Args:
+            scope (dict): The ASGI scope of the request, after routing.
+
+        Returns:
+            str: The path template, or "unmatched" if no route handled the request.
+        """
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if self.route_paths is None:
+            self.route_paths = {route.endpoint: route.path for route in scope["app"].routes if hasattr(route, "endpoint")}
+        return self.route_paths.get(endpoint, "unmatched")
+
+
+# ------------- [Functions] -------------
+
+# Function for timing a phase of a request
+def time_phase(phase: str) -> PhaseTimer:
+    """
+    This function returns a context manager timing a phase of a request.
+
+    Args:
+        phase (str): The name of the phase.
+
+    Returns:
+        PhaseTimer: The timer of the phase.
+    """
+    return PhaseTimer(phase)
+
+# Function for timing every call of a function as a phase
+def timed(phase: str):
+    """
+    This function returns a decorator timing every call of a function (sync
+    or async) as a phase of a request.
+
+    Args:
+        phase (str): The name of the phase.
+
+    Returns:
+        The decorator.
+    """
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def timed_function(*args, **kwargs):
+                with PhaseTimer(phase):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def timed_function(*args, **kwargs):
+                with PhaseTimer(phase):
+                    return function(*args, **kwargs)
+        return timed_function
+    return decorator
+
+# Function for recording a flush of the batched writer
+def observe_db_write(seconds: float, rows: int) -> None:
+    """
+    This function records the time and rows of a flush of the batched writer.
+
+    Args:
+        seconds (float): The seconds the flush took.
+        rows (int): The rows written.
+    """
+    PHASE_DURATION.labels("db_write").observe(seconds)
+    DB_WRITE_ROWS.inc(rows)
+
+# Function for exposing the metrics in the Prometheus text format
+def generate_metrics() -> bytes:
+    """
+    This function returns the metrics in the Prometheus text format,
+    aggregated across every gunicorn worker in multiprocess mode.
+
+    Returns:
+        bytes: The metrics.
+    """
+    if multiprocess_bool:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+# ------------- [Initialization: Metrics] -------------
+
+# Time the flushes of the batched writer of this worker
+batch_writer.flush_observer = observe_db_write
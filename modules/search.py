@@ -0,0 +1,354 @@
+"""
+Search.py file for ProxyGPT. This file contains the full-text search module code for the API.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for catching FTS5 errors
+import sqlite3
+
+# Required for timing indexer runs
+import time
+
+# Required for the background indexing thread
+import threading
+
+# Required for type hints
+from typing import Callable, List
+
+# Import the shared storage layer
+from storage import get_connection, transaction
+
+# Import the decompression and text extraction of payloads
+from payloads import decode_payload, extract_payload_text
+
+# Import the time range filter of the logging module
+from modules.logging import build_time_filter
+
+# Required for printing styled log messages
+from utils import *
+
+# Import the search settings
+from settings import SEARCH_INDEX_INTERVAL, SEARCH_INDEX_BATCH_SIZE, SEARCH_MAX_TEXT_CHARS, SEARCH_SNIPPET_TOKENS
+
+
+# ------------- [Helper Functions] -------------
+
+# Markers around the matched terms in snippets
+SNIPPET_START = "<mark>"
+SNIPPET_END = "</mark>"
+
+# Maximum number of results of one search
+SEARCH_MAX_LIMIT = 100
+
+# Function for building the FTS5 query of a search
+def build_match_query(query: str, raw: bool = False) -> str:
+    """
+    This function builds the FTS5 MATCH expression of a search. By default every
+    word is quoted, so punctuation and FTS5 operators are searched for literally,
+    and all words must match; a word ending in * matches as a prefix. With raw,
+    the query is passed to FTS5 as it is (AND, OR, NOT, NEAR, "phrases",
+    column filters like completion:word).
+
+    Args:
+        query (str): The search query.
+        raw (bool): Use the FTS5 query syntax.
+
+    Returns:
+        str: The MATCH expression.
+
+    Raises:
+        ValueError: If the query is empty.
+    """
+    if raw:
+        if not query.strip():
+            raise ValueError("The search query is empty")
+        return query
+
+    terms = []
+    for word in query.split():
+        prefix = len(word) > 1 and word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    if not terms:
+        raise ValueError("The search query is empty")
+    return " ".join(terms)
+
+# Function for building the status filter of a search
+def build_status_filter(status: str, column: str = "response_code") -> tuple:
+    """
+    This function builds the SQL condition and parameters of a status filter,
+    given as comma separated status codes or classes, e.g. "200,429,5xx".
+
+    Args:
+        status (str): The status codes and classes.
+        column (str): The status code column to filter on.
+
+    Returns:
+        tuple: The SQL condition and the list of its parameters.
+
+    Raises:
+        ValueError: If a status is neither a code nor a class.
+    """
+    conditions = []
+    params = []
+    for code in status.split(","):
+        code = code.strip().lower()
+        if len(code) == 3 and code[0] in "12345" and code[1:] == "xx":
+            conditions.append(column + " BETWEEN ? AND ?")
+            params.extend([int(code[0]) * 100, int(code[0]) * 100 + 99])
+        elif code.isdigit():
+            conditions.append(column + " = ?")
+            params.append(int(code))
+        elif code:
+            raise ValueError(f"Unknown status: {code} (use codes like 429 or classes like 5xx)")
+    if not conditions:
+        raise ValueError("The status filter is empty")
+    return "(" + " OR ".join(conditions) + ")", params
+
+
+# ------------- [Classes] -------------
+
+# Define the search indexer
+class SearchIndexer:
+    """
+    Keeps the full-text index up to date. Every interval, a background thread
+    indexes the prompts and completions of the API logs written since the last
+    run, in batches, so requests never pay for indexing. Logs are indexed in
+    row id order, and the last indexed id is read back from the index, so the
+    indexer resumes where it stopped after a restart, and running it in several
+    workers at once is safe.
+
+    Args:
+        interval (float): Seconds between indexer runs.
+        batch_size (int): Maximum number of logs indexed per transaction.
+        max_chars (int): Maximum characters indexed of each prompt and completion.
+    """
+
+    def __init__(self, interval: float, batch_size: int, max_chars: int):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_chars = max_chars
+        self.thread = None
+        self.stopping = threading.Event()
+
+        # Metrics
+        self.runs = 0
+        self.indexed_logs = 0
+        self.last_run_ms = 0.0
+        self.last_error = None
+
+    def start(self) -> None:
+        """
+        This function starts the background indexing thread.
+        """
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name="proxygpt-search", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """
+        This function stops the background indexing thread.
+
+        Args:
+            timeout (float): The maximum seconds to wait for a running batch to finish.
+        """
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def stats(self) -> dict:
+        """
+        This function returns the metrics of the indexer.
+
+        Returns:
+            dict: The number of runs and indexed logs.
+        """
+        return {
+            "running": self.thread is not None,
+            "runs": self.runs,
+            "indexed_logs": self.indexed_logs,
+            "last_run_ms": self.last_run_ms,
+            "last_error": self.last_error,
+        }
+
+    def _run(self) -> None:
+        # Index new logs once per interval until stopped
+        while not self.stopping.wait(self.interval):
+            try:
+                start_time = time.time()
+                while not self.stopping.is_set() and self.index_new_logs() == self.batch_size:
+                    pass
+                self.runs += 1
+                self.last_run_ms = round((time.time()-start_time)*1000, 3)
+            except Exception as e:
+                self.last_error = str(e)
+                print(red_critical(f'[Critical] Search indexing failed: {e}'))
+
+    def index_new_logs(self) -> int:
+        """
+        This function indexes one batch of API logs not indexed yet. The
+        payloads are decompressed before the write lock is taken; if another
+        worker indexed the same logs meanwhile, the batch is dropped.
+
+        Returns:
+            int: The number of indexed logs.
+        """
+        conn = get_connection()
+        last_id = get_last_indexed_id(conn)
+        rows = conn.execute("SELECT rowid, payload_encoding, request_blob, response_blob FROM api_logs WHERE rowid > ? ORDER BY rowid LIMIT ?", (last_id, self.batch_size)).fetchall()
+        if not rows:
+            return 0
+
+        # Every log gets a row, even without text, so the last indexed id always advances
+        documents = []
+        for rowid, encoding, request_blob, response_blob in rows:
+            try:
+                prompt, completion = extract_payload_text(decode_payload(encoding, request_blob), decode_payload(encoding, response_blob), self.max_chars)
+            except Exception:
+                prompt, completion = "", ""
+            documents.append((rowid, prompt, completion))
+
+        with transaction() as conn:
+            if get_last_indexed_id(conn) != last_id:
+                return 0
+            conn.executemany("INSERT INTO api_logs_fts (rowid, prompt, completion) VALUES (?, ?, ?)", documents)
+        self.indexed_logs += len(documents)
+        return len(documents)
+
+
+# ------------- [Functions] -------------
+
+# Function for creating the full-text index
+def create_search_index() -> None:
+    """
+    This function creates the FTS5 table indexing the prompts and completions of
+    the API logs (its row ids are the ids of the logs), and a trigger removing
+    logs from the index when they are deleted, e.g. by the retention compactor.
+    It must run after the database schema is migrated.
+
+    Raises:
+        Exception: If SQLite was built without FTS5.
+    """
+    try:
+        with transaction() as conn:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS api_logs_fts USING fts5(prompt, completion, tokenize = 'unicode61 remove_diacritics 2')")
+            conn.execute('''
+                CREATE TRIGGER IF NOT EXISTS api_logs_fts_delete AFTER DELETE ON api_logs BEGIN
+                    DELETE FROM api_logs_fts WHERE rowid = old.rowid;
+                END
+            ''')
+    except sqlite3.OperationalError as e:
+        if "fts5" in str(e):
+            raise Exception("The search module requires SQLite with the FTS5 extension, which this Python's sqlite3 was built without.")
+        raise
+
+# Function for getting the id of the last indexed API log
+def get_last_indexed_id(conn: sqlite3.Connection) -> int:
+    """
+    This function returns the id of the last API log in the full-text index.
+
+    Args:
+        conn (sqlite3.Connection): The connection to read with.
+
+    Returns:
+        int: The id of the last indexed log, or 0 if the index is empty.
+    """
+    # FTS5 reads the largest row id directly when scanning in row id order
+    row = conn.execute("SELECT rowid FROM api_logs_fts ORDER BY rowid DESC LIMIT 1").fetchone()
+    return row[0] if row else 0
+
+# Function for rebuilding the full-text index
+def rebuild_search_index(progress: Callable[[int], None] = None) -> int:
+    """
+    This function empties the full-text index and indexes every API log again,
+    e.g. after changing SEARCH_MAX_TEXT_CHARS. Searches return partial results
+    until it finishes. Logs indexed by running workers meanwhile are not
+    counted.
+
+    Args:
+        progress (Callable[[int], None]) (optional): Called with the number of logs indexed so far after each batch.
+
+    Returns:
+        int: The number of indexed logs.
+    """
+    with transaction() as conn:
+        conn.execute("DELETE FROM api_logs_fts")
+
+    indexer = SearchIndexer(interval=SEARCH_INDEX_INTERVAL, batch_size=SEARCH_INDEX_BATCH_SIZE, max_chars=SEARCH_MAX_TEXT_CHARS)
+    while True:
+        if indexer.index_new_logs():
+            if progress is not None:
+                progress(indexer.indexed_logs)
+            continue
+        # Nothing indexed: either every log is indexed, or a running worker indexed the batch first
+        conn = get_connection()
+        if conn.execute("SELECT 1 FROM api_logs WHERE rowid > ? LIMIT 1", (get_last_indexed_id(conn),)).fetchone() is None:
+            return indexer.indexed_logs
+
+# Function for searching the API logs
+def search_api_logs(query: str, raw: bool = False, start_time: int = None, end_time: int = None, status: str = None, limit: int = 20, offset: int = 0) -> List[dict]:
+    """
+    This function searches the prompts and completions of the API logs, best
+    matches first (by BM25 rank), with a snippet of each where the matched
+    terms are wrapped in SNIPPET_START and SNIPPET_END.
+
+    Args:
+        query (str): The search query (see build_match_query).
+        raw (bool): Use the FTS5 query syntax.
+        start_time (int) (optional): Only match logs at or after this time.
+        end_time (int) (optional): Only match logs at or before this time.
+        status (str) (optional): Only match these status codes and classes, e.g. "200,5xx".
+        limit (int): The maximum number of results (at most SEARCH_MAX_LIMIT).
+        offset (int): The number of results to skip.
+
+    Returns:
+        List[dict]: The matching logs, with their rank and snippets.
+
+    Raises:
+        ValueError: If the query or a filter is invalid.
+    """
+
+    conditions, params = build_time_filter(start_time, end_time, column="l.api_timestamp")
+    if status:
+        condition, status_params = build_status_filter(status, column="l.response_code")
+        conditions.append(condition)
+        params.extend(status_params)
+    where = "".join(" AND " + condition for condition in conditions)
+
+    try:
+        rows = get_connection().execute(f'''
+            SELECT l.rowid, l.api_timestamp, l.response_time, l.response_code, l.endpoint, l.model, api_logs_fts.rank,
+                snippet(api_logs_fts, 0, ?, ?, '…', ?), snippet(api_logs_fts, 1, ?, ?, '…', ?)
+            FROM api_logs_fts JOIN api_logs AS l ON l.rowid = api_logs_fts.rowid
+            WHERE api_logs_fts MATCH ?{where}
+            ORDER BY api_logs_fts.rank LIMIT ? OFFSET ?
+        ''', [SNIPPET_START, SNIPPET_END, SEARCH_SNIPPET_TOKENS, SNIPPET_START, SNIPPET_END, SEARCH_SNIPPET_TOKENS,
+              build_match_query(query, raw)] + params + [max(1, min(limit, SEARCH_MAX_LIMIT)), max(0, offset)]).fetchall()
+    except sqlite3.OperationalError as e:
+        # Syntax errors of raw queries, e.g. unbalanced quotes or an unknown column filter
+        if raw:
+            raise ValueError(f"Invalid search query: {e}")
+        raise
+
+    return [
+        {"id": row[0], "timestamp": row[1], "response_time": row[2], "response_code": row[3], "endpoint": row[4], "model": row[5],
+         "rank": round(row[6], 4), "prompt": row[7], "completion": row[8]}
+        for row in rows
+    ]
+
+
+# ------------- [Initialization: Search] -------------
+
+# Create the search indexer (started and stopped with the app)
+search_indexer = SearchIndexer(interval=SEARCH_INDEX_INTERVAL, batch_size=SEARCH_INDEX_BATCH_SIZE, max_chars=SEARCH_MAX_TEXT_CHARS)
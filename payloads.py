@@ -0,0 +1,285 @@
+"""
+Payloads.py file for ProxyGPT. This file contains the encoding of logged request and response payloads.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for storing payloads as real JSON
+import json
+
+# Required for the canonical key of a request
+import hashlib
+
+# Required for compressing payloads
+import zlib
+
+# Required for type hints
+from typing import Any, Optional, Tuple
+
+# Use zstandard for compression if it is installed (pip install zstandard), zlib otherwise
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Import the payload compression setting
+from settings import LOG_PAYLOAD_COMPRESSION
+
+
+# ------------- [Initialization: Encoding] -------------
+
+# Compression level for zlib (1 fastest to 9 smallest) and zstd (1 fastest to 22 smallest)
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Set the encoding used for new payloads
+if LOG_PAYLOAD_COMPRESSION == "auto":
+    PAYLOAD_ENCODING = "zstd" if zstandard is not None else "zlib"
+elif LOG_PAYLOAD_COMPRESSION == "zstd" and zstandard is None:
+    raise Exception('LOG_PAYLOAD_COMPRESSION in settings.py is "zstd", but the zstandard package is not installed. Install it with: pip install zstandard')
+elif LOG_PAYLOAD_COMPRESSION in ("zstd", "zlib"):
+    PAYLOAD_ENCODING = LOG_PAYLOAD_COMPRESSION
+else:
+    raise Exception(f'LOG_PAYLOAD_COMPRESSION in settings.py must be one of "auto", "zstd" or "zlib", not "{LOG_PAYLOAD_COMPRESSION}".')
+
+# Marker appended to truncated strings, with the number of characters cut
+TRUNCATION_MARKER = "…[truncated %d chars]"
+
+
+# ------------- [Functions] -------------
+
+# Function for turning a payload into JSON bytes
+def payload_to_json_bytes(payload: Any) -> bytes:
+    """
+    This function returns the JSON bytes of a payload. Bytes and strings are
+    assumed to already hold JSON (e.g. a raw upstream body) and are kept as is,
+    so they are not parsed again.
+
+    Args:
+        payload (Any): The payload as a JSON-serializable object, str or bytes.
+
+    Returns:
+        bytes: The JSON bytes.
+    """
+    if isinstance(payload, bytes):
+        return payload
+    if isinstance(payload, str):
+        return payload.encode("utf-8")
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+# Function for compressing a payload
+def encode_payload(payload: Any) -> Tuple[Optional[str], Optional[bytes]]:
+    """
+    This function serializes a payload to JSON and compresses it.
+
+    Args:
+        payload (Any): The payload as a JSON-serializable object, str or bytes (None for no payload).
+
+    Returns:
+        Tuple[Optional[str], Optional[bytes]]: The encoding ("zstd" or "zlib") and the compressed blob.
+    """
+    if payload is None:
+        return None, None
+    data = payload_to_json_bytes(payload)
+    if PAYLOAD_ENCODING == "zstd":
+        return "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return "zlib", zlib.compress(data, ZLIB_LEVEL)
+
+# Function for decompressing a payload
+def decode_payload(encoding: Optional[str], blob: Optional[bytes]) -> Any:
+    """
+    This function decompresses a payload and parses its JSON. Payloads that are
+    not valid JSON are returned as a string.
+
+    Args:
+        encoding (Optional[str]): The encoding of the blob ("zstd" or "zlib").
+        blob (Optional[bytes]): The compressed blob.
+
+    Returns:
+        Any: The parsed payload, or None if there is no payload.
+    """
+    if blob is None:
+        return None
+    if encoding == "zstd":
+        if zstandard is None:
+            raise Exception("This payload is compressed with zstd. Install the zstandard package to read it.")
+        data = zstandard.ZstdDecompressor().decompress(blob)
+    elif encoding == "zlib":
+        data = zlib.decompress(blob)
+    else:
+        raise Exception(f"Unknown payload encoding: {encoding}")
+
+    text = data.decode("utf-8", errors="replace")
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+# Function for capping the length of the strings in a payload
+def truncate_payload(payload: Any, max_chars: Optional[int]) -> Any:
+    """
+    This function caps every string in a payload (message contents, completions,
+    error messages...) at max_chars, replacing the rest with a marker recording
+    how much was cut, so the payload stays valid JSON. Payloads given as JSON
+    bytes or str are only parsed when they may hold a string long enough to
+    need truncation, and are returned as is otherwise.
+
+    Args:
+        payload (Any): The payload (object, or JSON str/bytes).
+        max_chars (Optional[int]): The maximum characters of each string (None for no limit).
+
+    Returns:
+        Any: The payload, truncated (as an object if it had to be parsed).
+    """
+
+    def truncate(value):
+        if isinstance(value, str):
+            if len(value) > max_chars:
+                return value[:max_chars] + TRUNCATION_MARKER % (len(value) - max_chars)
+            return value
+        if isinstance(value, dict):
+            return {key: truncate(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [truncate(item) for item in value]
+        return value
+
+    if payload is None or max_chars is None:
+        return payload
+    if isinstance(payload, (bytes, str)):
+        # A UTF-8 body is at least as long as any string in it
+        if len(payload) <= max_chars:
+            return payload
+        # Without escaped quotes, the strings of a JSON body are every other part between quotes,
+        # and no longer once decoded (e.g. an embeddings response with large numeric arrays)
+        quote, escaped_quote = (b'"', b'\\"') if isinstance(payload, bytes) else ('"', '\\"')
+        if payload.lstrip()[:1] in (b"{", b"[", "{", "[") and escaped_quote not in payload \
+                and max(map(len, payload.split(quote)[1::2]), default=0) <= max_chars:
+            return payload
+        try:
+            payload = json.loads(payload)
+        except ValueError:
+            payload = payload.decode("utf-8", errors="replace") if isinstance(payload, bytes) else payload
+    return truncate(payload)
+
+# Function for building the canonical key of a completion request
+def get_payload_key(payload: dict) -> str:
+    """
+    This function returns the canonical hash of a completion request: the
+    SHA-256 of its model, messages and temperature serialized with sorted keys,
+    so equal requests always map to the same key.
+
+    Args:
+        payload (dict): The upstream payload of the request.
+
+    Returns:
+        str: The key of the request.
+    """
+    canonical = json.dumps(
+        {"model": payload.get("model"), "messages": payload.get("messages"), "temperature": payload.get("temperature")},
+        sort_keys=True, separators=(",", ":"), ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+# Function for extracting the queryable fields of a chat completion
+def extract_payload_fields(request: Any, response: Any) -> dict:
+    """
+    This function extracts the small fields that are stored next to the
+    compressed payloads, so they can be queried without decompression: the
+    model, the number of messages, the token usage and the finish reason.
+
+    Args:
+        request (Any): The request payload (object, or JSON str/bytes).
+        response (Any): The response payload (object, or JSON str/bytes).
+
+    Returns:
+        dict: The extracted fields (None where not available).
+    """
+
+    def parse(payload):
+        if isinstance(payload, (bytes, str)):
+            try:
+                return json.loads(payload)
+            except ValueError:
+                return None
+        return payload
+
+    request = parse(request)
+    response = parse(response)
+    fields = {"model": None, "message_count": None, "prompt_tokens": None, "completion_tokens": None, "finish_reason": None}
+
+    if isinstance(request, dict):
+        fields["model"] = request.get("model")
+        if isinstance(request.get("messages"), list):
+            fields["message_count"] = len(request["messages"])
+
+    if isinstance(response, dict):
+        fields["model"] = response.get("model") or fields["model"]
+        usage = response.get("usage")
+        if isinstance(usage, dict):
+            fields["prompt_tokens"] = usage.get("prompt_tokens")
+            fields["completion_tokens"] = usage.get("completion_tokens")
+        choices = response.get("choices")
+        if isinstance(choices, list) and choices and isinstance(choices[0], dict):
+            fields["finish_reason"] = choices[0].get("finish_reason")
+
+    return fields
+
+# Function for extracting the searchable text of a chat completion
+def extract_payload_text(request: Any, response: Any, max_chars: int = None) -> Tuple[str, str]:
+    """
+    This function extracts the text of a prompt (the message contents, or the
+    prompt or input of other endpoints) and of its completion (the message
+    contents or texts of the choices, or the error message), for full-text
+    search. Payloads that are not JSON are used as they are.
+
+    Args:
+        request (Any): The decoded request payload.
+        response (Any): The decoded response payload.
+        max_chars (int) (optional): The maximum characters kept of each text.
+
+    Returns:
+        Tuple[str, str]: The prompt text and the completion text.
+    """
+
+    def collect(value, parts):
+        if isinstance(value, str):
+            parts.append(value)
+        elif isinstance(value, list):
+            for item in value:
+                # Content parts of multimodal messages, e.g. {"type": "text", "text": "..."}
+                collect(item.get("text") if isinstance(item, dict) else item, parts)
+
+    prompt_parts = []
+    if isinstance(request, dict):
+        if isinstance(request.get("messages"), list):
+            for message in request["messages"]:
+                if isinstance(message, dict):
+                    collect(message.get("content"), prompt_parts)
+        collect(request.get("prompt"), prompt_parts)
+        collect(request.get("input"), prompt_parts)
+    else:
+        collect(request, prompt_parts)
+
+    completion_parts = []
+    if isinstance(response, dict):
+        if isinstance(response.get("choices"), list):
+            for choice in response["choices"]:
+                if isinstance(choice, dict):
+                    if isinstance(choice.get("message"), dict):
+                        collect(choice["message"].get("content"), completion_parts)
+                    collect(choice.get("text"), completion_parts)
+        if isinstance(response.get("error"), dict):
+            collect(response["error"].get("message"), completion_parts)
+    else:
+        collect(response, completion_parts)
+
+    prompt = "\n".join(prompt_parts)
+    completion = "\n".join(completion_parts)
+    if max_chars is not None:
+        prompt, completion = prompt[:max_chars], completion[:max_chars]
+    return prompt, completion
@@ -0,0 +1,590 @@
+"""
+Ratelimit.py file for ProxyGPT. This file contains the rate limit backends for the API.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for timestamps
+import time
+
+# Import the shared storage layer holding the api_usage table
+from storage import get_connection, transaction
+
+# Required for sharing a backend between the threadpool workers of FastAPI
+import threading
+
+# Required for unique members in the Redis backend
+import uuid
+
+# Required for tracking the usage rows written by this worker
+from collections import Counter
+
+# Required for type hints
+from typing import Dict, Optional, Tuple
+
+
+# ------------- [Classes] -------------
+
+# Define a sliding window counter backed by a ring buffer of buckets
+class SlidingWindowCounter:
+    """
+    Counts events in a rolling window of time using a ring buffer of buckets.
+
+    Adding an event and reading the count are O(1) (amortized, since expired
+    buckets are cleared as time advances). With 1 second buckets the count
+    matches the "api_timestamp > now - window" query it replaces exactly.
+
+    Args:
+        window_seconds (int): The length of the rolling window in seconds.
+        bucket_seconds (int): The length of each bucket in seconds.
+    """
+
+    def __init__(self, window_seconds: int, bucket_seconds: int = 1):
+        self.window_seconds = window_seconds
+        self.bucket_seconds = bucket_seconds
+        self.num_buckets = -(-window_seconds // bucket_seconds)
+        self.buckets = [0] * self.num_buckets
+        self.total = 0
+        self.head: Optional[int] = None
+
+    def _advance(self, now: float) -> None:
+        # Move the head to the bucket of now, clearing every bucket that fell out of the window
+        bucket = int(now // self.bucket_seconds)
+        if self.head is None:
+            self.head = bucket
+            return
+        if bucket <= self.head:
+            return
+        steps = min(bucket - self.head, self.num_buckets)
+        for expired in range(self.head + 1, self.head + 1 + steps):
+            index = expired % self.num_buckets
+            self.total -= self.buckets[index]
+            self.buckets[index] = 0
+        self.head = bucket
+
+    def add(self, timestamp: float, amount: int = 1) -> None:
+        """
+        This function adds events at the given timestamp. Events older than the
+        window are ignored.
+
+        Args:
+            timestamp (float): The time of the events.
+            amount (int): The number of events to add.
+        """
+        self._advance(timestamp)
+        bucket = int(timestamp // self.bucket_seconds)
+        if bucket <= self.head - self.num_buckets:
+            return
+        self.buckets[bucket % self.num_buckets] += amount
+        self.total += amount
+
+    def remove(self, now: float, amount: int) -> None:
+        """
+        This function removes the newest events of the window (e.g. calls that
+        were counted but never made).
+
+        Args:
+            now (float): The current time.
+            amount (int): The number of events to remove.
+        """
+        self._advance(now)
+        for bucket in range(self.head, self.head - self.num_buckets, -1):
+            if amount <= 0:
+                return
+            index = bucket % self.num_buckets
+            removed = min(self.buckets[index], amount)
+            self.buckets[index] -= removed
+            self.total -= removed
+            amount -= removed
+
+    def count(self, now: float) -> int:
+        """
+        This function returns the number of events in the window ending at now.
+
+        Args:
+            now (float): The current time.
+
+        Returns:
+            int: The number of events in the window.
+        """
+        self._advance(now)
+        return self.total
+
+    def seconds_until(self, now: float, amount: int) -> float:
+        """
+        This function returns how long until the count of the window drops to
+        at most the given amount, as the oldest buckets expire.
+
+        Args:
+            now (float): The current time.
+            amount (int): The count to wait for.
+
+        Returns:
+            float: The seconds to wait (0 if the count is already at most amount).
+        """
+        self._advance(now)
+        remaining = self.total
+        if remaining <= amount:
+            return 0.0
+        for bucket in range(self.head - self.num_buckets + 1, self.head + 1):
+            remaining -= self.buckets[bucket % self.num_buckets]
+            if remaining <= amount:
+                return max((bucket + self.num_buckets) * self.bucket_seconds - now, 0.0)
+        return float(self.window_seconds)
+
+
+# Define the interface of a rate limit backend
+class RateLimitBackend:
+    """
+    Interface of a rate limit backend. Every backend enforces the same set of
+    rolling window limits and exposes an atomic reserve operation, so that
+    checking the limits and counting a call can never be split by another
+    request.
+
+    Calls are also counted per API key (by fingerprint), over the windows in
+    key_windows, and a reservation can carry limits of its own for the key.
+
+    Args:
+        limits (Dict[str, Tuple[int, int]]): The global limits by name, as (window_seconds, limit).
+        key_windows (Dict[str, int]) (optional): The windows of the per-key limits by name, in seconds.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[int, int]], key_windows: Optional[Dict[str, int]] = None):
+        self.limits = limits
+        self.key_windows = key_windows or {}
+
+    def load(self) -> None:
+        """
+        This function prepares the backend at startup. Does nothing by default.
+        """
+        pass
+
+    def reserve(self, key_id: Optional[str] = None, key_limits: Optional[Dict[str, int]] = None, amount: int = 1) -> bool:
+        """
+        This function atomically checks every global limit and every limit of
+        the key and, if all of them have room for amount more calls, counts
+        them. Either every call is counted or none is.
+
+        Args:
+            key_id (str) (optional): The fingerprint of the API key making the call.
+            key_limits (Dict[str, int]) (optional): The limits of the key by name (names of key_windows).
+            amount (int): The number of calls to reserve (e.g. the items of a batch).
+
+        Returns:
+            bool: True if the slots were reserved, False if a limit would be exceeded.
+        """
+        raise NotImplementedError
+
+    def release(self, key_id: Optional[str] = None, amount: int = 1) -> None:
+        """
+        This function gives back calls that were reserved but never made (e.g.
+        the requests of a batch shed before calling upstream), by removing the
+        newest calls of the key from every count.
+
+        Args:
+            key_id (str) (optional): The fingerprint of the API key that reserved the calls.
+            amount (int): The number of calls to give back.
+        """
+        raise NotImplementedError
+
+    def usage(self, name: str, key_id: Optional[str] = None) -> int:
+        """
+        This function returns the current count of the given limit.
+
+        Args:
+            name (str): The name of the limit.
+            key_id (str) (optional): Count only the calls of this API key, over the window of key_windows.
+
+        Returns:
+            int: The number of calls in the limit's window.
+        """
+        raise NotImplementedError
+
+    def retry_after(self, key_id: Optional[str] = None, key_limits: Optional[Dict[str, int]] = None, amount: int = 1) -> float:
+        """
+        This function returns how long until every global limit and every limit
+        of the key have room for amount more calls, as the oldest calls in their
+        windows expire. Used for the Retry-After header of a rejected call.
+
+        Args:
+            key_id (str) (optional): The fingerprint of the API key making the call.
+            key_limits (Dict[str, int]) (optional): The limits of the key by name (names of key_windows).
+            amount (int): The number of calls to wait room for.
+
+        Returns:
+            float: The seconds to wait (0 if every limit already has room, the
+                longest window if amount is above a limit).
+        """
+        raise NotImplementedError
+
+    def _longest_window(self) -> int:
+        # The longest window of any global or per-key limit
+        return max([window for window, limit in self.limits.values()] + list(self.key_windows.values()) + [0])
+
+    def check(self) -> bool:
+        """
+        This function checks (without reserving) if every limit still has room for one more call.
+
+        Returns:
+            bool: True if no limit has been reached, False otherwise.
+        """
+        return all(self.usage(name) < limit for name, (window, limit) in self.limits.items())
+
+
+# Define the in-memory rate limit backend
+class MemoryRateLimitBackend(RateLimitBackend):
+    """
+    In-memory rate limit backend with one sliding window counter per limit.
+
+    Reservations never query the database and are atomic within a worker. The
+    api_usage table is only used for durability: the counters are rebuilt from
+    it at startup, every call is written through to it, and rows inserted by
+    other workers are folded in incrementally (by rowid) at most once per sync
+    interval. Limits are therefore only approximate across workers.
+
+    If a writer is given, the write-through goes to its queue instead of the
+    request path.
+
+    Per-key counters are created on the first call of each key. To keep their
+    memory small with thousands of keys, they use at most KEY_BUCKETS buckets
+    per window (e.g. 10 second buckets for an hourly limit), so per-key limits
+    are counted at that granularity.
+
+    Args:
+        limits (Dict[str, Tuple[int, int]]): The global limits by name, as (window_seconds, limit).
+        key_windows (Dict[str, int]) (optional): The windows of the per-key limits by name, in seconds.
+        bucket_seconds (int): The length of each counter bucket in seconds.
+        sync_interval (float): The minimum seconds between folding in rows from other workers.
+        writer (BatchWriter) (optional): The background writer used for the write-through.
+    """
+
+    # Maximum number of buckets of each per-key counter
+    KEY_BUCKETS = 360
+
+    def __init__(self, limits: Dict[str, Tuple[int, int]], key_windows: Optional[Dict[str, int]] = None, bucket_seconds: int = 1, sync_interval: float = 1.0, writer=None):
+        super().__init__(limits, key_windows)
+        self.bucket_seconds = bucket_seconds
+        self.sync_interval = sync_interval
+        self.writer = writer
+        self.counters = {name: SlidingWindowCounter(window, bucket_seconds) for name, (window, limit) in limits.items()}
+        self.key_counters: Dict[str, Dict[str, SlidingWindowCounter]] = {}
+        self.lock = threading.Lock()
+        self.last_rowid = 0
+        self.last_sync = 0.0
+
+        # (timestamp, key_id) of the rows written by this worker that sync has not seen yet
+        self.own_timestamps = Counter()
+
+    def _get_key_counters(self, key_id: str) -> Dict[str, SlidingWindowCounter]:
+        counters = self.key_counters.get(key_id)
+        if counters is None:
+            counters = {name: SlidingWindowCounter(window, max(self.bucket_seconds, window // self.KEY_BUCKETS)) for name, window in self.key_windows.items()}
+            self.key_counters[key_id] = counters
+        return counters
+
+    def _add(self, timestamp: float, key_id: Optional[str] = None, amount: int = 1) -> None:
+        for counter in self.counters.values():
+            counter.add(timestamp, amount)
+        if key_id is not None:
+            for counter in self._get_key_counters(key_id).values():
+                counter.add(timestamp, amount)
+
+    def load(self) -> None:
+        """
+        This function rebuilds the counters from the rows of api_usage that are
+        still inside the longest window.
+        """
+        now = time.time()
+        longest_window = self._longest_window()
+        with self.lock:
+            c = get_connection().cursor()
+            c.execute("SELECT COALESCE(MAX(rowid), 0) FROM api_usage")
+            self.last_rowid = c.fetchone()[0]
+            c.execute("SELECT api_timestamp, key_id, COUNT(*) FROM api_usage WHERE api_timestamp > ? AND rowid <= ? GROUP BY api_timestamp, key_id", (int(now)-longest_window, self.last_rowid))
+            for timestamp, key_id, amount in c.fetchall():
+                self._add(timestamp, key_id, amount)
+            self.last_sync = now
+
+    def sync(self, force: bool = False) -> None:
+        """
+        This function folds in the usage rows written by other workers since
+        the last sync. Lookups are by rowid, so the cost depends only on the
+        number of new rows.
+
+        Args:
+            force (bool): Sync even if the sync interval has not passed.
+        """
+        now = time.time()
+        if not force and now - self.last_sync < self.sync_interval:
+            return
+        with self.lock:
+            c = get_connection().cursor()
+            c.execute("SELECT rowid, api_timestamp, key_id FROM api_usage WHERE rowid > ? ORDER BY rowid", (self.last_rowid,))
+            for rowid, timestamp, key_id in c.fetchall():
+                self.last_rowid = rowid
+                # Skip rows written by this worker, which are already counted. Rows are matched
+                # by timestamp and key since batched writes have no rowid, which keeps the count exact.
+                if self.own_timestamps[(timestamp, key_id)] > 0:
+                    self.own_timestamps[(timestamp, key_id)] -= 1
+                    continue
+                self._add(timestamp, key_id)
+
+            # Forget own rows that were never written (e.g. dropped) once they are out of every window
+            longest_window = self._longest_window()
+            for own in [own for own in self.own_timestamps if self.own_timestamps[own] <= 0 or own[0] <= now - longest_window]:
+                del self.own_timestamps[own]
+            self.last_sync = now
+
+    def reserve(self, key_id: Optional[str] = None, key_limits: Optional[Dict[str, int]] = None, amount: int = 1) -> bool:
+        self.sync()
+        now = int(time.time())
+        with self.lock:
+            for name, (window, limit) in self.limits.items():
+                if self.counters[name].count(now) + amount > limit:
+                    return False
+            if key_id is not None and key_limits:
+                key_counters = self._get_key_counters(key_id)
+                for name, limit in key_limits.items():
+                    if key_counters[name].count(now) + amount > limit:
+                        return False
+            self._add(now, key_id, amount)
+            self.own_timestamps[(now, key_id)] += amount
+            rows = [(now, key_id)] * amount
+            if self.writer is not None:
+                if not self.writer.submit_many("INSERT INTO api_usage (api_timestamp, key_id) VALUES (?, ?)", rows):
+                    self.own_timestamps[(now, key_id)] -= amount
+            else:
+                with transaction() as conn:
+                    conn.executemany("INSERT INTO api_usage (api_timestamp, key_id) VALUES (?, ?)", rows)
+        return True
+
+    def release(self, key_id: Optional[str] = None, amount: int = 1) -> None:
+        now = time.time()
+        with self.lock:
+            for counter in self.counters.values():
+                counter.remove(now, amount)
+            if key_id is not None:
+                for counter in self._get_key_counters(key_id).values():
+                    counter.remove(now, amount)
+            # Queued after the rows of the reservation, so the writer deletes them once they are written
+            if self.writer is not None:
+                self.writer.submit("DELETE FROM api_usage WHERE rowid IN (SELECT rowid FROM api_usage WHERE key_id IS ? ORDER BY api_timestamp DESC LIMIT ?)", (key_id, amount))
+            else:
+                with transaction() as conn:
+                    conn.execute("DELETE FROM api_usage WHERE rowid IN (SELECT rowid FROM api_usage WHERE key_id IS ? ORDER BY api_timestamp DESC LIMIT ?)", (key_id, amount))
+
+    def retry_after(self, key_id: Optional[str] = None, key_limits: Optional[Dict[str, int]] = None, amount: int = 1) -> float:
+        self.sync()
+        now = time.time()
+        with self.lock:
+            waits = [self.counters[name].seconds_until(now, limit - amount) for name, (window, limit) in self.limits.items()]
+            if key_id is not None and key_limits:
+                key_counters = self._get_key_counters(key_id)
+                waits += [key_counters[name].seconds_until(now, limit - amount) for name, limit in key_limits.items()]
+        return max(waits + [0.0])
+
+    def usage(self, name: str, key_id: Optional[str] = None) -> int:
+        self.sync()
+        with self.lock:
+            if key_id is not None:
+                return self._get_key_counters(key_id)[name].count(time.time())
+            return self.counters[name].count(time.time())
+
+
+# Define the SQLite rate limit backend
+class SQLiteRateLimitBackend(RateLimitBackend):
+    """
+    Rate limit backend that reserves slots in the shared api_usage table with a
+    single conditional INSERT (of one row per reserved call) inside an
+    immediate transaction. The write lock is
+    taken before the counts are read, so the limits hold exactly across every
+    worker process using the same database file. Per-key counts use the
+    (key_id, api_timestamp) index, so they only read the rows of that key.
+
+    The windows are counted while the write lock is held, so concurrent
+    reservations from every worker wait on each other. The memory backend
+    is faster, but only approximate across workers.
+
+    Args:
+        limits (Dict[str, Tuple[int, int]]): The global limits by name, as (window_seconds, limit).
+        key_windows (Dict[str, int]) (optional): The windows of the per-key limits by name, in seconds.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[int, int]], key_windows: Optional[Dict[str, int]] = None):
+        super().__init__(limits, key_windows)
+
+        # Conditional inserts by per-key limits. Keys mostly share a few sets of limits, so this stays small.
+        self.reserve_statements = {}
+
+    def _get_reserve_statement(self, key_limits: Dict[str, int]) -> str:
+        # Build the conditional insert, with one window condition per limit, once per set of limits so it stays in the statement cache
+        statement_key = tuple(sorted(key_limits.items()))
+        statement = self.reserve_statements.get(statement_key)
+        if statement is None:
+            conditions = ["(SELECT COUNT(*) FROM api_usage WHERE api_timestamp > :now - %d) + :amount <= %d" % (window, limit) for window, limit in self.limits.values()]
+            conditions += ["(SELECT COUNT(*) FROM api_usage WHERE key_id = :key_id AND api_timestamp > :now - %d) + :amount <= %d" % (self.key_windows[name], limit) for name, limit in statement_key]
+            # The counts do not depend on the row, so they are computed once before any row is inserted
+            statement = "WITH RECURSIVE calls(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM calls WHERE n < :amount) INSERT INTO api_usage (api_timestamp, key_id) SELECT :now, :key_id FROM calls" + (" WHERE " + " AND ".join(conditions) if conditions else "")
+            self.reserve_statements[statement_key] = statement
+        return statement
+
+    def reserve(self, key_id: Optional[str] = None, key_limits: Optional[Dict[str, int]] = None, amount: int = 1) -> bool:
+        statement = self._get_reserve_statement(key_limits if key_id is not None and key_limits else {})
+        with transaction() as conn:
+            conn.execute(statement, {"now": int(time.time()), "key_id": key_id, "amount": amount})
+            # The rowcount of the cursor is not set for statements starting with WITH, so ask SQLite
+            inserted = conn.execute("SELECT changes()").fetchone()[0]
+        return inserted == amount
+
+    def release(self, key_id: Optional[str] = None, amount: int = 1) -> None:
+        with transaction() as conn:
+            conn.execute("DELETE FROM api_usage WHERE rowid IN (SELECT rowid FROM api_usage WHERE key_id IS ? ORDER BY api_timestamp DESC LIMIT ?)", (key_id, amount))
+
+    def retry_after(self, key_id: Optional[str] = None, key_limits: Optional[Dict[str, int]] = None, amount: int = 1) -> float:
+        now = int(time.time())
+        windows = [(window, limit, None) for window, limit in self.limits.values()]
+        if key_id is not None and key_limits:
+            windows += [(self.key_windows[name], limit, key_id) for name, limit in key_limits.items()]
+        c = get_connection().cursor()
+        wait = 0.0
+        for window, limit, window_key_id in windows:
+            if amount > limit:
+                wait = max(wait, float(window))
+                continue
+            # The calls above limit - amount have to expire, so wait for the newest of them
+            condition, params = ("key_id = ? AND api_timestamp > ?", [window_key_id, now-window]) if window_key_id is not None else ("api_timestamp > ?", [now-window])
+            c.execute("SELECT COUNT(*) FROM api_usage WHERE " + condition, params)
+            excess = c.fetchone()[0] - (limit - amount)
+            if excess <= 0:
+                continue
+            c.execute("SELECT api_timestamp FROM api_usage WHERE " + condition + " ORDER BY api_timestamp LIMIT 1 OFFSET ?", params + [excess - 1])
+            row = c.fetchone()
+            if row is not None:
+                wait = max(wait, float(row[0] + window - now))
+        return wait
+
+    def usage(self, name: str, key_id: Optional[str] = None) -> int:
+        c = get_connection().cursor()
+        if key_id is not None:
+            c.execute("SELECT COUNT(*) FROM api_usage WHERE key_id = ? AND api_timestamp > ?", (key_id, int(time.time())-self.key_windows[name]))
+        else:
+            window, limit = self.limits[name]
+            c.execute("SELECT COUNT(*) FROM api_usage WHERE api_timestamp > ?", (int(time.time())-window,))
+        return c.fetchone()[0]
+
+
+# Define the Redis rate limit backend
+class RedisRateLimitBackend(RateLimitBackend):
+    """
+    Rate limit backend that keeps usage in Redis sorted sets (one for all calls,
+    and one per API key) and reserves slots with a Lua script, which Redis runs
+    atomically. Timestamps come from the Redis server clock, so the limits hold
+    exactly across every worker and every host sharing the same Redis (or
+    Redis-compatible) server.
+
+    Requires the redis package (pip install redis).
+
+    Args:
+        limits (Dict[str, Tuple[int, int]]): The global limits by name, as (window_seconds, limit).
+        redis_url (str): The url of the Redis server, e.g. redis://localhost:6379/0.
+        key (str): The key of the sorted set holding the usage. Per-key sets use key:<key_id>.
+        key_windows (Dict[str, int]) (optional): The windows of the per-key limits by name, in seconds.
+    """
+
+    # For each sorted set: trim expired calls and check its windows. Add the calls to every set only if all windows have room.
+    # ARGV is the longest window and the number of calls, then per set the number of windows followed by (window, limit) pairs, then a unique id.
+    RESERVE_SCRIPT = """
+        local now = redis.call('TIME')
+        local now_us = tonumber(now[1]) * 1000000 + tonumber(now[2])
+        local longest = tonumber(ARGV[1])
+        local amount = tonumber(ARGV[2])
+        local i = 3
+        for k = 1, #KEYS do
+            redis.call('ZREMRANGEBYSCORE', KEYS[k], '-inf', now_us - longest * 1000000)
+            local windows = tonumber(ARGV[i])
+            i = i + 1
+            for j = 1, windows do
+                local window = tonumber(ARGV[i])
+                local limit = tonumber(ARGV[i + 1])
+                i = i + 2
+                if redis.call('ZCOUNT', KEYS[k], '(' .. (now_us - window * 1000000), '+inf') + amount > limit then
+                    return 0
+                end
+            end
+        end
+        for k = 1, #KEYS do
+            for n = 1, amount do
+                redis.call('ZADD', KEYS[k], now_us, now_us .. '-' .. ARGV[#ARGV] .. '-' .. n)
+            end
+            redis.call('EXPIRE', KEYS[k], longest)
+        end
+        return 1
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[int, int]], redis_url: str, key: str = "proxygpt:api_usage", key_windows: Optional[Dict[str, int]] = None):
+        super().__init__(limits, key_windows)
+        try:
+            import redis
+        except ImportError:
+            raise Exception("The redis rate limit backend requires the redis package. Install it with: pip install redis")
+        self.client = redis.Redis.from_url(redis_url)
+        self.key = key
+        self.longest_window = self._longest_window()
+        self.reserve_script = self.client.register_script(self.RESERVE_SCRIPT)
+
+    def reserve(self, key_id: Optional[str] = None, key_limits: Optional[Dict[str, int]] = None, amount: int = 1) -> bool:
+        keys = [self.key]
+        args = [self.longest_window, amount, len(self.limits)]
+        for window, limit in self.limits.values():
+            args += [window, limit]
+        if key_id is not None:
+            key_limits = key_limits or {}
+            keys.append(self.key + ":" + key_id)
+            args.append(len(key_limits))
+            for name, limit in key_limits.items():
+                args += [self.key_windows[name], limit]
+        # The last argument makes the member unique for calls in the same microsecond
+        args.append(uuid.uuid4().hex)
+        return self.reserve_script(keys=keys, args=args) == 1
+
+    def release(self, key_id: Optional[str] = None, amount: int = 1) -> None:
+        pipeline = self.client.pipeline()
+        pipeline.zpopmax(self.key, amount)
+        if key_id is not None:
+            pipeline.zpopmax(self.key + ":" + key_id, amount)
+        pipeline.execute()
+
+    def retry_after(self, key_id: Optional[str] = None, key_limits: Optional[Dict[str, int]] = None, amount: int = 1) -> float:
+        windows = [(self.key, window, limit) for window, limit in self.limits.values()]
+        if key_id is not None and key_limits:
+            windows += [(self.key + ":" + key_id, self.key_windows[name], limit) for name, limit in key_limits.items()]
+        seconds, microseconds = self.client.time()
+        now_us = seconds * 1000000 + microseconds
+        wait = 0.0
+        for key, window, limit in windows:
+            if amount > limit:
+                wait = max(wait, float(window))
+                continue
+            # The calls above limit - amount have to expire, so wait for the newest of them
+            start = "(%d" % (now_us - window * 1000000)
+            excess = self.client.zcount(key, start, "+inf") - (limit - amount)
+            if excess <= 0:
+                continue
+            oldest = self.client.zrangebyscore(key, start, "+inf", start=excess - 1, num=1, withscores=True)
+            if oldest:
+                wait = max(wait, (oldest[0][1] + window * 1000000 - now_us) / 1000000)
+        return wait
+
+    def usage(self, name: str, key_id: Optional[str] = None) -> int:
+        if key_id is not None:
+            key, window = self.key + ":" + key_id, self.key_windows[name]
+        else:
+            key, (window, limit) = self.key, self.limits[name]
+        seconds, microseconds = self.client.time()
+        now_us = seconds * 1000000 + microseconds
+        return self.client.zcount(key, "(%d" % (now_us - window * 1000000), "+inf")
@@ -0,0 +1,389 @@
+"""
+Resilience.py file for ProxyGPT. This file contains the deadlines, retries, hedged requests and circuit breaker of upstream calls.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for timing out, hedging and backing off upstream calls
+import asyncio
+
+# Required for catching connection errors of the upstream client
+import aiohttp
+
+# Required for rounding up Retry-After
+import math
+
+# Required for the jitter of the backoff
+import random
+
+# Required for deadlines and latencies
+import time
+
+# Required for the recent latencies
+from collections import deque
+
+# Required for type hints
+from typing import Awaitable, Callable, Optional
+
+# Import the error raised when no upstream member can take a request, and the duration parser
+from upstream import UpstreamUnavailable, parse_duration
+
+
+# ------------- [Settings] -------------
+
+# Status codes of upstream responses worth retrying
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Errors of an upstream call worth retrying
+RETRYABLE_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, UpstreamUnavailable)
+
+
+# ------------- [Classes] -------------
+
+# Define the error raised when the deadline of a request passes
+class DeadlineExceeded(Exception):
+    """
+    Raised when the deadline of a request passes before upstream responded.
+    """
+
+
+# Define the error raised while the circuit breaker is open
+class CircuitOpen(Exception):
+    """
+    Raised without calling upstream while the circuit breaker is open.
+
+    Args:
+        retry_after (int): The seconds until the breaker lets a trial request through.
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__("Upstream is unavailable (circuit breaker open)")
+        self.retry_after = retry_after
+
+
+# Define the error raised when every attempt failed without a response
+class UpstreamFailed(Exception):
+    """
+    Raised when every attempt of an upstream call failed with a connection error.
+    """
+
+
+# Define the deadline of a request
+class Deadline:
+    """
+    The point in time by which a request must have its upstream response. It
+    is set once when the request arrives, and every wait on its way upstream
+    (admission queue, attempts, backoff) is bounded by the time remaining.
+
+    Args:
+        seconds (float): The seconds from now until the deadline.
+    """
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        """
+        This function returns the seconds until the deadline.
+
+        Returns:
+            float: The seconds remaining (0 once the deadline has passed).
+        """
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+
+# Define the circuit breaker
+class CircuitBreaker:
+    """
+    Fails upstream calls fast while upstream is unhealthy, instead of letting
+    every request wait for its own timeout. After failure_threshold
+    consecutive failed attempts (connection errors, timeouts and 5xx responses)
+    the breaker opens and rejects calls for reset_timeout seconds. It then lets
+    one trial call through (half open): the breaker closes if it succeeds, and
+    opens again if it fails. Rate limit responses (429) are handled by the
+    upstream pool and do not count either way.
+
+    Runs in the event loop of the worker, so it needs no locks.
+
+    Args:
+        failure_threshold (int): The consecutive failures that open the breaker.
+        reset_timeout (float): Seconds the breaker stays open before a trial call.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+        # Metrics
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self) -> None:
+        """
+        This function checks if an upstream call may be made.
+
+        Raises:
+            CircuitOpen: If the breaker is open, or its trial call is in flight.
+        """
+        if self.state == "open":
+            wait = self.opened_at + self.reset_timeout - time.monotonic()
+            if wait > 0:
+                self.rejected += 1
+                raise CircuitOpen(max(1, math.ceil(wait)))
+            self.state = "half_open"
+            self.trial_in_flight = False
+        if self.state == "half_open":
+            if self.trial_in_flight:
+                self.rejected += 1
+                raise CircuitOpen(1)
+            self.trial_in_flight = True
+
+    def record_success(self) -> None:
+        """
+        This function records a successful attempt, closing the breaker.
+        """
+        self.failures = 0
+        self.trial_in_flight = False
+        self.state = "closed"
+
+    def record_failure(self) -> None:
+        """
+        This function records a failed attempt, opening the breaker after too many.
+        """
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.opened += 1
+
+    def record_ignored(self) -> None:
+        """
+        This function records an attempt that says nothing about the health of
+        upstream (e.g. a 429 or a cancelled call), freeing the trial call.
+        """
+        self.trial_in_flight = False
+
+    def stats(self) -> dict:
+        """
+        This function returns the state and metrics of the breaker.
+
+        Returns:
+            dict: The state, consecutive failures, and the times opened and calls rejected.
+        """
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+
+# Define the caller making upstream calls with retries, hedging and the circuit breaker
+class ResilientCaller:
+    """
+    Makes upstream calls within the deadline of the request. An attempt that
+    fails with a connection error, a timeout, a 429 or a 5xx response is
+    retried up to max_attempts in total, after a backoff with full jitter
+    (a random delay up to backoff_base * 2^retry, at most backoff_max) or
+    the Retry-After of the failure if longer. Retries stop early when the
+    backoff would pass the deadline, and the last response is returned.
+
+    With hedging, a second attempt is started if the first has not responded
+    after the p95 latency of recent successful attempts (at least
+    hedge_min_delay seconds, and only once hedge_min_samples latencies are
+    known). The first good response wins and the other attempt is cancelled.
+    Hedging trades extra upstream calls for lower tail latency, so it is only
+    used for idempotent calls.
+
+    Args:
+        breaker (CircuitBreaker): The circuit breaker of the worker.
+        max_attempts (int): The maximum attempts of a call, including the first.
+        backoff_base (float): The backoff in seconds before the first retry.
+        backoff_max (float): The maximum backoff in seconds.
+        hedge_min_delay (float): The minimum seconds before a hedged attempt is started.
+        hedge_min_samples (int): The latencies needed before hedging starts.
+    """
+
+    def __init__(self, breaker: CircuitBreaker, max_attempts: int, backoff_base: float, backoff_max: float, hedge_min_delay: float, hedge_min_samples: int):
+        self.breaker = breaker
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.recent_latencies = deque(maxlen=1000)
+
+        # Metrics
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadline_exceeded = 0
+
+    async def call(self, attempt: Callable[[], Awaitable], deadline: Deadline, hedge: bool = False):
+        """
+        This function makes an upstream call with retries (and optionally
+        hedging) within the deadline.
+
+        Args:
+            attempt (Callable): The coroutine function making one attempt, returning a response with status_code and headers.
+            deadline (Deadline): The deadline of the request.
+            hedge (bool): Start a hedged attempt when the first one is slow.
+
+        Returns:
+            The response of the last attempt.
+
+        Raises:
+            CircuitOpen: If the breaker is open before the first attempt.
+            DeadlineExceeded: If the deadline passed before any response.
+            UpstreamUnavailable: If no upstream member could take the last attempt.
+            UpstreamFailed: If the last attempt failed with a connection error.
+        """
+        self.calls += 1
+        response = None
+        error = None
+        for attempt_number in range(self.max_attempts):
+            if attempt_number > 0:
+                self.retries += 1
+            # The deadline is checked first, so a half open breaker is only claimed by an attempt that runs
+            if deadline.remaining() <= 0:
+                break
+            # The breaker is checked before every attempt, but an earlier result is returned over its error
+            try:
+                self.breaker.allow()
+            except CircuitOpen:
+                if attempt_number == 0:
+                    raise
+                break
+
+            # The previous retryable response is only released once this attempt replaces it
+            if response is not None:
+                response.release()
+                response = None
+            try:
+                response, error = await self._attempt_round(attempt, deadline, hedge), None
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    return response
+                retry_after = parse_duration(response.headers.get("Retry-After") or response.headers.get("retry-after"))
+            except RETRYABLE_ERRORS as e:
+                response, error = None, e
+                retry_after = getattr(e, "retry_after", None)
+
+            # Back off with full jitter, or for the Retry-After of the failure if longer, within the deadline
+            if attempt_number + 1 == self.max_attempts:
+                break
+            delay = max(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt_number)), retry_after or 0)
+            if delay >= deadline.remaining():
+                break
+            try:
+                await asyncio.sleep(delay)
+            except BaseException:
+                if response is not None:
+                    response.release()
+                raise
+
+        if response is not None:
+            return response
+        if error is None or deadline.remaining() <= 0:
+            self.deadline_exceeded += 1
+            raise DeadlineExceeded()
+        if isinstance(error, UpstreamUnavailable):
+            raise error
+        raise UpstreamFailed(str(error) or type(error).__name__) from error
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        This function returns the seconds after which a hedged attempt is
+        started: the p95 latency of recent successful attempts.
+
+        Returns:
+            Optional[float]: The delay, or None while too few latencies are known.
+        """
+        if len(self.recent_latencies) < self.hedge_min_samples:
+            return None
+        latencies = sorted(self.recent_latencies)
+        return max(latencies[int(0.95 * (len(latencies) - 1))], self.hedge_min_delay)
+
+    def stats(self) -> dict:
+        """
+        This function returns the metrics of the upstream calls.
+
+        Returns:
+            dict: The calls, attempts, retries and hedges, and the state of the breaker.
+        """
+        hedge_delay = self.hedge_delay()
+        return {
+            "calls": self.calls,
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "deadline_exceeded": self.deadline_exceeded,
+            "hedge_delay_ms": round(hedge_delay * 1000, 3) if hedge_delay is not None else None,
+            "circuit_breaker": self.breaker.stats(),
+        }
+
+    async def _attempt_round(self, attempt: Callable[[], Awaitable], deadline: Deadline, hedge: bool):
+        # Make one attempt, plus a hedged attempt if the first is slower than the hedge delay
+        hedge_delay = self.hedge_delay() if hedge else None
+        if hedge_delay is None:
+            return await self._timed_attempt(attempt, deadline)
+
+        tasks = [asyncio.ensure_future(self._timed_attempt(attempt, deadline))]
+        returned = None
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=min(hedge_delay, deadline.remaining()))
+            if not done and deadline.remaining() > 0:
+                self.hedges += 1
+                tasks.append(asyncio.ensure_future(self._timed_attempt(attempt, deadline)))
+
+            # Return the first good response, or the last failure once every attempt has finished
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    returned = task
+                    if task.exception() is None and task.result().status_code not in RETRYABLE_STATUS_CODES:
+                        if len(tasks) > 1 and task is tasks[1]:
+                            self.hedge_wins += 1
+                        return task.result()
+            return returned.result()
+        finally:
+            # Cancel the attempts still running, and release the responses that were not returned
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif task is not returned and not task.cancelled() and task.exception() is None:
+                    task.result().release()
+
+    async def _timed_attempt(self, attempt: Callable[[], Awaitable], deadline: Deadline):
+        # Make one attempt within the deadline, recording its latency and outcome
+        self.attempts += 1
+        start_time = time.monotonic()
+        try:
+            response = await asyncio.wait_for(attempt(), timeout=deadline.remaining())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            self.breaker.record_ignored()
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        elif response.status_code == 429:
+            self.breaker.record_ignored()
+        else:
+            self.breaker.record_success()
+            self.recent_latencies.append(time.monotonic() - start_time)
+        return response
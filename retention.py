@@ -0,0 +1,242 @@
+"""
+Retention.py file for ProxyGPT. This file contains the retention and compaction subsystem for the API.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for timestamps
+import time
+
+# Required for the background compaction thread
+import threading
+
+# Required for type hints
+from typing import List, Optional
+
+# Import the shared storage layer
+from storage import get_connection, transaction, compress_logged_payloads
+
+# Required for printing styled log messages
+from utils import *
+
+
+# ------------- [Helper Functions] -------------
+
+# Function for getting the histogram bucket label of a latency
+def latency_bucket_label(response_time: float, boundaries: List[float]) -> str:
+    """
+    This function returns the label of the (non-cumulative) latency histogram
+    bucket a response time falls into, using Prometheus style upper bounds.
+
+    Args:
+        response_time (float): The response time in milliseconds.
+        boundaries (List[float]): The sorted upper bounds of the buckets in milliseconds.
+
+    Returns:
+        str: The upper bound of the bucket (e.g. "250"), or "+Inf".
+    """
+    for boundary in boundaries:
+        if response_time <= boundary:
+            return "%g" % boundary
+    return "+Inf"
+
+
+# ------------- [Classes] -------------
+
+# Define the retention compactor
+class RetentionCompactor:
+    """
+    Keeps the database bounded. Every interval, a background thread:
+
+    - deletes api_usage rows older than usage_ttl, in small batches;
+    - rolls api_logs rows older than logs_ttl into the per-hour aggregate tables
+      (api_logs_hourly and api_logs_hourly_latency) and deletes the raw rows, in
+      small batches with the rollup and delete in the same transaction;
+    - reclaims freed pages with an incremental vacuum;
+    - converts the payloads of api_logs rows written before migration 3 to
+      compressed JSON, in small batches, until none is left.
+
+    Each batch is its own short transaction, so requests are never blocked for
+    long, and running the compactor in several workers at once is safe.
+
+    Args:
+        usage_ttl (int): Seconds api_usage rows are kept (None to keep forever).
+        logs_ttl (int): Seconds raw api_logs rows are kept before roll up (None to keep forever).
+        interval (float): Seconds between compaction runs.
+        batch_size (int): Maximum number of rows deleted per transaction.
+        vacuum_pages (int): Maximum number of free pages reclaimed per run (0 to disable).
+        latency_buckets (List[float]): The upper bounds of the latency histogram in milliseconds.
+    """
+
+    def __init__(self, usage_ttl: Optional[int], logs_ttl: Optional[int], interval: float, batch_size: int, vacuum_pages: int, latency_buckets: List[float]):
+        self.usage_ttl = usage_ttl
+        self.logs_ttl = logs_ttl
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.latency_buckets = sorted(latency_buckets)
+        self.thread = None
+        self.stopping = threading.Event()
+        # The rowid up to which legacy payloads are converted, and whether any are left
+        self.compressed_up_to = 0
+        self.compressing = True
+
+        # Metrics
+        self.runs = 0
+        self.deleted_usage_rows = 0
+        self.rolled_up_log_rows = 0
+        self.compressed_log_rows = 0
+        self.last_run_ms = 0.0
+        self.last_error = None
+
+    def start(self) -> None:
+        """
+        This function starts the background compaction thread.
+        """
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name="proxygpt-retention", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """
+        This function stops the background compaction thread.
+
+        Args:
+            timeout (float): The maximum seconds to wait for a running batch to finish.
+        """
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def stats(self) -> dict:
+        """
+        This function returns the metrics of the compactor.
+
+        Returns:
+            dict: The number of runs, and deleted and rolled up row counts.
+        """
+        return {
+            "running": self.thread is not None,
+            "runs": self.runs,
+            "deleted_usage_rows": self.deleted_usage_rows,
+            "rolled_up_log_rows": self.rolled_up_log_rows,
+            "compressed_log_rows": self.compressed_log_rows,
+            "last_run_ms": self.last_run_ms,
+            "last_error": self.last_error,
+        }
+
+    def _run(self) -> None:
+        # Compact once per interval until stopped
+        while not self.stopping.wait(self.interval):
+            try:
+                self.compact()
+            except Exception as e:
+                self.last_error = str(e)
+                print(red_critical(f'[Critical] Retention compaction failed: {e}'))
+
+    def compact(self) -> None:
+        """
+        This function runs one full compaction: expired usage rows, roll up of
+        expired log rows, an incremental vacuum, and the conversion of legacy
+        log payloads.
+        """
+        start_time = time.time()
+        now = int(start_time)
+
+        if self.usage_ttl is not None:
+            while not self.stopping.is_set() and self.delete_expired_usage(now - self.usage_ttl) == self.batch_size:
+                pass
+
+        if self.logs_ttl is not None:
+            while not self.stopping.is_set() and self.roll_up_expired_logs(now - self.logs_ttl) == self.batch_size:
+                pass
+
+        if self.vacuum_pages > 0:
+            # executescript steps the pragma to completion (execute would free a single page)
+            get_connection().executescript("PRAGMA incremental_vacuum(%d);" % self.vacuum_pages)
+
+        while not self.stopping.is_set() and self.compressing:
+            converted, self.compressed_up_to = compress_logged_payloads(self.compressed_up_to, self.batch_size)
+            self.compressed_log_rows += converted
+            self.compressing = converted == self.batch_size
+
+        self.runs += 1
+        self.last_run_ms = round((time.time()-start_time)*1000, 3)
+
+    def delete_expired_usage(self, cutoff: int) -> int:
+        """
+        This function deletes one batch of api_usage rows at or before the cutoff.
+
+        Args:
+            cutoff (int): The timestamp at or before which rows are expired.
+
+        Returns:
+            int: The number of deleted rows.
+        """
+        with transaction() as conn:
+            c = conn.execute("DELETE FROM api_usage WHERE rowid IN (SELECT rowid FROM api_usage WHERE api_timestamp <= ? LIMIT ?)", (cutoff, self.batch_size))
+        self.deleted_usage_rows += c.rowcount
+        return c.rowcount
+
+    def roll_up_expired_logs(self, cutoff: int) -> int:
+        """
+        This function rolls one batch of api_logs rows at or before the cutoff
+        into the hourly aggregate tables, and deletes the raw rows in the same
+        transaction.
+
+        Args:
+            cutoff (int): The timestamp at or before which rows are expired.
+
+        Returns:
+            int: The number of rolled up rows.
+        """
+        with transaction() as conn:
+            rows = conn.execute("SELECT rowid, api_timestamp, response_time, response_code, sample_weight FROM api_logs WHERE api_timestamp <= ? ORDER BY api_timestamp LIMIT ?", (cutoff, self.batch_size)).fetchall()
+            if not rows:
+                return 0
+
+            # Aggregate the batch per hour and status code, counting sampled rows by their weight
+            hourly = {}
+            histogram = {}
+            for rowid, api_timestamp, response_time, response_code, sample_weight in rows:
+                hour = api_timestamp - api_timestamp % 3600
+                response_time = response_time or 0.0
+                aggregate = hourly.setdefault((hour, response_code), [0, 0.0, response_time, response_time])
+                aggregate[0] += sample_weight
+                aggregate[1] += response_time * sample_weight
+                aggregate[2] = min(aggregate[2], response_time)
+                aggregate[3] = max(aggregate[3], response_time)
+                bucket = (hour, response_code, latency_bucket_label(response_time, self.latency_buckets))
+                histogram[bucket] = histogram.get(bucket, 0) + sample_weight
+
+            # Merge the aggregates into the rollup tables
+            conn.executemany('''
+                INSERT INTO api_logs_hourly (hour, response_code, request_count, latency_sum, latency_min, latency_max)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (hour, response_code) DO UPDATE SET
+                    request_count = request_count + excluded.request_count,
+                    latency_sum = latency_sum + excluded.latency_sum,
+                    latency_min = MIN(latency_min, excluded.latency_min),
+                    latency_max = MAX(latency_max, excluded.latency_max)
+            ''', [(hour, code, values[0], values[1], values[2], values[3]) for (hour, code), values in hourly.items()])
+            conn.executemany('''
+                INSERT INTO api_logs_hourly_latency (hour, response_code, le, request_count)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (hour, response_code, le) DO UPDATE SET
+                    request_count = request_count + excluded.request_count
+            ''', [(hour, code, le, count) for (hour, code, le), count in histogram.items()])
+
+            # Delete the raw rows (and their payloads)
+            conn.executemany("DELETE FROM api_logs WHERE rowid = ?", [(row[0],) for row in rows])
+
+        self.rolled_up_log_rows += len(rows)
+        return len(rows)
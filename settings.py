@@ -7,12 +7,77 @@ Date: 2024-01-05
 License: MIT
 """
 
+# ------------- [Import Libraries] -------------
+
+# Required for the environment variable overrides (e.g. for benchmarks)
+import os
+
+
 # ------------- [Settings] -------------
 
 # Settings (Note: Both can be true and simultaneously active and enforced)
 USE_HOURLY_RATE_LIMIT = True # Set to False to disable hourly rate limit
 USE_DAILY_RATE_LIMIT = True # Set to False to disable daily rate limit
 
+"""
+Set the database settings here. ProxyGPT keeps one long-lived connection per
+thread in each worker, with the database in WAL mode so workers can read and
+write concurrently. STORAGE_BUSY_TIMEOUT is how long (in seconds) a write waits
+for another worker's transaction before failing.
+"""
+DATABASE_PATH = os.getenv("PROXYGPT_DATABASE_PATH", "proxygpt.db") # Path of the SQLite database file (PROXYGPT_DATABASE_PATH overrides it)
+STORAGE_BUSY_TIMEOUT = 10.0 # Seconds to wait for the write lock held by another worker
+STORAGE_CACHE_SIZE_KB = 16384 # Page cache size per connection in KiB
+STORAGE_MMAP_SIZE_MB = 256 # Memory-mapped I/O size per connection in MiB (0 to disable)
+STORAGE_STATEMENT_CACHE_SIZE = 128 # Number of prepared statements cached per connection
+
+"""
+Set the rate limit backend here. Every backend checks and counts a call in one
+atomic step ("reserving" it).
+- "memory": counts in memory with one bucket per RATE_LIMIT_BUCKET_SECONDS and
+  reads calls made by other workers at most once per RATE_LIMIT_SYNC_INTERVAL
+  seconds (default). Reserving never waits on the database, but with several
+  workers each one only sees the others' calls after a sync, so a burst can
+  overshoot a limit by up to the calls the other workers made in one interval.
+- "sqlite": exact across all workers sharing the database file, but every
+  call counts its windows in api_usage while holding the database write lock,
+  so the workers reserve one at a time.
+- "redis": exact across workers and hosts. Set PROXYGPT_REDIS_URL and install
+  the redis package.
+"""
+RATE_LIMIT_BACKEND = "memory" # One of "memory", "sqlite" or "redis"
+RATE_LIMIT_REDIS_KEY = "proxygpt:api_usage" # Redis key holding the usage (redis backend)
+RATE_LIMIT_BUCKET_SECONDS = 1 # Length of each rate limit counter bucket in seconds (memory backend)
+RATE_LIMIT_SYNC_INTERVAL = 1.0 # Seconds between reading usage logged by other workers (memory backend)
+
+"""
+Set the per-key rate limits here. They apply to each ProxyGPT API key on top
+of the global hourly and daily limits above, so one busy key cannot use up the
+budget of every other key. Keys are identified by their fingerprint (the first
+16 hex characters of the SHA-256 of the key), which /ratelimit shows as key_id,
+or which you can compute with:
+python -c "import hashlib; print(hashlib.sha256(b'<key>').hexdigest()[:16])"
+Keys not listed in PER_KEY_RATE_LIMITS use PER_KEY_DEFAULT_RATE_LIMITS. Use
+None for no per-key limit.
+"""
+PER_KEY_DEFAULT_RATE_LIMITS = {"hourly": None, "daily": None} # Limits of every key not listed below
+PER_KEY_RATE_LIMITS = {} # Limits by key fingerprint, e.g. {"9f86d081884c7d65": {"hourly": 100, "daily": 1000}}
+
+"""
+Set the token budget here. OpenAI also limits the tokens per minute, so with
+USE_TOKEN_BUDGET each request reserves its estimated tokens (prompt tokens
+plus TOKEN_BUDGET_COMPLETION_TOKENS) from a one minute sliding window before
+it is sent, and requests that would exceed PROXYGPT_TOKENS_PER_MINUTE get a
+429 with a Retry-After header without calling OpenAI. The reservation is then
+corrected to the usage reported by OpenAI. The budget is kept per worker, so
+divide your tokens per minute by the number of workers. "auto" counts tokens
+with tiktoken if it is installed, and estimates four characters per token
+otherwise.
+"""
+USE_TOKEN_BUDGET = False
+TOKEN_BUDGET_TOKENIZER = "auto" # One of "auto", "tiktoken" or "chars"
+TOKEN_BUDGET_COMPLETION_TOKENS = 256 # Completion tokens reserved per request until the actual usage is known
+
 """
 Set INSECURE_DEBUG to False to disable debug mode. When debug mode is off,
 server errors will no longer be passed through to the client, and instead 
@@ -24,14 +89,221 @@ INSECURE_DEBUG = True
 """
 Set the installed and used modules here. Removing a module from this list 
 will skip the import in main.py. Note some modules are dependent on others.
+PROXYGPT_INSTALLED_MODULES (comma separated, may be empty) overrides the list,
+e.g. to compare logging on and off in the benchmarks.
 """
 INSTALLED_MODULES = ["graphics","logging"]
+if os.getenv("PROXYGPT_INSTALLED_MODULES") is not None:
+    INSTALLED_MODULES = [module.strip() for module in os.getenv("PROXYGPT_INSTALLED_MODULES").split(",") if module.strip()]
+
+"""
+Set the logging policy here (used by the logging module). To keep database
+writes and growth in check under high traffic, fast successful requests (status
+below 400) can be sampled per upstream endpoint, e.g. {"*": 0.1, "embeddings":
+0.01}, and errors (status 400 and above) per status code or class, e.g.
+{"*": 1.0, "429": 0.05}; the most specific key wins and "*" is the default.
+Errors are kept by default, and requests at least LOG_SLOW_REQUEST_MS slow are
+always kept. Every logged row records its sample weight (1 / sample rate), so
+dashboard aggregates estimate the true request volume. Strings in logged
+payloads longer than LOG_MAX_FIELD_CHARS are truncated with a marker like
+"…[truncated 1234 chars]". Set LOG_PAYLOADS to "metadata" to only store the
+extracted fields (model, token usage, finish reason) and no payloads.
+"""
+LOG_SAMPLE_RATES = {"*": 1.0} # Fraction of fast successful requests logged, per upstream endpoint (e.g. "chat/completions")
+LOG_ERROR_SAMPLE_RATES = {"*": 1.0} # Fraction of error responses logged, per status code or class (e.g. "429" or "5xx")
+LOG_SLOW_REQUEST_MS = 5000 # Requests at least this slow (in milliseconds) are always logged (None to disable)
+LOG_MAX_FIELD_CHARS = 100000 # Maximum characters of each string in logged payloads (None for no limit)
+LOG_PAYLOADS = "full" # One of "full" or "metadata"
+
+"""
+Set the upstream connection pool settings here. Each worker keeps one shared
+keep-alive pool to OpenAI, opened and closed with the app lifespan. Timeouts
+are in seconds. Set UPSTREAM_POOL_SIZE_PER_HOST to 0 for no per-host limit.
+"""
+UPSTREAM_POOL_SIZE = 500 # Maximum number of open upstream connections per worker
+UPSTREAM_POOL_SIZE_PER_HOST = 0 # Maximum number of open connections per upstream host
+UPSTREAM_CONNECT_TIMEOUT = 10 # Seconds to wait for a connection to be established
+UPSTREAM_TOTAL_TIMEOUT = 600 # Seconds to wait for a complete upstream response
+UPSTREAM_KEEPALIVE_TIMEOUT = 60 # Seconds an idle upstream connection is kept open for reuse
+
+"""
+Set the upstream pool settings here. With several OpenAI keys in
+OPENAI_API_KEYS (and optionally their base urls in OPENAI_API_BASES), each
+upstream call goes to the key with the fewest outstanding requests. A key that
+gets a 429, or reports no remaining requests or tokens, is left out until its
+Retry-After or x-ratelimit-reset-* headers say it has reset, or for
+UPSTREAM_DEFAULT_COOLDOWN seconds if it sends neither. Both are kept per worker.
+"""
+UPSTREAM_MEMBER_CAPACITY = None # Maximum outstanding requests per OpenAI key and worker (None for no limit)
+UPSTREAM_DEFAULT_COOLDOWN = 10 # Seconds a key is left out after a 429 without rate limit headers
+
+"""
+Set the resilience settings of upstream calls here. Each request has a
+deadline of RESILIENCE_DEADLINE seconds (clients may shorten it with the
+X-ProxyGPT-Timeout header), which bounds its wait for admission, its attempts
+and its backoffs; a request without a response by then gets a 504. Calls that
+fail with a connection error, a timeout, a 429 or a 5xx are retried (up to
+RESILIENCE_MAX_ATTEMPTS in total) after a jittered exponential backoff. With
+RESILIENCE_HEDGE, a completion that is slower than the recent p95 latency gets
+a second, hedged call and the first response wins (this costs extra tokens).
+After RESILIENCE_BREAKER_FAILURES consecutive failures the circuit breaker
+rejects calls with a 503 for RESILIENCE_BREAKER_RESET seconds, then lets one
+trial call through. All of these are kept per worker.
+"""
+RESILIENCE_DEADLINE = 120 # Default seconds a request may take to get its upstream response
+RESILIENCE_MAX_ATTEMPTS = 3 # Maximum attempts of an upstream call, including the first (1 for no retries)
+RESILIENCE_BACKOFF_BASE = 0.5 # Maximum seconds of the jittered backoff before the first retry, doubled for each retry
+RESILIENCE_BACKOFF_MAX = 8 # Maximum seconds of the jittered backoff
+RESILIENCE_HEDGE = False # Send a hedged call for slow completions
+RESILIENCE_HEDGE_MIN_DELAY = 1 # Minimum seconds before a hedged call is sent
+RESILIENCE_HEDGE_MIN_SAMPLES = 20 # Latencies needed to compute the p95 before hedging starts
+RESILIENCE_BREAKER_FAILURES = 5 # Consecutive failed calls that open the circuit breaker
+RESILIENCE_BREAKER_RESET = 30 # Seconds the circuit breaker stays open before a trial call
+
+"""
+Set the admission control settings here. Each worker makes at most
+ADMISSION_MAX_CONCURRENCY upstream calls at once (None for no limit). Further
+requests wait in a queue, lowest priority value first, for at most
+ADMISSION_QUEUE_TIMEOUT seconds. Requests are rejected at once with a 503 and a
+Retry-After header when ADMISSION_MAX_QUEUE requests are already waiting, or
+when their wait times out. Requests are admitted before their rate limit is
+reserved, so rejected requests are not counted. Priorities are set by key
+fingerprint (see PER_KEY_RATE_LIMITS).
+"""
+ADMISSION_MAX_CONCURRENCY = 200 # Maximum number of concurrent upstream calls per worker
+ADMISSION_MAX_QUEUE = 500 # Maximum number of requests waiting for an upstream call per worker
+ADMISSION_QUEUE_TIMEOUT = 10 # Maximum seconds a request waits for an upstream call
+ADMISSION_DEFAULT_PRIORITY = 10 # Priority of every key not listed below (lower is admitted first)
+ADMISSION_KEY_PRIORITIES = {} # Priorities by key fingerprint, e.g. {"9f86d081884c7d65": 0}
+
+"""
+Set the OpenAI endpoints available through the raw passthrough route here.
+A request to /api/openai/v1/<path> is forwarded unchanged to
+https://api.openai.com/v1/<path> if <path> is in this list, with only the
+Authorization header replaced. Set to an empty list to disable the route.
+"""
+PASSTHROUGH_ENDPOINTS = ["chat/completions", "completions", "embeddings", "moderations"]
+
+"""
+Set the batch completion settings here. /api/openai/completions/gpt3/batch
+takes up to BATCH_MAX_SIZE chat requests in one call, checks the API key and
+reserves the rate limit for all of them at once, and calls upstream for at
+most BATCH_MAX_CONCURRENCY of them at a time (each call still waits for an
+admission slot and has its own deadline).
+"""
+BATCH_MAX_SIZE = 1000 # Maximum number of chat requests in one batch
+BATCH_MAX_CONCURRENCY = 8 # Maximum number of upstream calls in flight per batch
+
+"""
+Set the background log writer settings here. Log rows are queued in memory and
+written by a background thread in batches of up to LOG_WRITER_BATCH_SIZE rows
+(one transaction per batch), at least every LOG_WRITER_FLUSH_INTERVAL seconds.
+When more than LOG_WRITER_QUEUE_SIZE rows are pending, new rows are dropped
+(and counted in /stats) rather than slowing down requests.
+"""
+LOG_WRITER_QUEUE_SIZE = 10000 # Maximum number of pending log writes per worker
+LOG_WRITER_BATCH_SIZE = 500 # Maximum number of rows written in one transaction
+LOG_WRITER_FLUSH_INTERVAL = 0.5 # Maximum seconds a row waits before it is written
+
+"""
+Set the compression of logged request and response payloads here. Payloads are
+stored as compressed JSON and only decompressed when a single log is viewed.
+"auto" uses zstd if the zstandard package is installed, and zlib otherwise.
+"""
+LOG_PAYLOAD_COMPRESSION = "auto" # One of "auto", "zstd" or "zlib"
+
+"""
+Set the dashboard refresh settings here. An open dashboard only fetches what
+changed since its last refresh: the dashboard data endpoints return an ETag
+(the range of log ids) and answer If-None-Match with a 304 while no logs were
+written, and accept a since cursor to return only new logs and the aggregate
+buckets they changed. With DASHBOARD_LIVE_FEED, new log summaries are pushed
+to the dashboard over Server-Sent Events (/dashboard-data/stream) instead.
+"""
+DASHBOARD_REFRESH_INTERVAL = 15 # Seconds between the refreshes of an open dashboard when the live feed is off or unavailable
+DASHBOARD_LIVE_FEED = True # Push new log summaries to open dashboards over Server-Sent Events
+DASHBOARD_LIVE_FEED_INTERVAL = 2 # Seconds between the checks of the live feed for new logs
+DASHBOARD_LIVE_FEED_MAX_LOGS = 100 # Maximum logs sent in one live feed event
+
+"""
+Set the retention settings here. Every RETENTION_INTERVAL seconds, api_usage
+rows older than RETENTION_API_USAGE_TTL seconds are deleted (only the last day
+is needed for rate limits), and api_logs rows older than RETENTION_API_LOGS_TTL
+seconds are rolled up into hourly aggregates (count, latency sum/min/max and a
+latency histogram per status code) before their payloads are deleted. Set a TTL
+to None to keep rows forever.
+"""
+RETENTION_API_USAGE_TTL = 90000 # Seconds api_usage rows are kept (25 hours)
+RETENTION_API_LOGS_TTL = 2592000 # Seconds raw api_logs rows are kept (30 days)
+RETENTION_INTERVAL = 60 # Seconds between compaction runs
+RETENTION_BATCH_SIZE = 1000 # Maximum number of rows deleted per transaction
+RETENTION_VACUUM_PAGES = 1000 # Maximum number of free pages reclaimed per run (0 to disable)
+RETENTION_LATENCY_BUCKETS_MS = [100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000] # Upper bounds of the latency histogram
+
+"""
+Set the response cache settings here (add "cache" to INSTALLED_MODULES to use
+it). Non-streaming completion requests with a temperature of at most
+CACHE_MAX_TEMPERATURE are cached by a hash of their model, messages and
+temperature. Each worker keeps an in-memory LRU tier; set CACHE_PERSISTENT to
+True to also share entries between workers and restarts in the database.
+"""
+CACHE_MAX_ENTRIES = 1000 # Maximum number of responses kept in memory per worker
+CACHE_MAX_BYTES = 64 * 1024 * 1024 # Maximum total size of the responses kept in memory per worker
+CACHE_TTL = 3600 # Seconds a cached response is served before it expires
+CACHE_PERSISTENT = False # Also store cached responses in the database
+CACHE_PERSISTENT_MAX_ENTRIES = 100000 # Maximum number of responses kept in the database
+CACHE_MAX_TEMPERATURE = 0.0 # Requests with a higher temperature are never cached
+CACHE_HITS_CONSUME_RATE_LIMIT = False # Count cache hits against the hourly and daily rate limits
+
+"""
+Set the request coalescing settings here. Concurrent identical non-streaming
+completion requests (same model, messages and temperature) share one upstream
+call, and the response is returned to all of them. With COALESCE_ACROSS_WORKERS,
+requests in different gunicorn workers are also coalesced through a lock table
+in the database. COALESCE_ACCOUNTING sets how coalesced requests are counted:
+"per_request" reserves rate limit and logs every request, "leader_only" only
+the request that called upstream. Set COALESCE_MAX_TEMPERATURE to only coalesce
+requests up to that temperature (None for any temperature).
+"""
+COALESCE_REQUESTS = True # Share one upstream call between concurrent identical requests
+COALESCE_MAX_TEMPERATURE = None # Requests with a higher temperature are never coalesced (None for no limit)
+COALESCE_ACCOUNTING = "per_request" # One of "per_request" or "leader_only"
+COALESCE_ACROSS_WORKERS = False # Also coalesce requests of other workers through the database
+COALESCE_LOCK_TIMEOUT = 120 # Seconds a worker holds the lock of a request at most
+COALESCE_POLL_INTERVAL = 0.05 # Seconds between polls for the response of another worker
+COALESCE_RESULT_TTL = 2 # Seconds a response is kept for the workers still polling
+
+"""
+Set the Prometheus metrics settings here (add "metrics" to INSTALLED_MODULES
+and pip install prometheus_client to use it). /metrics exposes request counts
+and latencies, and the time spent in each phase of a request (auth,
+rate_limit, admission, token_budget, upstream, serialization, log_write and
+db_write). With gunicorn, gunicorn.conf.py collects the metrics of every
+worker in METRICS_MULTIPROCESS_DIR, which is cleared on startup.
+"""
+METRICS_LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60] # Upper bounds (in seconds) of the latency histograms
+METRICS_MULTIPROCESS_DIR = "/tmp/proxygpt-metrics" # Directory of the metric files of the gunicorn workers
+
+"""
+Set the full-text search settings here (add "search" to INSTALLED_MODULES to
+use it, which needs SQLite with FTS5). A background thread in each worker
+indexes the prompts and completions of new API logs every SEARCH_INDEX_INTERVAL
+seconds, in batches, so requests never wait for indexing. /logs/search returns
+ranked matches with highlighted snippets. Logs written before the module was
+installed are indexed in the background too; run
+python manage.py rebuild-search-index to index them at once, or to rebuild the
+index after changing SEARCH_MAX_TEXT_CHARS.
+"""
+SEARCH_INDEX_INTERVAL = 1 # Seconds between the runs of the search indexer
+SEARCH_INDEX_BATCH_SIZE = 500 # Maximum number of logs indexed per transaction
+SEARCH_MAX_TEXT_CHARS = 20000 # Maximum characters indexed of each prompt and completion
+SEARCH_SNIPPET_TOKENS = 16 # Approximate number of words in each snippet (at most 64)
 
 
 # ------------- [Checks] -------------
 
 # Check the dependencies of the installed modules
-dependencies = {"graphics":["logging"],"logging":[]}
+dependencies = {"graphics":["logging"],"logging":[],"cache":[],"metrics":[],"search":["logging"]}
 
 # Add the dependencies
 for module in INSTALLED_MODULES:
@@ -0,0 +1,310 @@
+"""
+Storage.py file for ProxyGPT. This file contains the shared SQLite storage layer for the API.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the database
+import sqlite3
+
+# Required for migrating logged payloads to JSON
+import json
+
+# Required for one long-lived connection per thread (and per worker process)
+import os
+import threading
+
+# Required for the transaction helper
+from contextlib import contextmanager
+
+# Required for type hints
+from typing import Tuple
+
+# Required for migrating logged payloads (stored as Python reprs before migration 3)
+import ast
+
+# Import the payload encoding used by migration 3
+from payloads import encode_payload, extract_payload_fields
+
+# Required for printing styled log messages
+from utils import *
+
+# Import the storage settings
+from settings import DATABASE_PATH, STORAGE_BUSY_TIMEOUT, STORAGE_CACHE_SIZE_KB, STORAGE_MMAP_SIZE_MB, STORAGE_STATEMENT_CACHE_SIZE
+
+
+# ------------- [Migrations] -------------
+
+# Function for converting a batch of logged payloads to compressed JSON
+def compress_logged_payloads(after_rowid: int = 0, batch_size: int = 1000) -> Tuple[int, int]:
+    """
+    This function converts one batch of api_logs rows written before migration
+    3, whose request (a Python repr) and response_str are still TEXT columns,
+    into compressed JSON blobs with the extracted columns filled, and clears the
+    old TEXT columns. Each batch is its own short transaction, so the conversion
+    never holds the write lock for long and resumes where it stopped: converted
+    rows no longer match, and after_rowid skips the rows already checked. It
+    runs in the background of the retention compactor, or all at once with
+    python manage.py compress-logs.
+
+    Args:
+        after_rowid (int): Only convert rows with a rowid above this one.
+        batch_size (int): Maximum number of rows converted per transaction.
+
+    Returns:
+        Tuple[int, int]: The number of converted rows (0 once no row is left) and the rowid of the last one.
+    """
+
+    with transaction() as conn:
+        rows = conn.execute("SELECT rowid, request, response_str FROM api_logs WHERE rowid > ? AND (request IS NOT NULL OR response_str IS NOT NULL) ORDER BY rowid LIMIT ?", (after_rowid, batch_size)).fetchall()
+        if not rows:
+            return 0, after_rowid
+
+        updates = []
+        for rowid, request, response_str in rows:
+            # Requests were logged with str(payload), so read them back as Python literals
+            try:
+                request = ast.literal_eval(request) if request is not None else None
+            except (ValueError, SyntaxError):
+                pass
+            # Responses were logged as the response text, which is usually JSON already
+            try:
+                response = json.loads(response_str) if response_str is not None else None
+            except ValueError:
+                response = response_str
+
+            request_encoding, request_blob = encode_payload(request)
+            response_encoding, response_blob = encode_payload(response)
+            fields = extract_payload_fields(request, response)
+            updates.append((request_encoding or response_encoding, request_blob, response_blob, fields["model"], fields["message_count"], fields["prompt_tokens"], fields["completion_tokens"], fields["finish_reason"], rowid))
+
+        conn.executemany('''
+            UPDATE api_logs SET payload_encoding = ?, request_blob = ?, response_blob = ?, model = ?, message_count = ?,
+                prompt_tokens = ?, completion_tokens = ?, finish_reason = ?, request = NULL, response_str = NULL
+            WHERE rowid = ?
+        ''', updates)
+
+    return len(rows), rows[-1][0]
+
+"""
+Versioned schema migrations. Each entry is (version, description, steps), where
+a step is either an SQL statement or a function taking the connection. The
+applied version is stored in PRAGMA user_version, and migrations are only ever
+appended, never edited once released.
+"""
+MIGRATIONS = [
+    (1, "Create api_usage and api_logs with timestamp indexes", [
+        '''CREATE TABLE IF NOT EXISTS api_usage
+                (api_timestamp integer)''',
+        '''CREATE TABLE IF NOT EXISTS api_logs (
+                api_timestamp INTEGER,
+                response_time FLOAT,
+                response_code INTEGER,
+                endpoint TEXT,
+                request TEXT,
+                response_str TEXT
+            )''',
+        "CREATE INDEX IF NOT EXISTS api_usage_timestamp ON api_usage (api_timestamp)",
+        "CREATE INDEX IF NOT EXISTS api_logs_timestamp ON api_logs (api_timestamp)",
+    ]),
+    (2, "Create the hourly rollup tables for expired api_logs", [
+        '''CREATE TABLE IF NOT EXISTS api_logs_hourly (
+                hour INTEGER,
+                response_code INTEGER,
+                request_count INTEGER,
+                latency_sum FLOAT,
+                latency_min FLOAT,
+                latency_max FLOAT,
+                PRIMARY KEY (hour, response_code)
+            )''',
+        '''CREATE TABLE IF NOT EXISTS api_logs_hourly_latency (
+                hour INTEGER,
+                response_code INTEGER,
+                le TEXT,
+                request_count INTEGER,
+                PRIMARY KEY (hour, response_code, le)
+            )''',
+    ]),
+    (3, "Store api_logs payloads as compressed JSON with extracted columns", [
+        "ALTER TABLE api_logs ADD COLUMN payload_encoding TEXT",
+        "ALTER TABLE api_logs ADD COLUMN request_blob BLOB",
+        "ALTER TABLE api_logs ADD COLUMN response_blob BLOB",
+        "ALTER TABLE api_logs ADD COLUMN model TEXT",
+        "ALTER TABLE api_logs ADD COLUMN message_count INTEGER",
+        "ALTER TABLE api_logs ADD COLUMN prompt_tokens INTEGER",
+        "ALTER TABLE api_logs ADD COLUMN completion_tokens INTEGER",
+        "ALTER TABLE api_logs ADD COLUMN finish_reason TEXT",
+        # Existing rows are converted in batches after startup (see compress_logged_payloads)
+    ]),
+    (4, "Create the persistent tier of the response cache", [
+        '''CREATE TABLE IF NOT EXISTS response_cache (
+                cache_key TEXT PRIMARY KEY,
+                expires_at FLOAT,
+                body BLOB
+            )''',
+        "CREATE INDEX IF NOT EXISTS response_cache_expires_at ON response_cache (expires_at)",
+    ]),
+    (5, "Create the lock table for coalescing requests across workers", [
+        '''CREATE TABLE IF NOT EXISTS inflight_requests (
+                request_key TEXT PRIMARY KEY,
+                owner INTEGER,
+                status_code INTEGER,
+                body BLOB,
+                expires_at FLOAT
+            )''',
+        "CREATE INDEX IF NOT EXISTS inflight_requests_expires_at ON inflight_requests (expires_at)",
+    ]),
+    (6, "Record the API key of each api_usage row for per-key rate limits", [
+        "ALTER TABLE api_usage ADD COLUMN key_id TEXT",
+        "CREATE INDEX IF NOT EXISTS api_usage_key_timestamp ON api_usage (key_id, api_timestamp)",
+    ]),
+    (7, "Record the sample weight of each api_logs row for sampled logging", [
+        "ALTER TABLE api_logs ADD COLUMN sample_weight REAL NOT NULL DEFAULT 1",
+    ]),
+]
+
+
+# ------------- [Connections] -------------
+
+# Thread-local storage holding the long-lived connection of each thread
+_local = threading.local()
+
+# Function for opening a new tuned connection
+def open_connection(check_same_thread: bool = True) -> sqlite3.Connection:
+    """
+    This function opens a new connection to the database with the tuned pragmas.
+    Most code should use get_connection instead, which reuses the connection of
+    the current thread.
+
+    The connection is in autocommit mode; use transaction() to group writes.
+
+    Args:
+        check_same_thread (bool): Only allow the connection in the thread that
+            opened it. Disable it for a dedicated connection used by one thread at
+            a time, e.g. a streamed response whose chunks are read in the threadpool.
+
+    Returns:
+        sqlite3.Connection: The new connection.
+    """
+
+    conn = sqlite3.connect(
+        DATABASE_PATH,
+        timeout=STORAGE_BUSY_TIMEOUT,
+        isolation_level=None,
+        cached_statements=STORAGE_STATEMENT_CACHE_SIZE,
+        check_same_thread=check_same_thread,
+    )
+    conn.execute("PRAGMA busy_timeout = %d" % int(STORAGE_BUSY_TIMEOUT * 1000))
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -%d" % STORAGE_CACHE_SIZE_KB)
+    conn.execute("PRAGMA mmap_size = %d" % (STORAGE_MMAP_SIZE_MB * 1024 * 1024))
+    return conn
+
+# Function for getting the connection of the current thread
+def get_connection() -> sqlite3.Connection:
+    """
+    This function returns the long-lived connection of the current thread,
+    opening it on first use. Connections are never shared between threads or
+    inherited across a fork, so each gunicorn worker gets its own.
+
+    Statements are cached (prepared once) per connection by the sqlite3 module,
+    so callers should pass constant SQL strings with parameters.
+
+    Returns:
+        sqlite3.Connection: The connection of the current thread.
+    """
+
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = open_connection()
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+# Function for running writes in one transaction
+@contextmanager
+def transaction():
+    """
+    This function opens an immediate transaction on the connection of the
+    current thread, committing on success and rolling back on error. The write
+    lock is taken at the start, so reads inside the transaction cannot be
+    invalidated by another worker.
+
+    Yields:
+        sqlite3.Connection: The connection holding the transaction.
+    """
+
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+# ------------- [Functions] -------------
+
+# Function for migrating the database to the latest schema
+def migrate() -> int:
+    """
+    This function switches the database to WAL mode and applies every pending
+    migration, each in its own transaction. It is safe to run from several
+    workers at once, since the version is checked after taking the write lock.
+
+    Returns:
+        int: The schema version of the database.
+    """
+
+    conn = get_connection()
+
+    # Incremental auto vacuum lets the retention compactor reclaim space. It must be set before the first
+    # table is created. An existing database needs a full VACUUM, which is not run here: every worker
+    # migrates at import, and concurrent VACUUMs would fail on the lock (see enable_incremental_vacuum).
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        else:
+            print(yellow_warning("[Warning] The database does not use incremental auto vacuum, so the retention compactor cannot return freed pages to the OS. Run python manage.py vacuum (preferably while ProxyGPT is stopped) to convert it once."))
+
+    # WAL lets readers and the writer work concurrently. It is persistent, and cannot be changed inside a transaction.
+    conn.execute("PRAGMA journal_mode = WAL")
+
+    for version, description, steps in MIGRATIONS:
+        with transaction() as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute("PRAGMA user_version = %d" % version)
+
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+# Function for converting an existing database to incremental auto vacuum
+def enable_incremental_vacuum() -> bool:
+    """
+    This function converts an existing database to incremental auto vacuum with
+    a full VACUUM, which rewrites the whole file and needs the database to
+    itself for its duration. It is run from manage.py, never at startup.
+
+    Returns:
+        bool: True if the database was converted, False if it already was.
+    """
+
+    conn = get_connection()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
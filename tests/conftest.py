@@ -0,0 +1,26 @@
+"""
+Conftest.py file for ProxyGPT. This file contains the shared setup of the tests.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the environment and the import path
+import os
+import sys
+
+# Required for a throwaway database
+import tempfile
+
+
+# ------------- [Setup] -------------
+
+# Use a throwaway database (set before settings.py is imported)
+os.environ.setdefault("PROXYGPT_DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "proxygpt-test.db"))
+
+# Import the modules of ProxyGPT from the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,75 @@
+"""
+Test_batchwriter.py file for ProxyGPT. This file contains the tests of the background batched writer.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the tests
+import threading
+import pytest
+
+# Import the storage layer and the batched writer
+import storage
+from batchwriter import BatchWriter
+
+
+# ------------- [Fixtures] -------------
+
+@pytest.fixture
+def writer(tmp_path, monkeypatch):
+    """
+    This fixture points the storage layer at an empty database with a test
+    table, and returns a batch writer that has not been started.
+    """
+    monkeypatch.setattr(storage, "DATABASE_PATH", str(tmp_path / "writer.db"))
+    monkeypatch.setattr(storage, "_local", threading.local())
+    storage.get_connection().execute("CREATE TABLE rows (value INTEGER)")
+    return BatchWriter(max_queue_size=100, batch_size=10, flush_interval=0.05)
+
+
+# ------------- [Tests] -------------
+
+def test_deferred_rows_are_built_by_the_writer_thread(writer):
+    built_by = []
+    def build(value):
+        built_by.append(threading.current_thread().name)
+        return (value,)
+
+    writer.start()
+    try:
+        assert writer.submit_many("INSERT INTO rows VALUES (?)", [(1,), lambda: build(2), lambda: None])
+    finally:
+        writer.stop()
+
+    assert built_by == ["proxygpt-batch-writer"]
+    assert [row[0] for row in storage.get_connection().execute("SELECT value FROM rows ORDER BY value")] == [1, 2]
+    assert writer.stats()["written_rows"] == 2
+
+
+def test_deferred_row_errors_are_counted_as_failed(writer):
+    def fail():
+        raise ValueError("broken payload")
+
+    writer.submit_many("INSERT INTO rows VALUES (?)", [fail, (3,)])
+
+    assert [row[0] for row in storage.get_connection().execute("SELECT value FROM rows")] == [3]
+    assert writer.stats()["failed_rows"] == 1
+
+
+def test_deletes_run_after_the_rows_queued_before_them(writer):
+    writer.start()
+    try:
+        writer.submit("INSERT INTO rows VALUES (?)", (1,))
+        writer.submit("DELETE FROM rows WHERE value = ?", (1,))
+        writer.submit("INSERT INTO rows VALUES (?)", (1,))
+        writer.submit("INSERT INTO rows VALUES (?)", (2,))
+    finally:
+        writer.stop()
+
+    assert [row[0] for row in storage.get_connection().execute("SELECT value FROM rows ORDER BY value")] == [1, 2]
+    assert writer.stats()["batches"] == 1
@@ -0,0 +1,165 @@
+"""
+Test_coalesce.py file for ProxyGPT. This file contains the tests of the request coalescer.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for running the coalescer
+import asyncio
+
+# Required for the tests
+import threading
+import time
+import pytest
+
+# Import the storage layer, the request coalescer and the deadlines
+import storage
+from coalesce import RequestCoalescer, LeaderRejected
+from resilience import Deadline, DeadlineExceeded
+from upstream import UpstreamResponse
+
+
+# ------------- [Fixtures] -------------
+
+@pytest.fixture
+def shared_database(tmp_path, monkeypatch):
+    """
+    This fixture points the storage layer at a new migrated database, shared
+    by the coalescers of every simulated worker.
+    """
+    monkeypatch.setattr(storage, "DATABASE_PATH", str(tmp_path / "coalesce.db"))
+    monkeypatch.setattr(storage, "_local", threading.local())
+    storage.migrate()
+
+
+# ------------- [Helper Functions] -------------
+
+# Function for creating a coalescer within one worker
+def make_coalescer() -> RequestCoalescer:
+    return RequestCoalescer(across_workers=False, lock_timeout=10, poll_interval=0.01, result_ttl=1)
+
+# Function for creating the coalescer of one of several workers sharing the database
+def make_worker_coalescer() -> RequestCoalescer:
+    return RequestCoalescer(across_workers=True, lock_timeout=10, poll_interval=0.01, result_ttl=1)
+
+# Function for creating an upstream call answering after a delay
+def make_slow_call(calls: list, delay: float):
+    async def call():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return UpstreamResponse(status_code=200, headers={}, body=b'{"answer": 42}')
+    return call
+
+
+# ------------- [Tests] -------------
+
+def test_followers_share_the_response_of_the_leader():
+    async def scenario():
+        coalescer = make_coalescer()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "response"
+
+        results = await asyncio.gather(*(coalescer.run("key", call) for _ in range(3)))
+        return calls, results
+
+    calls, results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert sorted(called for _, called in results) == [False, False, True]
+    assert all(response == "response" for response, _ in results)
+
+def test_rejected_leader_does_not_share_its_error():
+    async def scenario():
+        coalescer = make_coalescer()
+        started = asyncio.Event()
+
+        async def rejected_call():
+            started.set()
+            await asyncio.sleep(0.05)
+            raise LeaderRejected(ValueError("over the rate limit of the leader's key"))
+
+        async def follower_call():
+            return "follower response"
+
+        leader = asyncio.ensure_future(coalescer.run("key", rejected_call))
+        await started.wait()
+        follower = asyncio.ensure_future(coalescer.run("key", follower_call))
+
+        with pytest.raises(ValueError):
+            await leader
+        return await follower, coalescer.stats()
+
+    (response, called), stats = asyncio.run(scenario())
+    assert (response, called) == ("follower response", True)
+    assert stats["leaders"] == 2 and stats["in_flight"] == 0
+
+def test_upstream_errors_are_shared():
+    async def scenario():
+        coalescer = make_coalescer()
+
+        async def failing_call():
+            await asyncio.sleep(0.05)
+            raise RuntimeError("upstream failed")
+
+        return await asyncio.gather(coalescer.run("key", failing_call), coalescer.run("key", failing_call), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+def test_followers_stop_waiting_at_their_deadline():
+    async def scenario():
+        coalescer = make_coalescer()
+        calls = []
+        leader = asyncio.ensure_future(coalescer.run("key", make_slow_call(calls, 0.3)))
+        await asyncio.sleep(0.01)
+
+        start_time = time.monotonic()
+        with pytest.raises(DeadlineExceeded):
+            await coalescer.run("key", make_slow_call(calls, 0.3), Deadline(0.05))
+        waited = time.monotonic() - start_time
+        return waited, await leader, calls
+
+    waited, (response, called), calls = asyncio.run(scenario())
+    assert waited < 0.2
+    assert called and len(calls) == 1
+
+def test_followers_in_other_workers_get_the_published_response(shared_database):
+    async def scenario():
+        leader_worker, follower_worker = make_worker_coalescer(), make_worker_coalescer()
+        calls = []
+        leader = asyncio.ensure_future(leader_worker.run("key", make_slow_call(calls, 0.1)))
+        await asyncio.sleep(0.05)
+        follower = await follower_worker.run("key", make_slow_call(calls, 0.1), Deadline(5))
+        return await leader, follower, follower_worker.stats(), calls
+
+    (leader_response, leader_called), (response, called), stats, calls = asyncio.run(scenario())
+    assert leader_called and not called and len(calls) == 1
+    assert response.status_code == 200 and response.content == b'{"answer": 42}'
+    assert stats["coalesced_across_workers"] == 1
+
+def test_followers_in_other_workers_stop_polling_at_their_deadline(shared_database):
+    async def scenario():
+        leader_worker, follower_worker = make_worker_coalescer(), make_worker_coalescer()
+        calls = []
+        leader = asyncio.ensure_future(leader_worker.run("key", make_slow_call(calls, 0.5)))
+        await asyncio.sleep(0.05)
+
+        start_time = time.monotonic()
+        with pytest.raises(DeadlineExceeded):
+            await follower_worker.run("key", make_slow_call(calls, 0.5), Deadline(0.1))
+        waited = time.monotonic() - start_time
+        await leader
+        return waited, follower_worker.stats(), calls
+
+    waited, stats, calls = asyncio.run(scenario())
+    assert waited < 0.4
+    assert len(calls) == 1
+    assert stats["in_flight"] == 0 and stats["leaders"] == 0
@@ -0,0 +1,49 @@
+"""
+Test_payloads.py file for ProxyGPT. This file contains the tests of the logged payload encoding.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the tests
+import json
+
+# Import the payload encoding and the logging module
+from payloads import truncate_payload, TRUNCATION_MARKER
+import modules.logging
+
+
+# ------------- [Tests] -------------
+
+def test_truncate_payload_keeps_bodies_without_long_strings():
+    body = json.dumps({"object": "list", "data": [{"embedding": [0.123456789] * 5000}], "model": "m"}).encode()
+
+    assert truncate_payload(body, 100) is body
+
+
+def test_truncate_payload_cuts_long_strings():
+    marker = TRUNCATION_MARKER % 290
+
+    assert truncate_payload(json.dumps({"content": "x" * 300}).encode(), 10) == {"content": "x" * 10 + marker}
+    assert truncate_payload(json.dumps({"content": 'x"' * 150}), 10) == {"content": 'x"' * 5 + marker}
+    assert truncate_payload("plain text " * 30, 10) == "plain text" + TRUNCATION_MARKER % 320
+
+
+def test_metadata_mode_only_extracts_fields(monkeypatch):
+    def fail(*args):
+        raise AssertionError("payloads are not truncated nor encoded in metadata mode")
+    monkeypatch.setattr(modules.logging, "LOG_PAYLOADS", "metadata")
+    monkeypatch.setattr(modules.logging, "truncate_payload", fail)
+    monkeypatch.setattr(modules.logging, "encode_payload", fail)
+
+    row = modules.logging.build_api_log_row(10, 200, "https://api.openai.com/v1/chat/completions",
+                                            {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "x" * 300000}]},
+                                            b'{"choices": [{"finish_reason": "stop"}], "usage": {"prompt_tokens": 3, "completion_tokens": 4}}',
+                                            sample_rate=1)
+
+    assert row[4:7] == (None, None, None)
+    assert row[7:12] == ("gpt-3.5-turbo", 1, 3, 4, "stop")
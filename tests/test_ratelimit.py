@@ -0,0 +1,284 @@
+"""
+Test_ratelimit.py file for ProxyGPT. This file contains the tests of the rate limit backends.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the tests
+import threading
+import time
+import pytest
+
+# Import the storage layer and the rate limit backends
+import storage
+from ratelimit import SlidingWindowCounter, MemoryRateLimitBackend, RedisRateLimitBackend, SQLiteRateLimitBackend
+
+
+# ------------- [Fixtures] -------------
+
+@pytest.fixture
+def usage_database(tmp_path, monkeypatch):
+    """
+    This fixture points the storage layer at a new migrated database, and
+    returns a function inserting usage rows at given ages in seconds.
+    """
+    monkeypatch.setattr(storage, "DATABASE_PATH", str(tmp_path / "usage.db"))
+    monkeypatch.setattr(storage, "_local", threading.local())
+    storage.migrate()
+
+    def insert_usage(ages, key_id=None):
+        now = int(time.time())
+        with storage.transaction() as conn:
+            conn.executemany("INSERT INTO api_usage (api_timestamp, key_id) VALUES (?, ?)", [(now - age, key_id) for age in ages])
+    return insert_usage
+
+
+# ------------- [Helper Functions] -------------
+
+# Function for creating a Redis backend on a Redis-compatible stand-in
+def make_redis_backend(limits: dict, key_windows: dict = None) -> RedisRateLimitBackend:
+    """
+    This function creates a Redis rate limit backend whose client is an
+    in-process fakeredis server (pip install fakeredis), which runs the Lua
+    reservation script like Redis does.
+
+    Args:
+        limits (dict): The global limits by name, as (window_seconds, limit).
+        key_windows (dict) (optional): The windows of the per-key limits by name.
+
+    Returns:
+        RedisRateLimitBackend: The backend.
+    """
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    backend = RedisRateLimitBackend(limits, redis_url="redis://localhost:6379/0", key_windows=key_windows)
+    backend.client = fakeredis.FakeRedis()
+    backend.reserve_script = backend.client.register_script(backend.RESERVE_SCRIPT)
+    return backend
+
+
+# ------------- [Tests] -------------
+
+def test_sliding_window_counter_expires_buckets_across_boundaries():
+    counter = SlidingWindowCounter(60, bucket_seconds=10)
+    counter.add(1000)
+    counter.add(1005, 2)
+    counter.add(1019)
+
+    # 1000 and 1005 share the bucket [1000, 1010), which leaves the window once it starts at 1010
+    assert counter.count(1059) == 4
+    assert counter.count(1060) == 1
+    assert counter.count(1069) == 1
+    assert counter.count(1070) == 0
+
+    # Jumping ahead by more than the window clears every bucket, and old events are ignored
+    counter.add(1085)
+    assert counter.count(5000) == 0
+    counter.add(4900)
+    assert counter.count(5000) == 0
+    counter.add(4950)
+    assert counter.count(5000) == 1
+
+def test_sliding_window_counter_seconds_until():
+    counter = SlidingWindowCounter(60)
+    counter.add(1000)
+    counter.add(1010, 2)
+    counter.add(1030)
+
+    assert counter.seconds_until(1040, 4) == 0
+    assert counter.seconds_until(1040, 3) == 20
+    assert counter.seconds_until(1040.5, 1) == 29.5
+    assert counter.seconds_until(1040, 0) == 50
+    assert counter.seconds_until(1040, -1) == 60
+
+def test_sliding_window_counter_remove_takes_the_newest_events():
+    counter = SlidingWindowCounter(60)
+    counter.add(1000, 2)
+    counter.add(1030, 1)
+    counter.remove(1040, 2)
+
+    assert counter.count(1040) == 1
+    # The remaining event is the oldest, so it expires with its bucket
+    assert counter.count(1060) == 0
+
+def test_memory_release_gives_back_calls(usage_database):
+    backend = MemoryRateLimitBackend({"hourly": (3600, 3)}, key_windows={"hourly": 3600})
+    backend.load()
+    key_limits = {"hourly": 3}
+
+    assert backend.reserve(key_id="a", key_limits=key_limits, amount=3)
+    backend.release(key_id="a", amount=2)
+    assert backend.usage("hourly") == 1
+    assert backend.usage("hourly", key_id="a") == 1
+    assert storage.get_connection().execute("SELECT COUNT(*) FROM api_usage").fetchone()[0] == 1
+    assert backend.reserve(key_id="a", key_limits=key_limits, amount=2)
+
+def test_memory_sync_skips_own_rows_and_folds_in_other_workers(usage_database):
+    usage_database([100, 200])
+    backend = MemoryRateLimitBackend({"hourly": (3600, 10)}, key_windows={"hourly": 3600})
+    backend.load()
+    assert backend.usage("hourly") == 2
+
+    # Rows written by this worker are counted once, not again when sync reads them back
+    assert backend.reserve(key_id="a", key_limits={"hourly": 5}, amount=2)
+    backend.sync(force=True)
+    assert backend.usage("hourly") == 4
+    assert backend.usage("hourly", key_id="a") == 2
+    assert not backend.own_timestamps
+
+    # Rows written by another worker (same second and key) are folded in
+    usage_database([0, 0], key_id="a")
+    backend.sync(force=True)
+    assert backend.usage("hourly") == 6
+    assert backend.usage("hourly", key_id="a") == 4
+    assert not backend.reserve(key_id="a", key_limits={"hourly": 5}, amount=2)
+
+def test_memory_retry_after(usage_database):
+    usage_database([50, 10])
+    backend = MemoryRateLimitBackend({"minute": (60, 2)})
+    backend.load()
+
+    assert 9 <= backend.retry_after() <= 11
+    assert 49 <= backend.retry_after(amount=2) <= 51
+    assert backend.retry_after(amount=3) == 60
+
+def test_redis_reserve_global_limit():
+    backend = make_redis_backend({"hourly": (3600, 3), "daily": (86400, 5)})
+
+    assert backend.reserve()
+    assert backend.reserve(amount=2)
+    assert backend.usage("hourly") == 3
+    assert backend.usage("daily") == 3
+
+    # Full: nothing is added, even for the windows that still have room
+    assert not backend.reserve()
+    assert backend.usage("daily") == 3
+
+def test_redis_reserve_is_all_or_nothing_for_amounts():
+    backend = make_redis_backend({"hourly": (3600, 5)})
+
+    assert backend.reserve(amount=4)
+    assert not backend.reserve(amount=2)
+    assert backend.usage("hourly") == 4
+    assert backend.reserve(amount=1)
+    assert backend.usage("hourly") == 5
+
+def test_redis_reserve_per_key_limits():
+    backend = make_redis_backend({"hourly": (3600, 10)}, key_windows={"hourly": 3600})
+    key_limits = {"hourly": 2}
+
+    assert backend.reserve(key_id="a", key_limits=key_limits)
+    assert backend.reserve(key_id="a", key_limits=key_limits)
+    assert not backend.reserve(key_id="a", key_limits=key_limits)
+    assert backend.reserve(key_id="b", key_limits=key_limits)
+
+    assert backend.usage("hourly", key_id="a") == 2
+    assert backend.usage("hourly", key_id="b") == 1
+    assert backend.usage("hourly") == 3
+
+def test_redis_reserve_per_key_respects_global_limit():
+    backend = make_redis_backend({"hourly": (3600, 2)}, key_windows={"hourly": 3600})
+    key_limits = {"hourly": 5}
+
+    assert backend.reserve(key_id="a", key_limits=key_limits)
+    assert backend.reserve(key_id="b", key_limits=key_limits)
+    assert not backend.reserve(key_id="a", key_limits=key_limits)
+
+    # The rejected call was not added to the set of its key either
+    assert backend.usage("hourly", key_id="a") == 1
+
+def test_redis_retry_after_waits_for_the_oldest_calls():
+    backend = make_redis_backend({"hourly": (3600, 2)})
+
+    assert backend.retry_after() == 0
+    assert backend.reserve(amount=2)
+    assert 3599 <= backend.retry_after() <= 3600
+    assert backend.retry_after(amount=3) == 3600
+
+def test_sqlite_reserve_never_overshoots_across_connections(usage_database):
+    backend = SQLiteRateLimitBackend({"hourly": (3600, 20)})
+    reserved = []
+
+    # Each thread reserves through its own connection, like separate workers
+    def reserve_many():
+        for _ in range(10):
+            if backend.reserve():
+                reserved.append(1)
+    threads = [threading.Thread(target=reserve_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(reserved) == 20
+    assert backend.usage("hourly") == 20
+
+def test_sqlite_reserve_rejects_on_any_window(usage_database):
+    usage_database([120, 120, 120])
+    backend = SQLiteRateLimitBackend({"hourly": (3600, 4), "minute": (60, 10)})
+
+    # The minute window is empty, but the hourly window has room for one call only
+    assert backend.reserve()
+    assert not backend.reserve()
+    assert backend.usage("hourly") == 4
+    assert backend.usage("minute") == 1
+
+    # A batch is rejected as a whole if any window lacks room for all of it
+    backend = SQLiteRateLimitBackend({"hourly": (3600, 10), "minute": (60, 3)})
+    assert not backend.reserve(amount=3)
+    assert backend.reserve(amount=2)
+    assert backend.usage("minute") == 3
+
+def test_sqlite_reserve_per_key_limits(usage_database):
+    backend = SQLiteRateLimitBackend({"hourly": (3600, 10)}, key_windows={"hourly": 3600})
+    key_limits = {"hourly": 2}
+
+    assert backend.reserve(key_id="a", key_limits=key_limits, amount=2)
+    assert not backend.reserve(key_id="a", key_limits=key_limits)
+    assert backend.reserve(key_id="b", key_limits=key_limits)
+    assert backend.usage("hourly", key_id="a") == 2
+    assert backend.usage("hourly") == 3
+
+def test_sqlite_retry_after_waits_for_the_oldest_calls(usage_database):
+    usage_database([50, 10])
+    usage_database([30], key_id="a")
+    backend = SQLiteRateLimitBackend({"minute": (60, 4)}, key_windows={"minute": 60})
+
+    assert backend.retry_after() == 0
+    assert backend.reserve()
+
+    # One call fits once the oldest call expires, two once the second oldest does
+    assert 9 <= backend.retry_after() <= 10
+    assert 29 <= backend.retry_after(amount=2) <= 30
+    assert backend.retry_after(amount=5) == 60
+
+    # The limits of the key only count its own calls
+    assert 29 <= backend.retry_after(key_id="a", key_limits={"minute": 1}) <= 30
+    assert 9 <= backend.retry_after(key_id="b", key_limits={"minute": 1}) <= 10
+
+def test_redis_release_gives_back_calls():
+    backend = make_redis_backend({"hourly": (3600, 3)}, key_windows={"hourly": 3600})
+
+    assert backend.reserve(key_id="a", key_limits={"hourly": 3}, amount=3)
+    backend.release(key_id="a", amount=2)
+    assert backend.usage("hourly") == 1
+    assert backend.usage("hourly", key_id="a") == 1
+    assert backend.reserve(amount=2)
+
+def test_sqlite_release_gives_back_the_newest_calls(usage_database):
+    usage_database([100], key_id="a")
+    backend = SQLiteRateLimitBackend({"hourly": (3600, 4)}, key_windows={"hourly": 3600})
+
+    assert backend.reserve(key_id="a", key_limits={"hourly": 3}, amount=2)
+    assert backend.reserve(key_id="b")
+    backend.release(key_id="a", amount=2)
+    assert backend.usage("hourly") == 2
+    assert backend.usage("hourly", key_id="a") == 1
+    assert backend.usage("hourly", key_id="b") == 1
+    remaining = storage.get_connection().execute("SELECT api_timestamp FROM api_usage WHERE key_id = 'a'").fetchall()
+    assert len(remaining) == 1 and 99 <= int(time.time()) - remaining[0][0] <= 101
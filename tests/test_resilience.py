@@ -0,0 +1,88 @@
+"""
+Test_resilience.py file for ProxyGPT. This file contains the tests of the retries and circuit breaker of upstream calls.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the tests
+import asyncio
+import time
+import pytest
+
+# Import the resilience layer
+from resilience import CircuitBreaker, Deadline, DeadlineExceeded, ResilientCaller
+
+
+# ------------- [Helpers] -------------
+
+class FakeResponse:
+    """
+    Stands in for an upstream response, recording if it was released.
+    """
+
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.headers = {}
+        self.released = False
+
+    def release(self) -> None:
+        self.released = True
+
+def make_attempt(status_codes: list, responses: list):
+    # Return an attempt answering with the given status codes in turn
+    async def attempt():
+        responses.append(FakeResponse(status_codes[len(responses)]))
+        return responses[-1]
+    return attempt
+
+
+# ------------- [Tests] -------------
+
+def test_last_retryable_response_is_not_released_when_the_breaker_opens():
+    responses = []
+    caller = ResilientCaller(CircuitBreaker(1, 30), max_attempts=3, backoff_base=0.01, backoff_max=0.01, hedge_min_delay=1, hedge_min_samples=10)
+
+    response = asyncio.run(caller.call(make_attempt([503, 200], responses), Deadline(5)))
+
+    assert response.status_code == 503
+    assert not response.released
+    assert len(responses) == 1
+
+
+def test_retried_responses_are_released():
+    responses = []
+    caller = ResilientCaller(CircuitBreaker(5, 30), max_attempts=3, backoff_base=0.01, backoff_max=0.01, hedge_min_delay=1, hedge_min_samples=10)
+
+    response = asyncio.run(caller.call(make_attempt([503, 502, 200], responses), Deadline(5)))
+
+    assert response.status_code == 200
+    assert [r.released for r in responses] == [True, True, False]
+
+
+def test_last_retryable_response_is_not_released_when_attempts_run_out():
+    responses = []
+    caller = ResilientCaller(CircuitBreaker(5, 30), max_attempts=2, backoff_base=0.01, backoff_max=0.01, hedge_min_delay=1, hedge_min_samples=10)
+
+    response = asyncio.run(caller.call(make_attempt([503, 503], responses), Deadline(5)))
+
+    assert response is responses[-1] and not response.released
+    assert responses[0].released
+
+
+def test_expired_deadline_does_not_claim_the_half_open_trial_call():
+    breaker = CircuitBreaker(1, 0.01)
+    caller = ResilientCaller(breaker, max_attempts=1, backoff_base=0.01, backoff_max=0.01, hedge_min_delay=1, hedge_min_samples=10)
+    breaker.record_failure()
+    time.sleep(0.02)
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(caller.call(make_attempt([200], []), Deadline(0.0)))
+
+    response = asyncio.run(caller.call(make_attempt([200], []), Deadline(5)))
+    assert response.status_code == 200
+    assert breaker.state == "closed"
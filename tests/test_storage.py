@@ -0,0 +1,68 @@
+"""
+Test_storage.py file for ProxyGPT. This file contains the tests of the shared SQLite storage layer.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the tests
+import sqlite3
+import pytest
+
+# Import the storage layer and the payload decoding
+import storage
+from payloads import decode_payload
+
+
+# ------------- [Fixtures] -------------
+
+@pytest.fixture
+def legacy_database(tmp_path, monkeypatch):
+    """
+    This fixture creates a database as written before migration 3 (payloads as
+    TEXT columns), and points the storage layer at it.
+    """
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE api_usage (api_timestamp integer)")
+    conn.execute("CREATE TABLE api_logs (api_timestamp INTEGER, response_time FLOAT, response_code INTEGER, endpoint TEXT, request TEXT, response_str TEXT)")
+    conn.executemany("INSERT INTO api_logs VALUES (1, 10, 200, 'endpoint', ?, ?)", [
+        (str({"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "hello %d" % i}]}), '{"choices": [{"finish_reason": "stop"}], "usage": {"prompt_tokens": %d, "completion_tokens": 1}}' % i)
+        for i in range(10)
+    ])
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(storage, "DATABASE_PATH", path)
+    monkeypatch.setattr(storage, "_local", type(storage._local)())
+    yield path
+
+
+# ------------- [Tests] -------------
+
+def test_migrate_leaves_legacy_payloads_for_later(legacy_database):
+    assert storage.migrate() == storage.MIGRATIONS[-1][0]
+    conn = storage.get_connection()
+    assert conn.execute("SELECT COUNT(*) FROM api_logs WHERE request IS NOT NULL").fetchone()[0] == 10
+
+def test_compress_logged_payloads_in_resumable_batches(legacy_database):
+    storage.migrate()
+    conn = storage.get_connection()
+
+    assert storage.compress_logged_payloads(0, batch_size=4) == (4, 4)
+    assert conn.execute("SELECT COUNT(*) FROM api_logs WHERE request IS NOT NULL").fetchone()[0] == 6
+
+    # Starting over skips the converted rows, which no longer match
+    assert storage.compress_logged_payloads(0, batch_size=4) == (4, 8)
+    assert storage.compress_logged_payloads(8, batch_size=4) == (2, 10)
+    assert storage.compress_logged_payloads(10, batch_size=4) == (0, 10)
+
+    rows = conn.execute("SELECT payload_encoding, request_blob, model, prompt_tokens, finish_reason, request, response_str FROM api_logs ORDER BY rowid").fetchall()
+    for index, (encoding, request_blob, model, prompt_tokens, finish_reason, request, response_str) in enumerate(rows):
+        assert decode_payload(encoding, request_blob)["messages"][0]["content"] == "hello %d" % index
+        assert (model, prompt_tokens, finish_reason, request, response_str) == ("gpt-3.5-turbo", index, "stop", None, None)
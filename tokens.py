@@ -0,0 +1,241 @@
+"""
+Tokens.py file for ProxyGPT. This file contains the token estimation and the token budget (tokens per minute) for the API.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for rounding up estimates and Retry-After
+import math
+
+# Required for reading the token usage of raw responses without parsing them
+import re
+
+# Required for timestamps
+import time
+
+# Required for sharing the budget between the threadpool workers of FastAPI
+import threading
+
+# Required for type hints
+from typing import List, Optional, Tuple
+
+# Use tiktoken for exact token counts if it is installed (pip install tiktoken)
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Import the sliding window counter of the rate limits
+from ratelimit import SlidingWindowCounter
+
+
+# ------------- [Classes] -------------
+
+# Define the character based tokenizer
+class CharacterTokenizer:
+    """
+    Fast tokenizer estimating one token per four characters, which is close to
+    the average for English text with OpenAI's tokenizers.
+    """
+
+    name = "chars"
+
+    def count(self, text: str) -> int:
+        """
+        This function returns the estimated number of tokens of a text.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            int: The estimated number of tokens.
+        """
+        return math.ceil(len(text) / 4)
+
+
+# Define the tiktoken based tokenizer
+class TiktokenTokenizer:
+    """
+    Tokenizer counting tokens exactly with tiktoken.
+
+    Args:
+        encoding_name (str): The name of the tiktoken encoding (cl100k_base for gpt-3.5-turbo and gpt-4).
+    """
+
+    name = "tiktoken"
+
+    def __init__(self, encoding_name: str = "cl100k_base"):
+        if tiktoken is None:
+            raise Exception("The tiktoken tokenizer requires the tiktoken package. Install it with: pip install tiktoken")
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+    def count(self, text: str) -> int:
+        """
+        This function returns the number of tokens of a text.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            int: The number of tokens.
+        """
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+# Define the token budget
+class TokenBudget:
+    """
+    Sliding window budget of upstream tokens (e.g. tokens per minute), so
+    requests that would exceed OpenAI's token rate limit are rejected locally
+    instead of costing an upstream round trip.
+
+    A request reserves its estimated tokens before it is sent, and the
+    reservation is reconciled with the actual usage reported by OpenAI once the
+    response arrives. The budget is kept in memory, so it is enforced per
+    worker.
+
+    Args:
+        tokens_per_window (int): The maximum number of tokens in the window.
+        window_seconds (int): The length of the window in seconds.
+    """
+
+    def __init__(self, tokens_per_window: int, window_seconds: int = 60):
+        self.tokens_per_window = tokens_per_window
+        self.window_seconds = window_seconds
+        self.counter = SlidingWindowCounter(window_seconds)
+        self.lock = threading.Lock()
+
+        # Metrics
+        self.reserved = 0
+        self.rejected = 0
+        self.reconciled_tokens = 0
+
+    def reserve(self, tokens: int) -> Tuple[Optional[Tuple[int, int]], float]:
+        """
+        This function reserves tokens from the budget if there is room for them.
+        A request larger than the whole budget is only let through when the
+        window is empty.
+
+        Args:
+            tokens (int): The estimated tokens of the request.
+
+        Returns:
+            Tuple[Optional[Tuple[int, int]], float]: The reservation (None if rejected), and the seconds until there is room.
+        """
+        now = time.time()
+        with self.lock:
+            used = self.counter.count(now)
+            if used + tokens > self.tokens_per_window and used > 0:
+                self.rejected += 1
+                return None, self.counter.seconds_until(now, max(self.tokens_per_window - tokens, 0))
+            timestamp = int(now)
+            self.counter.add(timestamp, tokens)
+            self.reserved += 1
+            return (timestamp, tokens), 0.0
+
+    def reconcile(self, reservation: Tuple[int, int], actual_tokens: int) -> None:
+        """
+        This function corrects a reservation to the actual tokens used.
+
+        Args:
+            reservation (Tuple[int, int]): The reservation returned by reserve.
+            actual_tokens (int): The tokens used, as reported by OpenAI.
+        """
+        timestamp, tokens = reservation
+        with self.lock:
+            self.counter.add(timestamp, actual_tokens - tokens)
+            self.reconciled_tokens += actual_tokens - tokens
+
+    def usage(self) -> int:
+        """
+        This function returns the tokens used in the current window.
+
+        Returns:
+            int: The tokens in the window.
+        """
+        with self.lock:
+            return self.counter.count(time.time())
+
+    def stats(self) -> dict:
+        """
+        This function returns the metrics of the budget.
+
+        Returns:
+            dict: The tokens in the window, and the reserved and rejected request counts.
+        """
+        return {
+            "tokens_per_window": self.tokens_per_window,
+            "window_seconds": self.window_seconds,
+            "tokens_in_window": self.usage(),
+            "reserved_requests": self.reserved,
+            "rejected_requests": self.rejected,
+            "reconciled_tokens": self.reconciled_tokens,
+        }
+
+
+# ------------- [Functions] -------------
+
+# Function for creating the tokenizer selected in settings
+def get_tokenizer(name: str):
+    """
+    This function returns the tokenizer with the given name. "auto" uses
+    tiktoken if it is installed and its encoding can be loaded, and the
+    character based estimate otherwise.
+
+    Args:
+        name (str): One of "auto", "tiktoken" or "chars".
+
+    Returns:
+        The tokenizer, with a count(text) method.
+    """
+    if name == "chars":
+        return CharacterTokenizer()
+    if name == "tiktoken":
+        return TiktokenTokenizer()
+    if name == "auto":
+        try:
+            return TiktokenTokenizer()
+        except Exception:
+            return CharacterTokenizer()
+    raise Exception(f'TOKEN_BUDGET_TOKENIZER in settings.py must be one of "auto", "tiktoken" or "chars", not "{name}".')
+
+# Function for estimating the prompt tokens of a chat completion
+def estimate_chat_tokens(messages: List[dict], tokenizer) -> int:
+    """
+    This function estimates the prompt tokens of a chat completion, including
+    the few tokens OpenAI adds around each message and to prime the reply.
+
+    Args:
+        messages (List[dict]): The messages, each with a role and content.
+        tokenizer: The tokenizer.
+
+    Returns:
+        int: The estimated prompt tokens.
+    """
+    tokens = 3
+    for message in messages:
+        tokens += 4 + tokenizer.count(message.get("role") or "") + tokenizer.count(message.get("content") or "")
+    return tokens
+
+# Pattern of the total tokens in the usage block of a raw response
+TOTAL_TOKENS_PATTERN = re.compile(rb'"total_tokens"\s*:\s*(\d+)')
+
+# Function for reading the total tokens of a raw response
+def find_total_tokens(body: bytes) -> Optional[int]:
+    """
+    This function finds the total tokens in the usage block of a raw JSON
+    response, without parsing the whole body.
+
+    Args:
+        body (bytes): The raw response body.
+
+    Returns:
+        Optional[int]: The total tokens, or None if the response has no usage block.
+    """
+    match = TOTAL_TOKENS_PATTERN.search(body)
+    return int(match.group(1)) if match else None
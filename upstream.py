@@ -0,0 +1,494 @@
+"""
+Upstream.py file for ProxyGPT. This file contains the async upstream client used to reach OpenAI.
+
+Author: Benjamin Klieger
+Version: 0.2.0-beta
+Date: 2024-01-05
+License: MIT
+"""
+
+# ------------- [Import Libraries] -------------
+
+# Required for the async keep-alive connection pool
+import aiohttp
+
+# Required for parsing upstream responses
+import json
+
+# Required for parsing the rate limit headers of upstream responses
+import re
+
+# Required for the cooldowns of upstream members
+import time
+
+# Required for type hints
+from typing import List, Optional
+
+# Import the key fingerprint, which names the members of the upstream pool
+from keys import get_key_id
+
+
+# ------------- [Classes] -------------
+
+# Define the response returned by the upstream client
+class UpstreamResponse:
+    """
+    A fully read response from the upstream API. Mirrors the small part of the
+    requests.Response interface that ProxyGPT uses (status_code, text, json()).
+    """
+
+    def __init__(self, status_code: int, headers: dict, body: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = body
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def release(self) -> None:
+        """
+        This function does nothing, as the body is already read. It lets fully
+        read and streaming responses be discarded the same way.
+        """
+
+
+# Define the streaming response returned by the upstream client
+class UpstreamStream:
+    """
+    An open streaming response from the upstream API. The body is relayed
+    chunk by chunk with iter_chunks(), and the connection is returned to the
+    pool by release() once the stream has been consumed or abandoned.
+    """
+
+    def __init__(self, response: aiohttp.ClientResponse):
+        self._response = response
+        self.status_code = response.status
+        self.headers = dict(response.headers)
+
+    async def iter_chunks(self):
+        """
+        This function yields the body chunks as soon as they arrive from upstream.
+        """
+        async for chunk in self._response.content.iter_any():
+            yield chunk
+
+    async def read(self) -> UpstreamResponse:
+        """
+        This function reads the remaining body and releases the connection.
+
+        Returns:
+            UpstreamResponse: The fully read upstream response.
+        """
+        try:
+            body = await self._response.read()
+        finally:
+            self.release()
+        return UpstreamResponse(status_code=self.status_code, headers=self.headers, body=body)
+
+    def release(self) -> None:
+        """
+        This function returns the connection to the pool (or closes it if the body was not fully read).
+        """
+        self._response.release()
+
+
+# Define the async upstream client
+class UpstreamClient:
+    """
+    Async HTTP client holding one shared keep-alive connection pool per worker.
+
+    The pool is created on startup and closed on shutdown through the app
+    lifespan, so requests reuse open TLS connections instead of performing a
+    new handshake for every call.
+
+    Args:
+        pool_size (int): The maximum number of open connections in the pool.
+        pool_size_per_host (int): The maximum number of open connections per host (0 for no limit).
+        connect_timeout (float): Seconds to wait for a connection to be established.
+        total_timeout (float): Seconds to wait for a complete request and response.
+        keepalive_timeout (float): Seconds an idle connection is kept open for reuse.
+    """
+
+    def __init__(self, pool_size: int, pool_size_per_host: int, connect_timeout: float, total_timeout: float, keepalive_timeout: float):
+        self.pool_size = pool_size
+        self.pool_size_per_host = pool_size_per_host
+        self.connect_timeout = connect_timeout
+        self.total_timeout = total_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self) -> None:
+        """
+        This function opens the shared connection pool. It must be called from
+        inside the running event loop (the app lifespan).
+        """
+        if self.session is not None:
+            return
+
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size,
+            limit_per_host=self.pool_size_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=300,
+        )
+        timeout = aiohttp.ClientTimeout(total=self.total_timeout, connect=self.connect_timeout)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def close(self) -> None:
+        """
+        This function closes the shared connection pool and all open connections.
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def post(self, url: str, json: dict, headers: dict) -> UpstreamResponse:
+        """
+        This function sends a POST request with a JSON body and reads the full response.
+
+        Args:
+            url (str): The upstream url.
+            json (dict): The JSON payload of the request.
+            headers (dict): The headers of the request.
+
+        Returns:
+            UpstreamResponse: The fully read upstream response.
+        """
+
+        # Open the pool lazily if the lifespan was not run (e.g. in a script)
+        if self.session is None:
+            await self.start()
+
+        async with self.session.post(url, json=json, headers=headers) as response:
+            body = await response.read()
+            return UpstreamResponse(status_code=response.status, headers=dict(response.headers), body=body)
+
+    async def open_stream(self, url: str, json: dict, headers: dict) -> UpstreamStream:
+        """
+        This function sends a POST request with a JSON body and returns as soon as
+        the response headers arrive, leaving the body to be streamed.
+
+        Args:
+            url (str): The upstream url.
+            json (dict): The JSON payload of the request.
+            headers (dict): The headers of the request.
+
+        Returns:
+            UpstreamStream: The open upstream response. The caller must release it.
+        """
+
+        # Open the pool lazily if the lifespan was not run (e.g. in a script)
+        if self.session is None:
+            await self.start()
+
+        # Streams may legitimately run longer than a single read, so only bound the connection and each read
+        timeout = aiohttp.ClientTimeout(total=None, connect=self.connect_timeout, sock_read=self.total_timeout)
+        response = await self.session.post(url, json=json, headers=headers, timeout=timeout)
+        return UpstreamStream(response)
+
+    async def open_request(self, method: str, url: str, body: Optional[bytes], headers: dict) -> UpstreamStream:
+        """
+        This function sends a request with a raw body, unchanged, and returns as
+        soon as the response headers arrive. The caller reads the body in full
+        or streams it, depending on the response.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The upstream url.
+            body (Optional[bytes]): The raw body of the request.
+            headers (dict): The headers of the request.
+
+        Returns:
+            UpstreamStream: The open upstream response. The caller must release it.
+        """
+
+        # Open the pool lazily if the lifespan was not run (e.g. in a script)
+        if self.session is None:
+            await self.start()
+
+        # The response may be streamed, so only bound the connection and each read
+        timeout = aiohttp.ClientTimeout(total=None, connect=self.connect_timeout, sock_read=self.total_timeout)
+        response = await self.session.request(method, url, data=body or None, headers=headers, timeout=timeout)
+        return UpstreamStream(response)
+
+
+# Define the error raised when no upstream member can take a request
+class UpstreamUnavailable(Exception):
+    """
+    Raised when every member of the upstream pool is cooling down after a rate
+    limit, or is at capacity.
+
+    Args:
+        status_code (int): 429 if every member is rate limited, 503 if every member is at capacity.
+        retry_after (int): The suggested seconds before retrying.
+    """
+
+    def __init__(self, status_code: int, retry_after: int):
+        super().__init__("No upstream member is available")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+# Define a member of the upstream pool
+class UpstreamMember:
+    """
+    One OpenAI key (and base url) of the upstream pool, with its outstanding
+    requests, cooldown and usage as seen by this worker.
+
+    Args:
+        api_key (str): The OpenAI API key.
+        base_url (str): The base url of the API, e.g. https://api.openai.com/v1.
+    """
+
+    def __init__(self, api_key: str, base_url: str):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.name = get_key_id(api_key)
+        self.outstanding = 0
+        self.cooldown_until = 0.0
+        self.last_used = 0.0
+
+        # Usage and health
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.remaining_requests = None
+        self.remaining_tokens = None
+
+    def stats(self, now: float) -> dict:
+        """
+        This function returns the health and usage of the member.
+
+        Args:
+            now (float): The current time.
+
+        Returns:
+            dict: The outstanding requests, cooldown, and counts of the member.
+        """
+        return {
+            "member": self.name,
+            "base_url": self.base_url,
+            "outstanding": self.outstanding,
+            "cooldown_seconds": round(max(self.cooldown_until - now, 0.0), 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "remaining_requests": self.remaining_requests,
+            "remaining_tokens": self.remaining_tokens,
+        }
+
+
+# Define the upstream pool
+class UpstreamPool:
+    """
+    Pool of OpenAI keys (and base urls), so total throughput scales with the
+    number of keys instead of being capped by one organization's rate limits.
+
+    Each request goes to the available member with the fewest outstanding
+    requests (least recently used on ties). A member is unavailable while it
+    has capacity outstanding requests, or while it cools down after a 429 or
+    after reporting no remaining requests or tokens, for as long as its
+    Retry-After or x-ratelimit-reset-* headers say.
+
+    The state is kept per worker and only read and changed from its event loop.
+
+    Args:
+        members (List[UpstreamMember]): The members of the pool.
+        capacity (Optional[int]): The maximum outstanding requests per member (None for no limit).
+        default_cooldown (float): Seconds a member cools down after a 429 without rate limit headers.
+    """
+
+    def __init__(self, members: List[UpstreamMember], capacity: Optional[int], default_cooldown: float):
+        self.members = members
+        self.capacity = capacity
+        self.default_cooldown = default_cooldown
+
+    def acquire(self) -> UpstreamMember:
+        """
+        This function picks the member for a request and counts it as outstanding.
+
+        Returns:
+            UpstreamMember: The member to send the request to.
+
+        Raises:
+            UpstreamUnavailable: If no member is available.
+        """
+        now = time.time()
+        best = None
+        for member in self.members:
+            if member.cooldown_until > now or (self.capacity is not None and member.outstanding >= self.capacity):
+                continue
+            if best is None or (member.outstanding, member.last_used) < (best.outstanding, best.last_used):
+                best = member
+
+        if best is None:
+            if self.members and all(member.cooldown_until > now for member in self.members):
+                raise UpstreamUnavailable(429, max(1, int(min(member.cooldown_until for member in self.members) - now + 0.999)))
+            raise UpstreamUnavailable(503, 1)
+
+        best.outstanding += 1
+        best.requests += 1
+        best.last_used = now
+        return best
+
+    def release(self, member: UpstreamMember, status_code: Optional[int] = None, headers: Optional[dict] = None) -> None:
+        """
+        This function counts a request of a member as finished, and cools the
+        member down if the response shows it is rate limited.
+
+        Args:
+            member (UpstreamMember): The member returned by acquire.
+            status_code (int) (optional): The status code of the response (None if the request failed).
+            headers (dict) (optional): The headers of the response.
+        """
+        member.outstanding -= 1
+        if status_code is None or status_code >= 500:
+            member.errors += 1
+        headers = {name.lower(): value for name, value in (headers or {}).items()}
+
+        # Track the remaining budget reported by OpenAI
+        remaining_requests = parse_int_header(headers.get("x-ratelimit-remaining-requests"))
+        remaining_tokens = parse_int_header(headers.get("x-ratelimit-remaining-tokens"))
+        if remaining_requests is not None:
+            member.remaining_requests = remaining_requests
+        if remaining_tokens is not None:
+            member.remaining_tokens = remaining_tokens
+
+        # Cool down on a 429, or when a budget is used up, until it resets
+        cooldown = None
+        if status_code == 429:
+            member.rate_limited += 1
+            cooldown = parse_duration(headers.get("retry-after"))
+            if cooldown is None:
+                resets = [parse_duration(headers.get("x-ratelimit-reset-requests")), parse_duration(headers.get("x-ratelimit-reset-tokens"))]
+                resets = [reset for reset in resets if reset is not None]
+                cooldown = max(resets) if resets else self.default_cooldown
+        elif remaining_requests == 0:
+            cooldown = parse_duration(headers.get("x-ratelimit-reset-requests"))
+        elif remaining_tokens == 0:
+            cooldown = parse_duration(headers.get("x-ratelimit-reset-tokens"))
+        if cooldown:
+            member.cooldown_until = max(member.cooldown_until, time.time() + cooldown)
+
+    @staticmethod
+    def headers(member: UpstreamMember, headers: dict) -> dict:
+        """
+        This function returns the headers of a request with the Authorization of a member.
+
+        Args:
+            member (UpstreamMember): The member the request is sent to.
+            headers (dict): The other headers of the request.
+
+        Returns:
+            dict: The headers of the request.
+        """
+        return {**headers, "Authorization": "Bearer " + member.api_key}
+
+    def stats(self) -> List[dict]:
+        """
+        This function returns the health and usage of every member.
+
+        Returns:
+            List[dict]: The stats of each member.
+        """
+        now = time.time()
+        return [member.stats(now) for member in self.members]
+
+
+# ------------- [Functions] -------------
+
+# Pattern of one part of a duration, e.g. "6m" or "0.5s" in "6m0.5s"
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+# Function for parsing the duration of a rate limit header
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """
+    This function parses a duration in seconds from a Retry-After header (in
+    seconds) or an x-ratelimit-reset-* header (e.g. "1s", "6m0s" or "20ms").
+
+    Args:
+        value (Optional[str]): The header value.
+
+    Returns:
+        Optional[float]: The duration in seconds, or None if it cannot be parsed.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PATTERN.findall(value)
+    if not parts:
+        return None
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+# Function for parsing an integer header
+def parse_int_header(value: Optional[str]) -> Optional[int]:
+    """
+    This function parses an integer header value.
+
+    Args:
+        value (Optional[str]): The header value.
+
+    Returns:
+        Optional[int]: The integer, or None if it cannot be parsed.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+# Function for assembling a streamed chat completion into a single response
+def assemble_chat_completion_stream(body: bytes) -> dict:
+    """
+    This function rebuilds a chat completion object from the Server-Sent-Events
+    body of a streamed chat completion, joining the content deltas per choice.
+
+    Args:
+        body (bytes): The raw SSE body relayed to the client.
+
+    Returns:
+        dict: The assembled chat completion.
+    """
+
+    completion = {"object": "chat.completion", "choices": []}
+    choices = {}
+
+    for line in body.decode("utf-8", errors="replace").splitlines():
+        # Only data lines carry chunks, and [DONE] marks the end of the stream
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "" or data == "[DONE]":
+            continue
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            continue
+
+        # Copy the completion metadata from the chunks
+        for field in ("id", "created", "model", "system_fingerprint", "usage"):
+            if chunk.get(field) is not None:
+                completion[field] = chunk[field]
+
+        # Join the deltas of each choice
+        for chunk_choice in chunk.get("choices", []):
+            index = chunk_choice.get("index", 0)
+            choice = choices.setdefault(index, {"index": index, "message": {"role": "assistant", "content": ""}, "finish_reason": None})
+            delta = chunk_choice.get("delta") or {}
+            if delta.get("role"):
+                choice["message"]["role"] = delta["role"]
+            if delta.get("content"):
+                choice["message"]["content"] += delta["content"]
+            if chunk_choice.get("finish_reason") is not None:
+                choice["finish_reason"] = chunk_choice["finish_reason"]
+
+    completion["choices"] = [choices[index] for index in sorted(choices)]
+    return completion